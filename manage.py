@@ -1,10 +1,22 @@
 import datetime
 import json
 import os
+import shutil
+import sys
+import tempfile
+import time
 
+import peewee
 from flask.ext.script import Manager
+from playhouse.migrate import Migrator
 
-from mcbench.models import Benchmark, Query, QueryMatch
+import mcbench.bench
+import mcbench.manifest
+import mcbench.remote
+import mcbench.xpath
+from mcbench.models import (
+    db, insert_many, Benchmark, File, IndexTerm, Query, QueryMatch,
+    QueryStats)
 from mcbench import settings, querier
 from mcbench import app
 
@@ -22,21 +34,78 @@ EXAMPLE_QUERIES = (
 )
 
 
+MODELS = (Benchmark, File, Query, QueryMatch, IndexTerm, QueryStats)
+
+
 @manager.command
 def create_tables():
-    Benchmark.create_table()
-    Query.create_table()
-    QueryMatch.create_table()
+    for model in MODELS:
+        model.create_table()
 
 
 @manager.command
 def drop_tables():
-    Benchmark.drop_table()
-    Query.drop_table()
-    QueryMatch.drop_table()
+    for model in reversed(MODELS):
+        model.drop_table(fail_silently=True)
+
+
+def model_indexes(model):
+    """Returns the (fields, unique) pairs of the indexes create_table makes
+    for model."""
+    indexes = [([field], field.unique) for field in model._meta.fields.values()
+               if not field.primary_key and
+               (field.index or field.unique or
+                isinstance(field, peewee.ForeignKeyField))]
+    for fields, unique in model._meta.indexes:
+        indexes.append(([model._meta.fields[name] for name in fields],
+                        unique))
+    return indexes
+
+
+@manager.command
+def migrate():
+    """Creates missing tables, adds missing columns and indexes to existing
+    ones, merges duplicate queries, and records the files of benchmarks
+    that were never scanned (those of a database from before files were
+    recorded)."""
+    migrator = Migrator(db)
+    for model in MODELS:
+        if not model.table_exists():
+            model.create_table()
+            continue
+        table = model._meta.db_table
+        columns = set(row[1] for row in db.execute_sql(
+            'PRAGMA table_info(%s)' % migrator.quote(table)))
+        for field in model._meta.fields.values():
+            if field.db_column not in columns:
+                migrator.add_column(model, field)
+                if field.default is not None:
+                    model.update(**{field.name: field.default}).execute()
+        indexes = set(row[1] for row in db.execute_sql(
+            'PRAGMA index_list(%s)' % migrator.quote(table)))
+        for fields, unique in model_indexes(model):
+            name = '%s_%s' % (table, '_'.join(f.db_column for f in fields))
+            if name not in indexes:
+                db.create_index(model, fields, unique)
+    merge_duplicate_queries()
+    unscanned = list(Benchmark.select().where(Benchmark.scanned >> None))
+    if unscanned:
+        for benchmark in unscanned:
+            benchmark.scan_files()
+        validate_benchmarks(unscanned)
+        print 'Scanned the files of %d benchmarks.' % len(unscanned)
+
+
+@manager.command
+def merge_duplicate_queries():
+    """Merges queries that are equivalent once normalized; see
+    mcbench.normalization."""
+    merged = Query.merge_duplicates()
+    if merged:
+        print 'Merged %d duplicate queries.' % merged
 
 
-def create_benchmark_from_manifest_entry(entry):
+def benchmark_from_manifest_entry(entry):
     date_submitted = datetime.datetime.strptime(
         entry['date_submitted'], '%d %b %Y')
     date_updated = datetime.datetime.strptime(
@@ -44,31 +113,330 @@ def create_benchmark_from_manifest_entry(entry):
     fields = dict(entry,
                   date_submitted=date_submitted,
                   date_updated=date_updated)
-    benchmark = Benchmark.create(**fields)
+    return Benchmark(**fields)
+
+
+def compact_benchmarks(benchmarks):
+    """Compacts benchmarks, reporting the files that don't parse; queries
+    skip those."""
+    for path, error in sorted(querier.compact_benchmarks(benchmarks)):
+        print 'Could not parse %s: %s' % (path, error)
+
+
+def validate_benchmarks(benchmarks):
+    compact_benchmarks(benchmarks)
+    querier.detect_encodings(benchmarks)
+    querier.index_benchmarks(benchmarks)
+
+
+# How many benchmarks load_manifest inserts at a time.
+INSERT_BATCH_SIZE = 500
 
 
 @manager.command
-def load_manifest(manifest):
-    existing_benchmarks = set(b.name for b in Benchmark.all())
-    with open(manifest) as f:
-        manifest = json.load(f)
-        for project in manifest['projects']:
-            if project['name'] not in existing_benchmarks:
-                create_benchmark_from_manifest_entry(project)
+def load_manifest(manifest, refresh_queries=False):
+    """Adds the benchmarks in manifest that aren't there yet, all in one
+    transaction, and then validates them. With --refresh_queries, saved
+    queries are then evaluated against them.
+
+    The benchmarks are committed before they're validated, so that other
+    writers don't wait for the workers; if validating them fails, run
+    compact_asts, detect_encodings and build_index to finish it."""
+    with db.transaction():
+        existing_benchmarks = set(name for name, in
+                                  Benchmark.select(Benchmark.name).tuples())
+        new_names = set()
+        batch = []
+        with open(manifest) as f:
+            for project in mcbench.manifest.iter_projects(f):
+                if (project['name'] in existing_benchmarks or
+                        project['name'] in new_names):
+                    continue
+                new_names.add(project['name'])
+                batch.append(benchmark_from_manifest_entry(project))
+                if len(batch) == INSERT_BATCH_SIZE:
+                    insert_many(batch)
+                    batch = []
+        insert_many(batch)
+        new_benchmarks = [b for b in Benchmark.all() if b.name in new_names]
+        for benchmark in new_benchmarks:
+            benchmark.scan_files()
+    validate_benchmarks(new_benchmarks)
+    if refresh_queries:
+        update_query_results(Query.saved())
+
+
+@manager.command
+def refresh_files(full=False):
+    """Updates the recorded files of every benchmark, and reindexes those
+    that changed. Without --full, directories aren't walked again."""
+    changed = []
+    for benchmark in Benchmark.all():
+        if full:
+            benchmark.scan_files()
+            changed.append(benchmark)
+        elif benchmark.refresh_files():
+            changed.append(benchmark)
+    validate_benchmarks(changed)
+
+
+@manager.command
+def compact_asts():
+    compact_benchmarks(Benchmark.all())
+
+
+@manager.command
+def build_index():
+    querier.index_benchmarks(Benchmark.all())
+
+
+@manager.command
+def compress_xml(decompress=False):
+    """Stores the XML of every benchmark gzipped, which takes about a tenth
+    of the space; queries and pages read it either way. With --decompress,
+    stores it uncompressed again."""
+    print 'Converted %d files.' % querier.store_xml(Benchmark.all(),
+                                                   not decompress)
+
+
+@manager.command
+def detect_encodings():
+    """Detects the encoding of the Matlab source of the files that have none
+    recorded, in the worker processes."""
+    print 'Detected the encoding of %d files.' % (
+        querier.detect_encodings(Benchmark.all()))
+
+
+def print_query_stats(stats):
+    print '%8.3fs  %s%s' % (stats.elapsed, stats.query.xpath,
+                            ' (cut short: %s)' % stats.incomplete
+                            if stats.incomplete else '')
+    print ('           %d benchmarks, %d files; plan %.3fs, parse %.3fs, '
+           'evaluate %.3fs, write %.3fs; %d extension calls' % (
+               stats.benchmarks, stats.files, stats.plan_time,
+               stats.parse_time, stats.evaluate_time, stats.write_time,
+               stats.extension_calls))
+
+
+def update_query_results(queries):
+    recorded = querier.update_matches_many(queries).values()
+    for stats in sorted(recorded, key=lambda s: -s.evaluate_time):
+        print_query_stats(stats)
 
 
 @manager.command
 def load_initial_queries():
-    for name, xpath in EXAMPLE_QUERIES:
-        query = Query.create(xpath=xpath, name=name)
-        query.cache_matches(querier.compute_matches(xpath))
+    update_query_results([Query.create(xpath=xpath, name=name)
+                          for name, xpath in EXAMPLE_QUERIES])
 
 
 @manager.command
 def refresh_query_results():
-    for query in Query.all():
-        query.expire_matches()
-        query.cache_matches(querier.compute_matches(query.xpath))
+    """Brings cached query results up to date, only evaluating queries
+    against benchmarks that are new or changed since they were cached."""
+    QueryMatch.delete_orphans()
+    update_query_results(Query.all())
+
+
+@manager.command
+def slow_queries(limit=10):
+    """Shows the queries that took longest to evaluate, and the benchmarks
+    that took longest in each."""
+    for stats in QueryStats.slowest(int(limit)):
+        print_query_stats(stats)
+        for match in stats.query.slowest_matches(3):
+            print '           %8.3fs  %s' % (match.seconds,
+                                             match.benchmark.name)
+
+
+@manager.command
+def compare_rewrites(repeat=5):
+    """Times the example queries over every file with and without their
+    extension calls rewritten into plain XPath."""
+    trees = [mcbench.xpath.parse_xml_filename(file.ast_path)
+             for benchmark in Benchmark.all() for file in benchmark.files]
+
+    def run(compiled):
+        start = time.time()
+        for _ in range(int(repeat)):
+            for tree in trees:
+                compiled.execute(tree)
+        return time.time() - start
+
+    for _, xpath in EXAMPLE_QUERIES:
+        plain = run(mcbench.xpath.compile(xpath, rewrite=False))
+        rewritten = run(mcbench.xpath.compile(xpath))
+        print '%8.3fs %8.3fs %6.1fx  %s' % (plain, rewritten,
+                                            plain / rewritten, xpath)
+
+
+@manager.command
+def bench(copies=10, repeat=5, seed=0, output=''):
+    """Measures query latency and throughput on a synthetic corpus of copies
+    copies of the test data, and writes the results as JSON to output (or
+    standard output)."""
+    if int(repeat) < 1:
+        sys.exit('--repeat must be at least 1.')
+    directory = tempfile.mkdtemp(prefix='mcbench-bench-')
+    try:
+        settings.DATA_ROOT = os.path.join(directory, 'data')
+        mcbench.bench.make_corpus('testdata', settings.DATA_ROOT,
+                                  int(copies), seed=int(seed))
+        db.init(os.path.join(directory, 'bench.sqlite'))
+        create_tables()
+        start = time.time()
+        load_manifest(os.path.join(settings.DATA_ROOT, 'manifest.json'))
+        ingest_time = time.time() - start
+
+        files = list(File.select())
+        queries = [('example', xpath) for _, xpath in EXAMPLE_QUERIES]
+        queries.extend(('pathological', xpath)
+                       for xpath in mcbench.bench.PATHOLOGICAL_QUERIES)
+        results = {
+            'corpus': {
+                'copies': int(copies),
+                'seed': int(seed),
+                'benchmarks': Benchmark.count(),
+                'files': len(files),
+                'xml_bytes': sum(f.xml_size or 0 for f in files),
+            },
+            'worker_processes': settings.WORKER_PROCESSES,
+            'repeat': int(repeat),
+            'ingest_time': ingest_time,
+            'queries': mcbench.bench.run(queries, int(repeat)),
+        }
+    finally:
+        shutil.rmtree(directory)
+    if output:
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    else:
+        print json.dumps(results, indent=2, sort_keys=True)
+
+
+# Spelled out, as --giants and --giant_copies would both get -g.
+@manager.option('--copies', type=int, default=20)
+@manager.option('--giants', type=int, default=2)
+@manager.option('--giant_copies', type=int, default=50)
+@manager.option('--repeat', type=int, default=3)
+@manager.option('--seed', type=int, default=0)
+def bench_schedule(copies, giants, giant_copies, repeat, seed):
+    """Measures the p50 and p99 time searching takes on a skewed synthetic
+    corpus (see mcbench.bench.make_skewed_corpus), with and without
+    splitting large benchmarks into a task per file, and prints the results
+    as JSON."""
+    directory = tempfile.mkdtemp(prefix='mcbench-bench-')
+    try:
+        settings.DATA_ROOT = os.path.join(directory, 'data')
+        mcbench.bench.make_skewed_corpus(
+            'testdata', settings.DATA_ROOT, copies, giants, giant_copies,
+            seed=seed)
+        db.init(os.path.join(directory, 'bench.sqlite'))
+        create_tables()
+        load_manifest(os.path.join(settings.DATA_ROOT, 'manifest.json'))
+        xpaths = [xpath for _, xpath in EXAMPLE_QUERIES]
+        xpaths.extend(mcbench.bench.PATHOLOGICAL_QUERIES)
+        results = {
+            'corpus': {
+                'benchmarks': Benchmark.count(),
+                'files': File.select().count(),
+                'giants': giants,
+                'giant_copies': giant_copies,
+            },
+            'worker_processes': settings.WORKER_PROCESSES,
+            'queries': len(xpaths),
+            'repeat': repeat,
+            'schedules': [
+                mcbench.bench.completion_times(xpaths, repeat, size)
+                for size in (None, settings.TASK_SPLIT_SIZE)],
+        }
+    finally:
+        shutil.rmtree(directory)
+    print json.dumps(results, indent=2, sort_keys=True)
+
+
+@manager.command
+def bench_storage(copies=10, repeat=3, seed=0):
+    """Measures the time searching takes with nothing cached on a synthetic
+    corpus of copies copies of the test data, with its XML stored
+    uncompressed and then gzipped, and prints the results as JSON.
+
+    The page cache can only be dropped between searches when running as
+    root; otherwise, only the workers' caches are."""
+    directory = tempfile.mkdtemp(prefix='mcbench-bench-')
+    try:
+        settings.DATA_ROOT = os.path.join(directory, 'data')
+        mcbench.bench.make_corpus('testdata', settings.DATA_ROOT,
+                                  int(copies), seed=int(seed))
+        db.init(os.path.join(directory, 'bench.sqlite'))
+        create_tables()
+        load_manifest(os.path.join(settings.DATA_ROOT, 'manifest.json'))
+        xpaths = [xpath for _, xpath in EXAMPLE_QUERIES]
+        xpaths.extend(mcbench.bench.PATHOLOGICAL_QUERIES)
+        results = {
+            'corpus': {
+                'benchmarks': Benchmark.count(),
+                'files': File.select().count(),
+            },
+            'worker_processes': settings.WORKER_PROCESSES,
+            'queries': len(xpaths),
+            'repeat': int(repeat),
+        }
+        results['raw'] = mcbench.bench.cold_query_times(xpaths, int(repeat))
+        start = time.time()
+        querier.store_xml(Benchmark.all(), True)
+        results['compress_time'] = time.time() - start
+        results['gzip'] = mcbench.bench.cold_query_times(xpaths, int(repeat))
+    finally:
+        shutil.rmtree(directory)
+    print json.dumps(results, indent=2, sort_keys=True)
+
+
+@manager.command
+def bench_db(benchmarks=20000, seconds=5):
+    """Measures the latency of reading a saved query's results while another
+    query's results for benchmarks benchmarks are being written, with and
+    without write-ahead logging, and prints the results as JSON."""
+    results = []
+    for journal_mode in ('DELETE', 'WAL'):
+        directory = tempfile.mkdtemp(prefix='mcbench-bench-')
+        try:
+            db.init(os.path.join(directory, 'bench.sqlite'))
+            create_tables()
+            results.append(mcbench.bench.reader_latency(
+                int(benchmarks), float(seconds), journal_mode))
+        finally:
+            db.close()
+            shutil.rmtree(directory)
+    print json.dumps(results, indent=2, sort_keys=True)
+
+
+# Spelled out, as the short options @manager.command would make up clash
+# with each other and with -h for help.
+@manager.option('--host', default='127.0.0.1')
+@manager.option('--port', type=int, default=9000)
+@manager.option('--data_root', default='')
+@manager.option('--processes', type=int, default=0)
+def serve_worker(host, port, data_root, processes):
+    """Runs query tasks sent by a RemoteExecutor (see WORKER_HOSTS) on the
+    benchmarks in data_root (by default, DATA_ROOT).
+
+    Only listens on this host unless given another --host to listen on;
+    --host '' listens on every interface. Refuses to start without
+    WORKER_AUTHKEY set."""
+    if not settings.WORKER_AUTHKEY:
+        sys.exit('Set WORKER_AUTHKEY in local_settings.py first.')
+    if data_root:
+        settings.DATA_ROOT = data_root
+    mcbench.remote.serve((host, port), settings.WORKER_AUTHKEY,
+                         querier.local_pool(processes))
+
+
+@manager.command
+def evict_queries():
+    """Deletes the least recently used unsaved queries while their cached
+    results take up more than QUERY_CACHE_MAX_BYTES."""
+    print 'Evicted %d queries.' % querier.evict_queries()
 
 
 @manager.command
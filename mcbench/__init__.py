@@ -8,6 +8,9 @@ app = flask.Flask(__name__)
 app.config.from_object('mcbench.settings')
 app.jinja_env.filters['highlight_matlab'] = mcbench.highlighters.matlab
 app.jinja_env.filters['highlight_xml'] = mcbench.highlighters.xml
+app.jinja_env.filters['highlight_matlab_file'] = \
+    mcbench.highlighters.matlab_file
+app.jinja_env.filters['highlight_xml_file'] = mcbench.highlighters.xml_file
 db.init(app.config['DB_PATH'])
 assets.init_app(app)
 
@@ -0,0 +1,246 @@
+"""Static analysis of XPath queries against the McLab AST index.
+
+The analysis is conservative: it only claims that a file must contain some
+tag or attribute value for a query to match it when that is certain, and it
+claims nothing about queries it doesn't understand.
+"""
+import collections
+import re
+
+# Attributes whose values are indexed, in addition to element tags.
+INDEXED_ATTRIBUTES = ('nameId', 'kind')
+
+_TOKEN = re.compile(r'''\s*(
+    "[^"]*" | '[^']*'
+  | \d+(?:\.\d*)? | \.\d+
+  | // | :: | \.\. | != | <= | >= | [/\[\]()@,|=<>+*.$-]
+  | [A-Za-z_][\w.-]*(?::[A-Za-z_][\w.-]*)?
+)''', re.VERBOSE)
+
+# Tokens after which 'and', 'or', '*' etc. can't be operators.
+_OPERATORS = frozenset([
+    '/', '//', '::', '@', '(', '[', ',', '|', '=', '!=', '<', '<=', '>',
+    '>=', '+', '-', '*', 'and', 'or', 'div', 'mod'])
+
+_NON_ELEMENT_AXES = ('attribute', 'namespace')
+
+
+def attribute_term(name, value):
+    return '@%s=%s' % (name, value)
+
+
+def document_terms(xml):
+    """Counts the index terms (tags and indexed attribute values) in xml."""
+    terms = collections.Counter()
+    for element in xml.iter():
+        if not isinstance(element.tag, basestring):
+            continue
+        terms[element.tag] += 1
+        for name in INDEXED_ATTRIBUTES:
+            value = element.get(name)
+            if value is not None:
+                terms[attribute_term(name, value)] += 1
+    return terms
+
+
+def tokenize_spans(query):
+    """Splits query into tokens, returned as (token, start, end) triples
+    giving where in query each one is."""
+    spans = []
+    pos = 0
+    while query[pos:].strip():
+        match = _TOKEN.match(query, pos)
+        if match is None:
+            raise ValueError('unexpected %r in query' % query[pos:])
+        spans.append((match.group(1), match.start(1), match.end(1)))
+        pos = match.end()
+    return spans
+
+
+def tokenize(query):
+    return [token for token, _, _ in tokenize_spans(query)]
+
+
+def _is_literal(token):
+    return token[0] in '\'"'
+
+
+def _is_name(token):
+    return token[0].isalpha() or token[0] == '_'
+
+
+def _is_operator(tokens, i):
+    return i > 0 and tokens[i - 1] not in _OPERATORS
+
+
+def _closing(tokens, i):
+    depth = 0
+    for j in range(i, len(tokens)):
+        if tokens[j] in ('(', '['):
+            depth += 1
+        elif tokens[j] in (')', ']'):
+            depth -= 1
+            if depth == 0:
+                return j
+    raise ValueError('unbalanced brackets in query')
+
+
+def _split(tokens, separator):
+    """Splits tokens on separator, except where it is nested in brackets."""
+    parts = [[]]
+    depth = 0
+    for i, token in enumerate(tokens):
+        if token in ('(', '['):
+            depth += 1
+        elif token in (')', ']'):
+            depth -= 1
+        elif (depth == 0 and token == separator and
+              (not _is_name(token) or _is_operator(tokens, i))):
+            parts.append([])
+            continue
+        parts[-1].append(token)
+    return parts
+
+
+def _call_args(tokens, name):
+    """Returns the arguments of tokens if they are exactly a call to name."""
+    if (len(tokens) < 3 or tokens[0] != name or tokens[1] != '(' or
+            _closing(tokens, 1) != len(tokens) - 1):
+        return None
+    if len(tokens) == 3:
+        return []
+    return _split(tokens[2:-1], ',')
+
+
+def _steps(tokens):
+    """Parses tokens as a location path.
+
+    Returns a list of (axis, node test, predicates) triples, where each
+    predicate is a list of tokens, or None if tokens aren't a location path.
+    """
+    steps = []
+    i = 1 if tokens and tokens[0] in ('/', '//') else 0
+    while i < len(tokens):
+        axis = 'child'
+        if tokens[i] == '@':
+            axis = 'attribute'
+            i += 1
+        elif i + 1 < len(tokens) and tokens[i + 1] == '::':
+            axis = tokens[i]
+            i += 2
+        if i == len(tokens):
+            return None
+        test = tokens[i]
+        i += 1
+        if test in ('.', '..'):
+            axis = 'self'
+        elif not (_is_name(test) or test == '*'):
+            return None
+        elif i < len(tokens) and tokens[i] == '(':
+            # A node type test like node() or text(), or a function call.
+            if i + 1 == len(tokens) or tokens[i + 1] != ')' or axis != 'child':
+                return None
+            test += '()'
+            i += 2
+        predicates = []
+        while i < len(tokens) and tokens[i] == '[':
+            end = _closing(tokens, i)
+            predicates.append(tokens[i + 1:end])
+            i = end + 1
+        steps.append((axis, test, predicates))
+        if i == len(tokens):
+            return steps
+        if tokens[i] not in ('/', '//'):
+            return None
+        i += 1
+    return None
+
+
+def _path_requirements(steps):
+    required = []
+    for axis, test, predicates in steps:
+        if (axis not in _NON_ELEMENT_AXES and _is_name(test) and
+                not test.endswith('()') and ':' not in test):
+            required.append(frozenset([test]))
+        for predicate in predicates:
+            required.extend(_predicate_requirements(predicate))
+    return required
+
+
+def _predicate_requirements(tokens):
+    if len(_split(tokens, 'or')) > 1:
+        return []
+    required = []
+    for conjunct in _split(tokens, 'and'):
+        required.extend(_conjunct_requirements(conjunct))
+    return required
+
+
+def _conjunct_requirements(tokens):
+    if not tokens:
+        return []
+    names = _call_args(tokens, 'is_call')
+    if names is not None:
+        if names and all(len(n) == 1 and _is_literal(n[0]) for n in names):
+            return [frozenset(attribute_term('nameId', n[0][1:-1])
+                              for n in names)]
+        return []
+    if (len(tokens) == 4 and tokens[0] == '@' and tokens[2] == '=' and
+            tokens[1] in INDEXED_ATTRIBUTES and _is_literal(tokens[3])):
+        return [frozenset([attribute_term(tokens[1], tokens[3][1:-1])])]
+    steps = _steps(tokens)
+    if steps is None:
+        return []
+    return _path_requirements(steps)
+
+
+class QueryAnalysis(object):
+    """What the index can tell about a query.
+
+    required is a list of sets of index terms; a file can only match the
+    query if it contains at least one term from each set.
+
+    counted_tag is set if the number of matches of the query in a file is
+    just the number of elements with that tag in it, and result_tag if it's
+    at most that.
+
+    exists is set if the query only asks whether a file matches at all, by
+    being wrapped in boolean().
+    """
+    def __init__(self, required=(), counted_tag=None, result_tag=None,
+                 exists=False):
+        self.required = list(required)
+        self.counted_tag = counted_tag
+        self.result_tag = result_tag
+        self.exists = exists
+
+
+def analyze(query):
+    """Analyzes a compiled XPathQuery; see QueryAnalysis."""
+    exists = False
+    try:
+        tokens = tokenize(query.query)
+        for function in ('boolean', 'count'):
+            args = _call_args(tokens, function)
+            if args is not None:
+                if len(args) != 1:
+                    return QueryAnalysis(exists=exists)
+                tokens = args[0]
+                exists = exists or function == 'boolean'
+        steps = _steps(tokens)
+    except ValueError:
+        return QueryAnalysis(exists=exists)
+    if steps is None:
+        return QueryAnalysis(exists=exists)
+    required = _path_requirements(steps)
+    axis, test, predicates = steps[-1]
+    result_tag = None
+    if (axis not in _NON_ELEMENT_AXES and _is_name(test) and
+            not test.endswith('()') and ':' not in test):
+        # Matches are distinct elements, all with this tag.
+        result_tag = test
+    counted_tag = None
+    if (not exists and tokens[0] == '//' and len(steps) == 1 and
+            axis == 'child' and not predicates):
+        counted_tag = result_tag
+    return QueryAnalysis(required, counted_tag, result_tag, exists)
@@ -0,0 +1,371 @@
+"""Performance benchmarks for the query engine; see manage.py bench.
+
+The corpus is made up by copying the ASTs of some real benchmarks over and
+over, renaming some of the identifiers in each copy so that queries don't
+match the same way in all of them.
+"""
+import json
+import multiprocessing
+import os
+import random
+import re
+import shutil
+import subprocess
+import threading
+import time
+
+import peewee
+
+import mcbench.highlighters
+from mcbench.models import db, insert_many, Benchmark, Query
+from mcbench import app, querier, settings
+
+# Queries that are slow for one reason or another: matching every element,
+# calling back into Python for every element, walking up the tree from every
+# element, comparing every element against the whole document, and matching
+# nothing.
+PATHOLOGICAL_QUERIES = (
+    '//*',
+    '//*[loopvars()]',
+    '//*[count(ancestor::*) > 10]',
+    '//NameExpr[Name/@nameId = //Function/Name/@nameId]',
+    '//NoSuchTag',
+)
+
+_NAME_ID = re.compile(r'nameId="([^"]*)"')
+
+_NAMES = ('eval', 'feval', 'length', 'size', 'zeros', 'disp', 'i', 'j', 'x')
+
+
+def _mutate(xml, rng, rate):
+    def rename(match):
+        if rng.random() < rate:
+            return 'nameId="%s"' % rng.choice(_NAMES)
+        return match.group(0)
+    return _NAME_ID.sub(rename, xml)
+
+
+def make_corpus(source, destination, copies, seed=0, rate=0.1):
+    """Writes copies copies of each benchmark in the manifest.json in source
+    to destination, renaming rate of the identifiers in each copy, along
+    with a manifest.json for them."""
+    rng = random.Random(seed)
+    with open(os.path.join(source, 'manifest.json')) as f:
+        projects = json.load(f)['projects']
+    copied = []
+    for copy in range(copies):
+        for project in projects:
+            name = '%s-%d' % (project['name'], copy)
+            for directory, _, files in os.walk(
+                    os.path.join(source, project['name'])):
+                relative = os.path.relpath(
+                    directory, os.path.join(source, project['name']))
+                target = os.path.normpath(
+                    os.path.join(destination, name, relative))
+                if not os.path.isdir(target):
+                    os.makedirs(target)
+                for filename in files:
+                    path = os.path.join(directory, filename)
+                    if filename.endswith('.compact.xml'):
+                        continue
+                    if filename.endswith('.xml'):
+                        with open(path) as f:
+                            xml = _mutate(f.read(), rng, rate)
+                        with open(os.path.join(target, filename), 'w') as f:
+                            f.write(xml)
+                    else:
+                        shutil.copy(path, target)
+            copied.append(dict(project, name=name,
+                               title='%s (%d)' % (project['title'], copy)))
+    with open(os.path.join(destination, 'manifest.json'), 'w') as f:
+        json.dump({'projects': copied}, f)
+
+
+def make_skewed_corpus(source, destination, copies, giants, giant_copies,
+                       seed=0, rate=0.1):
+    """Like make_corpus, with giants more benchmarks, each made up of
+    giant_copies copies of every file of the benchmarks in source, so that
+    a few benchmarks dwarf the rest like the largest toolboxes do."""
+    make_corpus(source, destination, copies, seed, rate)
+    rng = random.Random(seed)
+    with open(os.path.join(source, 'manifest.json')) as f:
+        projects = json.load(f)['projects']
+    with open(os.path.join(destination, 'manifest.json')) as f:
+        manifest = json.load(f)
+    for giant in range(giants):
+        name = 'giant-%d' % giant
+        target = os.path.join(destination, name)
+        os.makedirs(target)
+        for copy in range(giant_copies):
+            for project in projects:
+                directory = os.path.join(source, project['name'])
+                for filename in os.listdir(directory):
+                    base, ext = os.path.splitext(filename)
+                    if filename.endswith('.compact.xml') or ext not in (
+                            '.m', '.xml'):
+                        continue
+                    with open(os.path.join(directory, filename)) as f:
+                        contents = f.read()
+                    if ext == '.xml':
+                        contents = _mutate(contents, rng, rate)
+                    with open(os.path.join(
+                            target, '%s_%d%s' % (base, copy, ext)), 'w') as f:
+                        f.write(contents)
+        manifest['projects'].append(dict(projects[0], name=name,
+                                         title='Giant (%d)' % giant))
+    with open(os.path.join(destination, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f)
+
+
+def _clear_caches():
+    querier.clear_caches()
+    mcbench.highlighters.clear_cache()
+
+
+def _forget(xpath):
+    query = Query.find_by_xpath(xpath)
+    if query is not None:
+        query.delete_instance(recursive=True)
+
+
+def _measure(run, repeat, items):
+    """Times run once with cold caches and repeat times with warm ones."""
+    _clear_caches()
+    start = time.time()
+    run()
+    cold = time.time() - start
+    warm = []
+    for _ in range(repeat):
+        start = time.time()
+        run()
+        warm.append(time.time() - start)
+    warm.sort()
+    median = warm[len(warm) // 2]
+    return {
+        'cold': cold,
+        'warm': {'min': warm[0], 'median': median, 'max': warm[-1]},
+        'per_second': items / median if median else None,
+    }
+
+
+def _measure_query(xpath, repeat, client):
+    benchmarks = list(Benchmark.all())
+    files = sum(len(b.files) for b in benchmarks)
+    largest = max(benchmarks,
+                  key=lambda b: sum(f.xml_size or 0 for f in b.files))
+
+    def list_view():
+        response = client.get('/list', query_string={'query': xpath})
+        assert response.status_code == 200, response.status_code
+
+    def benchmark_view():
+        response = client.get('/benchmark/%s' % largest.name,
+                              query_string={'query': xpath})
+        assert response.status_code == 200, response.status_code
+
+    def list_view_cold():
+        _forget(xpath)
+        list_view()
+
+    results = {
+        'compute_matches': _measure(
+            lambda: list(querier.compute_matches(xpath, benchmarks)),
+            repeat, files),
+        'matching_lines': _measure(
+            lambda: [querier.matching_lines(b, xpath) for b in benchmarks],
+            repeat, files),
+        'benchmark_view': _measure(benchmark_view, repeat, 1),
+    }
+    # The list view caches its results, so it's only cold when they're gone.
+    _forget(xpath)
+    results['list_view'] = _measure(list_view, repeat, 1)
+    results['list_view_uncached'] = _measure(list_view_cold, repeat, 1)
+    _forget(xpath)
+    return results
+
+
+def run(queries, repeat):
+    """Measures the cold and warm latency of each of queries, a list of
+    (kind, xpath) pairs, in compute_matches, matching_lines and the views.
+
+    per_second is benchmark files per second for compute_matches and
+    matching_lines, and requests per second for the views.
+    """
+    if repeat < 1:
+        raise ValueError('repeat must be at least 1')
+    client = app.test_client()
+    return [dict(_measure_query(xpath, repeat, client),
+                 kind=kind, xpath=xpath)
+            for kind, xpath in queries]
+
+
+def _percentile(sorted_values, fraction):
+    return sorted_values[min(int(len(sorted_values) * fraction),
+                             len(sorted_values) - 1)]
+
+
+def completion_times(xpaths, repeat, split_size):
+    """Measures how long searching for each of xpaths takes from scratch,
+    repeat times over, with settings.TASK_SPLIT_SIZE set to split_size.
+
+    Each query is run once beforehand, for the workers to cache the files
+    they're assigned under that setting.
+    """
+    old_split_size = settings.TASK_SPLIT_SIZE
+    settings.TASK_SPLIT_SIZE = split_size
+    try:
+        times = []
+        for i in range(repeat + 1):
+            for xpath in xpaths:
+                _forget(xpath)
+                start = time.time()
+                querier.get_matches(xpath)
+                if i:
+                    times.append(time.time() - start)
+                _forget(xpath)
+    finally:
+        settings.TASK_SPLIT_SIZE = old_split_size
+    times.sort()
+    return {
+        'split_size': split_size,
+        'p50': _percentile(times, 0.5),
+        'p99': _percentile(times, 0.99),
+        'max': times[-1],
+    }
+
+
+def drop_page_cache():
+    """Has the kernel forget the files it has cached in memory, so they're
+    read from disk again; returns whether it could (it takes root)."""
+    subprocess.call(['sync'])
+    try:
+        with open('/proc/sys/vm/drop_caches', 'w') as f:
+            f.write('3\n')
+    except IOError:
+        return False
+    return True
+
+
+def stored_xml_bytes(directory):
+    """Returns how much space the XML under directory takes up on disk."""
+    return sum(os.path.getsize(os.path.join(dirpath, filename))
+               for dirpath, _, files in os.walk(directory)
+               for filename in files
+               if filename.endswith(('.xml', '.xml.gz')))
+
+
+def cold_query_times(xpaths, repeat):
+    """Measures how long searching for each of xpaths takes from scratch,
+    repeat times over, with the workers' parsed trees and (if it can be
+    dropped) the page cache emptied before each search."""
+    times = []
+    page_cache_dropped = True
+    for _ in range(repeat):
+        for xpath in xpaths:
+            _forget(xpath)
+            querier.clear_caches()
+            page_cache_dropped &= drop_page_cache()
+            start = time.time()
+            querier.get_matches(xpath)
+            times.append(time.time() - start)
+            _forget(xpath)
+    times.sort()
+    return {
+        'xml_bytes': stored_xml_bytes(settings.DATA_ROOT),
+        'page_cache_dropped': page_cache_dropped,
+        'p50': _percentile(times, 0.5),
+        'p99': _percentile(times, 0.99),
+        'total': sum(times),
+    }
+
+
+def _read_cached(query_id, seconds, go, conn):
+    """Reads the cached results of a query for seconds seconds once go is
+    set, in a process of its own, and sends how long each read took."""
+    reads = []
+    try:
+        query = Query.get(Query.id == query_id)
+        go.wait()
+        end = time.time() + seconds
+        while time.time() < end:
+            start = time.time()
+            query.get_cached_matches()
+            reads.append(time.time() - start)
+    finally:
+        conn.send(reads)
+        db.close()
+
+
+def reader_latency(num_benchmarks, seconds, journal_mode, num_read=100):
+    """Measures how long reading the num_read cached results of a saved
+    query takes in another process, like the web server's, while a thread
+    of this one keeps caching num_benchmarks results of another query, for
+    seconds seconds, with the database in journal_mode.
+
+    Expects an empty database on disk with the tables created, and only
+    this thread's connection to it open.
+    """
+    pragmas = settings.SQLITE_PRAGMAS
+    settings.SQLITE_PRAGMAS = tuple(
+        (name, journal_mode if name == 'journal_mode' else value)
+        for name, value in pragmas)
+    try:
+        db.execute_sql('PRAGMA journal_mode = %s' % journal_mode)
+        insert_many(Benchmark(author='', author_url='',
+                              date_submitted='2014-01-01',
+                              date_updated='2014-01-01', name='b%d' % i,
+                              summary='', tags='', title='', url='')
+                    for i in range(num_benchmarks))
+        benchmarks = list(Benchmark.all())
+        read = Query.create(xpath='//ForStmt', name='Loops')
+        read.cache_matches((b, 1) for b in benchmarks[:num_read])
+        written = Query.create(xpath='//WhileStmt', name='')
+        # The reader shouldn't inherit an open connection.
+        db.close()
+        go = multiprocessing.Event()
+        results, child = multiprocessing.Pipe()
+        reader = multiprocessing.Process(
+            target=_read_cached, args=(read.id, seconds, go, child))
+        reader.start()
+        connected = threading.Event()
+        stop = threading.Event()
+        writes = []
+        locked = []
+
+        def write():
+            db.get_conn()
+            connected.set()
+            while not stop.is_set():
+                start = time.time()
+                try:
+                    written.cache_matches(
+                        (b, random.randrange(3)) for b in benchmarks)
+                except peewee.OperationalError:
+                    locked.append(time.time() - start)
+                else:
+                    writes.append(time.time() - start)
+
+        writer = threading.Thread(target=write)
+        writer.start()
+        connected.wait()
+        go.set()
+        try:
+            reads = results.recv()
+        finally:
+            stop.set()
+            writer.join()
+            reader.join()
+    finally:
+        settings.SQLITE_PRAGMAS = pragmas
+    reads.sort()
+    return {
+        'journal_mode': journal_mode,
+        'writes': len(writes),
+        'write_time': sum(writes) / len(writes) if writes else None,
+        # Writes that gave up waiting for the readers to let go.
+        'locked_writes': len(locked),
+        'reads': len(reads),
+        'read_latency': {'p50': _percentile(reads, 0.5),
+                         'p99': _percentile(reads, 0.99),
+                         'max': reads[-1]},
+    }
@@ -0,0 +1,70 @@
+import collections
+import threading
+
+
+class LRUCache(object):
+    """A bounded mapping that evicts its least recently used entries.
+
+    Every entry has a size (1 unless told otherwise); once the sizes add up
+    to more than max_size, entries are evicted oldest first until the cache
+    fits again. An entry larger than max_size is simply not kept.
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.total_size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        # Set by a clear that couldn't wait for the lock; see clear.
+        self._clear_pending = False
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, default=None):
+        with self._lock:
+            self._clear_if_pending()
+            try:
+                value, size = self._entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self._entries[key] = (value, size)
+            self.hits += 1
+            return value
+
+    def put(self, key, value, size=1):
+        with self._lock:
+            self._clear_if_pending()
+            if key in self._entries:
+                self.total_size -= self._entries.pop(key)[1]
+            if size > self.max_size:
+                return
+            self._entries[key] = (value, size)
+            self.total_size += size
+            while self.total_size > self.max_size:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.total_size -= evicted_size
+
+    def _clear_if_pending(self):
+        if self._clear_pending:
+            self._clear_pending = False
+            self._entries.clear()
+            self.total_size = 0
+
+    def clear(self, blocking=True):
+        """Empties the cache. Without blocking, if the cache is in use (as
+        when called from a signal handler that interrupted a get or put), it
+        is emptied by the next get or put instead."""
+        if not self._lock.acquire(blocking):
+            self._clear_pending = True
+            return
+        try:
+            self._clear_pending = True
+            self._clear_if_pending()
+        finally:
+            self._lock.release()
@@ -1,9 +1,22 @@
+import os
+
 import pygments.formatters
 import pygments.lexers
 
+from mcbench.cache import LRUCache
+from mcbench import settings
+
 MATLAB_LEXER = pygments.lexers.MatlabLexer()
 XML_LEXER = pygments.lexers.XmlLexer()
 
+# Highlighted files, keyed by path, modification time, lexer and highlighted
+# lines, and weighed by the length of their HTML.
+_highlighted = LRUCache(settings.HIGHLIGHT_CACHE_SIZE)
+
+
+def clear_cache():
+    _highlighted.clear()
+
 
 def highlight(code, lexer, lines=None):
     if lines is None:
@@ -12,9 +25,28 @@ def highlight(code, lexer, lines=None):
     return pygments.highlight(code, lexer, formatter)
 
 
+def highlight_file(path, read, lexer, lines=None):
+    lines = tuple(sorted(set(lines or ())))
+    key = (path, os.path.getmtime(path), lexer.name, lines)
+    html = _highlighted.get(key)
+    if html is None:
+        html = highlight(read(), lexer, lines)
+        _highlighted.put(key, html, size=len(html))
+    return html
+
+
 def matlab(code, lines=None):
     return highlight(code, MATLAB_LEXER, lines)
 
 
 def xml(code, lines=None):
     return highlight(code, XML_LEXER, lines)
+
+
+def matlab_file(file, lines=None):
+    return highlight_file(file.matlab_path, file.read_matlab, MATLAB_LEXER,
+                          lines)
+
+
+def xml_file(file, lines=None):
+    return highlight_file(file.xml_path, file.read_xml, XML_LEXER, lines)
@@ -0,0 +1,84 @@
+"""Reading benchmark manifests.
+
+A manifest is a JSON object whose "projects" member is a list of objects
+describing the benchmarks. Manifests of the whole File Exchange run to
+tens of thousands of projects, so they're read a chunk at a time and the
+projects yielded as they're read, rather than loaded all at once.
+"""
+import json
+
+_decoder = json.JSONDecoder()
+
+
+class _Reader(object):
+    def __init__(self, f, chunk_size):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self):
+        chunk = self.f.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+
+    def peek(self):
+        """Returns the next character that isn't whitespace, or '' at the
+        end of the file."""
+        while True:
+            while (self.pos < len(self.buffer) and
+                   self.buffer[self.pos].isspace()):
+                self.pos += 1
+            if self.pos < len(self.buffer) or self.eof:
+                return self.buffer[self.pos:self.pos + 1]
+            self._fill()
+
+    def expect(self, chars):
+        char = self.peek()
+        if not char or char not in chars:
+            raise ValueError('expected one of %r in manifest, found %r' %
+                             (chars, char))
+        self.pos += 1
+        return char
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.buffer, self.pos)
+                # A number at the end of the buffer may go on in the next
+                # chunk.
+                if end < len(self.buffer) or self.eof:
+                    self.pos = end
+                    return value
+            except ValueError:
+                if self.eof:
+                    raise
+            self._fill()
+
+
+def iter_projects(f, chunk_size=64 * 1024):
+    """Yields the projects in the manifest read from f, one at a time."""
+    reader = _Reader(f, chunk_size)
+    reader.expect('{')
+    if reader.peek() == '}':
+        return
+    while True:
+        key = reader.value()
+        reader.expect(':')
+        if key == 'projects':
+            reader.expect('[')
+            if reader.peek() == ']':
+                reader.pos += 1
+            else:
+                while True:
+                    yield reader.value()
+                    if reader.expect(',]') == ']':
+                        break
+        else:
+            reader.value()
+        if reader.expect(',}') == '}':
+            return
@@ -1,11 +1,48 @@
 import peewee
 
-db = peewee.SqliteDatabase(None, threadlocals=True)
+from mcbench import settings
+
+
+class SqliteDatabase(peewee.SqliteDatabase):
+    """A SQLite database whose connections are set up with
+    settings.SQLITE_PRAGMAS."""
+    def _connect(self, database, **kwargs):
+        conn = super(SqliteDatabase, self)._connect(database, **kwargs)
+        for name, value in settings.SQLITE_PRAGMAS:
+            conn.execute('PRAGMA %s = %s' % (name, value))
+        return conn
+
+
+db = SqliteDatabase(None, threadlocals=True)
+
+# SQLite allows no more than this many parameters in a statement.
+MAX_PARAMETERS = 999
 
 
 class Model(peewee.Model):
     class Meta:
         database = db
 
+
+def insert_many(instances):
+    """Inserts unsaved model instances, all of the same model, executing a
+    single statement for all of them rather than one each. Fields left unset
+    are inserted as None."""
+    instances = list(instances)
+    if not instances:
+        return
+    model = type(instances[0])
+    names = [field.name for field in model._meta.get_fields()
+             if field is not model._meta.primary_key]
+    queries = [model.insert(**dict((name, instance._data.get(name))
+                                   for name in names))
+               for instance in instances]
+    sql, _ = queries[0].sql()
+    db.get_cursor().executemany(sql, [query.sql()[1] for query in queries])
+    if db.get_autocommit():
+        db.commit()
+
 from .benchmark import Benchmark, File
 from .query import Query, QueryMatch
+from .index import IndexTerm
+from .stats import QueryStats
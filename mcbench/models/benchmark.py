@@ -1,10 +1,14 @@
+import collections
 import os
+import shutil
+import time
 
 import chardet
 import peewee
 
+import mcbench.xpath
 from mcbench import settings
-from mcbench.models import Model
+from mcbench.models import db, insert_many, Model
 
 
 class Benchmark(Model):
@@ -17,6 +21,11 @@ class Benchmark(Model):
     tags = peewee.CharField()
     title = peewee.CharField()
     url = peewee.CharField()
+    # When the files of this benchmark were last looked for.
+    scanned = peewee.FloatField(null=True)
+    # Bumped whenever the files change, so cached query results for older
+    # versions can be told apart.
+    version = peewee.IntegerField(null=True, default=0)
 
     @staticmethod
     def all():
@@ -30,33 +39,204 @@ class Benchmark(Model):
     def find_by_name(name):
         return Benchmark.select().where(Benchmark.name == name).first()
 
+    @property
+    def root(self):
+        return os.path.join(settings.DATA_ROOT, self.name)
+
     @property
     def files(self):
-        root = os.path.join(settings.DATA_ROOT, self.name)
-        for dirpath, _, files in os.walk(root):
+        return list(self.file_set.order_by(File.path))
+
+    def _new_file(self, path):
+        file = File(benchmark=self, path=path)
+        file.stat()
+        return file
+
+    def _add_file(self, path):
+        self._new_file(path).save()
+
+    def _add_files(self, directory):
+        new_files = []
+        for dirpath, _, files in os.walk(directory):
             for file in files:
                 base, ext = os.path.splitext(file)
                 if ext == '.m':
-                    yield File(dirpath, base)
+                    new_files.append(self._new_file(os.path.relpath(
+                        os.path.join(dirpath, base), settings.DATA_ROOT)))
+        insert_many(new_files)
+
+    @db.commit_on_success
+    def scan_files(self):
+        """Records the files of this benchmark by walking its directory."""
+        self.scanned = time.time()
+        self.version += 1
+        File.delete().where(File.benchmark == self).execute()
+        self._add_files(self.root)
+        self.save()
+
+    @db.commit_on_success
+    def refresh_files(self):
+        """Brings the recorded files of this benchmark up to date, and
+        returns whether any of them changed.
+
+        Rather than walking the whole directory again, this stats the files
+        already known, and only lists the directories leading to them that
+        were modified since the last scan. Files in a new subdirectory of one
+        of those are found too, but not files appearing in an existing
+        directory that had no Matlab files before; scan_files finds
+        everything.
+        """
+        if self.scanned is None:
+            self.scan_files()
+            return True
+        scanned = time.time()
+        changed = False
+        known = self.files
+        for file in known:
+            if not os.path.exists(file.matlab_path):
+                file.delete_instance()
+                changed = True
+            elif file.stat():
+                file.save()
+                changed = True
+
+        known_paths = set(file.path for file in known)
+        directories = set([self.name])
+        for path in known_paths:
+            directory = os.path.dirname(path)
+            while directory not in directories:
+                directories.add(directory)
+                directory = os.path.dirname(directory)
+        for directory in directories:
+            root = os.path.join(settings.DATA_ROOT, directory)
+            if (not os.path.isdir(root) or
+                    os.path.getmtime(root) < self.scanned):
+                continue
+            for entry in os.listdir(root):
+                path = os.path.join(directory, entry)
+                base, ext = os.path.splitext(path)
+                if os.path.isdir(os.path.join(root, entry)):
+                    if path not in directories:
+                        changed = True
+                        self._add_files(os.path.join(root, entry))
+                elif ext == '.m' and base not in known_paths:
+                    changed = True
+                    self._add_file(base)
 
+        self.scanned = scanned
+        if changed:
+            self.version += 1
+        self.save()
+        return changed
 
-def fix_utf8(s):
-    encoding = chardet.detect(s)['encoding']
+
+def detect_encoding(s):
+    """Returns the encoding s decodes with, going by chardet."""
+    # chardet gives up on empty files.
+    encoding = chardet.detect(s)['encoding'] or 'ascii'
     try:
-        return unicode(s.decode(encoding))
+        s.decode(encoding)
     except UnicodeDecodeError:
         # chardet seems to get the 2224-cost231-models files wrong;
         # it says windows-1255 but they're actually latin1 (according to vim).
         # This is an ugly workaround for this case.
         if encoding != 'windows-1255':
             raise
-        return unicode(s.decode('latin1'))
+        return 'latin1'
+    return encoding
+
+
+def fix_utf8(s, encoding=None):
+    """Decodes s with encoding, or the one detected if it's not given or
+    turns out to be wrong."""
+    if encoding is not None:
+        try:
+            return unicode(s.decode(encoding))
+        except (UnicodeDecodeError, LookupError):
+            pass
+    return unicode(s.decode(detect_encoding(s)))
+
+
+def _stored_path(path):
+    """Returns the path XML meant to be at path is stored at: path itself,
+    or the gzipped copy if that's all there is."""
+    compressed = path + mcbench.xpath.GZIP_SUFFIX
+    if not os.path.exists(path) and os.path.exists(compressed):
+        return compressed
+    return path
 
 
-class File(object):
-    def __init__(self, root, name):
-        self.root = root
-        self.name = name
+class File(Model):
+    benchmark = peewee.ForeignKeyField(Benchmark, on_delete='CASCADE')
+    # Relative to DATA_ROOT, without extension.
+    path = peewee.CharField()
+    size = peewee.IntegerField(default=0)
+    mtime = peewee.FloatField(default=0)
+    xml_size = peewee.IntegerField(null=True)
+    xml_mtime = peewee.FloatField(null=True)
+    node_count = peewee.IntegerField(null=True)
+    # Why the XML couldn't be parsed, if it couldn't; queries skip such
+    # files.
+    parse_error = peewee.TextField(null=True)
+    # The encoding of the Matlab source, detected once when the file is
+    # added (see querier.detect_encodings) so reading it is a plain decode.
+    encoding = peewee.CharField(null=True)
+
+    class Meta:
+        indexes = (
+            (('benchmark', 'path'), True),
+        )
+
+    @staticmethod
+    def from_path(path):
+        return File(path=path)
+
+    @staticmethod
+    def paths_by_benchmark(unparsable=False):
+        """Returns the paths of all the files that can be parsed (or of all
+        of them, with unparsable), by benchmark id."""
+        paths = collections.defaultdict(list)
+        for benchmark_id, files in File.sizes_by_benchmark(
+                unparsable).iteritems():
+            paths[benchmark_id] = [path for path, _ in files]
+        return paths
+
+    @staticmethod
+    def sizes_by_benchmark(unparsable=False):
+        """Like paths_by_benchmark, but returns (path, size of the XML)
+        pairs."""
+        files = collections.defaultdict(list)
+        query = File.select(File.benchmark, File.path, File.xml_size)
+        if not unparsable:
+            query = query.where(File.parse_error >> None)
+        for benchmark_id, path, xml_size in query.tuples():
+            files[benchmark_id].append((path, xml_size or 0))
+        return files
+
+    @property
+    def root(self):
+        return os.path.join(settings.DATA_ROOT, os.path.dirname(self.path))
+
+    @property
+    def name(self):
+        return os.path.basename(self.path)
+
+    def stat(self):
+        """Records the sizes and modification times of this file's Matlab
+        source and XML, and returns whether they changed."""
+        old = (self.size, self.mtime, self.xml_size, self.xml_mtime)
+        stat = os.stat(self.matlab_path)
+        if (self.size, self.mtime) != (stat.st_size, stat.st_mtime):
+            # It's detected again from the new source.
+            self.encoding = None
+        self.size, self.mtime = stat.st_size, stat.st_mtime
+        try:
+            stat = os.stat(self.xml_path)
+            self.xml_size = mcbench.xpath.xml_size(self.xml_path)
+            self.xml_mtime = stat.st_mtime
+        except OSError:
+            self.xml_size = self.xml_mtime = None
+        return old != (self.size, self.mtime, self.xml_size, self.xml_mtime)
 
     @property
     def matlab_path(self):
@@ -64,12 +244,79 @@ class File(object):
 
     @property
     def xml_path(self):
-        return os.path.join(self.root, '%s.xml' % self.name)
+        return _stored_path(os.path.join(self.root, '%s.xml' % self.name))
+
+    @property
+    def compact_xml_path(self):
+        return _stored_path(os.path.join(self.root,
+                                         '%s.compact.xml' % self.name))
+
+    @property
+    def ast_path(self):
+        """The path to parse this file's AST from.
+
+        This is the compact, annotated copy of the XML (see
+        mcbench.xpath.compact_xml and annotate_xml) if it is up to date, and
+        the XML itself otherwise.
+        """
+        try:
+            compact_mtime = os.path.getmtime(self.compact_xml_path)
+        except OSError:
+            return self.xml_path
+        if compact_mtime < os.path.getmtime(self.xml_path):
+            return self.xml_path
+        return self.compact_xml_path
+
+    def write_compact_xml(self):
+        """Writes the compact XML, and returns the number of elements in
+        it. Raises lxml.etree.XMLSyntaxError if the XML doesn't parse."""
+        xml = mcbench.xpath.compact_xml(self.read_xml())
+        tree = mcbench.xpath.parse_xml(xml)
+        # Stored the same way as the XML.
+        compressed = self.xml_path.endswith(mcbench.xpath.GZIP_SUFFIX)
+        path = os.path.join(self.root, '%s.compact.xml' % self.name)
+        if compressed:
+            path += mcbench.xpath.GZIP_SUFFIX
+        tmp_path = path + '.tmp'
+        with mcbench.xpath.open_xml(tmp_path, 'wb', compressed) as f:
+            f.write(mcbench.xpath.annotate_xml(xml, tree))
+        os.rename(tmp_path, path)
+        return sum(1 for element in tree.iter()
+                   if isinstance(element.tag, basestring))
+
+    def detect_encoding(self):
+        with open(self.matlab_path) as f:
+            return detect_encoding(f.read())
 
     def read_matlab(self):
         with open(self.matlab_path) as f:
-            return fix_utf8(f.read())
+            return fix_utf8(f.read(), self.encoding)
 
     def read_xml(self):
-        with open(self.xml_path) as f:
+        with mcbench.xpath.open_xml(self.xml_path) as f:
             return f.read()
+
+    def store_xml(self, compressed):
+        """Stores the XML and its compact copy gzipped (see
+        mcbench.xpath.open_xml), or uncompressed, keeping their modification
+        times. Returns whether either had to be converted."""
+        converted = False
+        for path in (self.xml_path, self.compact_xml_path):
+            is_compressed = path.endswith(mcbench.xpath.GZIP_SUFFIX)
+            if is_compressed == compressed or not os.path.exists(path):
+                continue
+            if compressed:
+                target = path + mcbench.xpath.GZIP_SUFFIX
+            else:
+                target = path[:-len(mcbench.xpath.GZIP_SUFFIX)]
+            tmp_path = target + '.tmp'
+            with mcbench.xpath.open_xml(path) as source:
+                with mcbench.xpath.open_xml(tmp_path, 'wb',
+                                            compressed) as f:
+                    shutil.copyfileobj(source, f)
+            stat = os.stat(path)
+            os.utime(tmp_path, (stat.st_atime, stat.st_mtime))
+            os.rename(tmp_path, target)
+            os.remove(path)
+            converted = True
+        return converted
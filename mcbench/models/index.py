@@ -0,0 +1,57 @@
+import peewee
+
+from . import db, insert_many, Model, Benchmark
+
+
+class IndexTerm(Model):
+    """How many times a tag or attribute value occurs in an AST file.
+
+    See mcbench.analysis for the terms that are indexed.
+    """
+    benchmark = peewee.ForeignKeyField(Benchmark, on_delete='CASCADE')
+    path = peewee.CharField()
+    term = peewee.CharField(index=True)
+    count = peewee.IntegerField()
+
+    @staticmethod
+    @db.commit_on_success
+    def index(benchmark, terms):
+        """Replaces the index for benchmark by terms, a dict from file paths
+        to term counts."""
+        IndexTerm.delete().where(IndexTerm.benchmark == benchmark).execute()
+        insert_many(IndexTerm(benchmark=benchmark, path=path, term=term,
+                              count=count)
+                    for path, counts in terms.iteritems()
+                    for term, count in counts.iteritems())
+
+    @staticmethod
+    def indexed_benchmarks():
+        """Returns the ids of benchmarks that have been indexed."""
+        query = IndexTerm.select(IndexTerm.benchmark).distinct().tuples()
+        return set(benchmark_id for benchmark_id, in query)
+
+    @staticmethod
+    def candidates(required):
+        """Returns the indexed files that contain at least one term from each
+        of the sets in required, as a dict from benchmark ids to paths."""
+        files = None
+        for terms in required:
+            query = (IndexTerm.select(IndexTerm.benchmark, IndexTerm.path)
+                     .where(IndexTerm.term << list(terms))
+                     .tuples())
+            matching = set(query)
+            files = matching if files is None else files & matching
+        candidates = {}
+        for benchmark_id, path in files or ():
+            candidates.setdefault(benchmark_id, []).append(path)
+        return candidates
+
+    @staticmethod
+    def counts(term):
+        """Returns how many times term occurs in each indexed benchmark."""
+        query = (IndexTerm.select(IndexTerm.benchmark,
+                                  peewee.fn.SUM(IndexTerm.count))
+                 .where(IndexTerm.term == term)
+                 .group_by(IndexTerm.benchmark)
+                 .tuples())
+        return dict(query)
@@ -1,11 +1,26 @@
+import json
+import time
+import zlib
+
 import peewee
 
-from . import db, Model, Benchmark
+from mcbench.normalization import normalize
+from . import db, insert_many, Model, Benchmark, MAX_PARAMETERS
 
 
 class Query(Model):
     name = peewee.CharField()
+    # The xpath as it was first entered, and its normalized form, which
+    # equivalent xpaths share and queries are looked up by.
     xpath = peewee.CharField(unique=True)
+    normalized = peewee.CharField(null=True, index=True)
+    # Why the last evaluation of the query was cut short, if it was; its
+    # results are then only those of the benchmarks it got through.
+    incomplete = peewee.CharField(null=True)
+    # When the query was last searched for, and how many times it was; see
+    # evict.
+    accessed = peewee.FloatField(null=True)
+    hits = peewee.IntegerField(null=True, default=0)
 
     @staticmethod
     def all():
@@ -21,32 +36,258 @@ class Query(Model):
 
     @staticmethod
     def find_by_xpath(xpath):
-        return Query.select().where(Query.xpath == xpath).first()
+        """Returns the query for xpath or any equivalent one."""
+        return (Query.select()
+                .where((Query.normalized == normalize(xpath)) |
+                       (Query.xpath == xpath))
+                .order_by(Query.id)
+                .first())
+
+    @staticmethod
+    def find_or_create(xpath):
+        """Returns the query for xpath, creating an unsaved one if there is
+        none, even if another process is creating it at the same time."""
+        query = Query.find_by_xpath(xpath)
+        if query is not None:
+            return query
+        try:
+            return Query.create(xpath=xpath, name='')
+        except peewee.IntegrityError:
+            return Query.find_by_xpath(xpath)
+
+    def save(self, *args, **kwargs):
+        self.normalized = normalize(self.xpath)
+        return super(Query, self).save(*args, **kwargs)
 
     @property
     def is_saved(self):
         return self.name != ''
 
+    def touch(self):
+        """Records that the query was searched for."""
+        self.accessed = time.time()
+        self.hits += 1
+        (Query.update(accessed=self.accessed, hits=Query.hits + 1)
+         .where(Query.id == self.id)
+         .execute())
+
+    def mark_incomplete(self, reason):
+        self.incomplete = reason
+        (Query.update(incomplete=reason)
+         .where(Query.id == self.id)
+         .execute())
+
+    @staticmethod
+    @db.commit_on_success
+    def evict(max_bytes, hit_weight, keep=()):
+        """Deletes unsaved queries, along with their cached results, until
+        the cached results of the unsaved queries take up at most max_bytes
+        in all (see QueryMatch.size), and returns how many were deleted.
+
+        The queries accessed longest ago go first, with each hit counting
+        as accessing the query hit_weight seconds later. Saved queries, and
+        those whose ids are in keep, are never deleted.
+        """
+        excess = (QueryMatch.select(QueryMatch.size()).join(Query)
+                  .where(Query.name == '').scalar() - max_bytes)
+        if excess <= 0:
+            return 0
+        candidates = (Query.select(Query, QueryMatch.size().alias('size'))
+                      .join(QueryMatch, peewee.JOIN_LEFT_OUTER)
+                      .where(Query.name == '')
+                      .group_by(Query)
+                      .order_by(peewee.fn.COALESCE(Query.accessed, 0) +
+                                Query.hits * hit_weight))
+        evicted = 0
+        for query in candidates:
+            if excess <= 0:
+                break
+            if query.id in keep:
+                continue
+            excess -= query.size
+            query.delete_instance(recursive=True)
+            evicted += 1
+        return evicted
+
     def unsave(self):
         self.name = ''
         self.save()
 
+    def merge(self, duplicate):
+        """Takes over the name and evaluation history of duplicate, an
+        equivalent query, and deletes it."""
+        from .stats import QueryStats
+        if not self.is_saved and duplicate.is_saved:
+            self.name = duplicate.name
+        self.hits = (self.hits or 0) + (duplicate.hits or 0)
+        self.accessed = max(self.accessed, duplicate.accessed)
+        self.save()
+        (QueryStats.update(query=self)
+         .where(QueryStats.query == duplicate)
+         .execute())
+        duplicate.delete_instance(recursive=True)
+
+    @staticmethod
+    @db.commit_on_success
+    def merge_duplicates():
+        """Normalizes every query, merging those that turn out to be
+        equivalent into the oldest of them; returns how many were merged."""
+        merged = 0
+        by_key = {}
+        for query in Query.select().order_by(Query.id):
+            key = normalize(query.xpath)
+            if key in by_key:
+                by_key[key].merge(query)
+                merged += 1
+            else:
+                if query.normalized != key:
+                    query.save()
+                by_key[key] = query
+        return merged
+
+    def pending_benchmarks(self):
+        """Returns the benchmarks this query has no up to date cached
+        results for."""
+        evaluated = (QueryMatch.select(QueryMatch.benchmark)
+                     .join(Benchmark)
+                     .where((QueryMatch.query == self) &
+                            (QueryMatch.version == Benchmark.version)))
+        return list(Benchmark.select().where(~(Benchmark.id << evaluated)))
+
     def expire_matches(self):
         QueryMatch.delete().where(QueryMatch.query == self).execute()
 
     @db.commit_on_success
-    def cache_matches(self, matches):
-        for benchmark, num_matches in matches:
-            QueryMatch.create(query=self,
-                              benchmark=benchmark,
-                              num_matches=num_matches)
+    def cache_matches(self, matches, seconds=None, locations=None):
+        """Caches the number of matches in each benchmark, replacing any
+        results cached for it before. matches is a sequence of (benchmark,
+        num_matches) pairs; seconds and locations optionally map benchmark
+        ids to how long evaluating the query against them took and to where
+        the matches are in their files (see match_locations).
+        """
+        seconds = seconds or {}
+        locations = locations or {}
+        matches = list(matches)
+        ids = [benchmark.id for benchmark, _ in matches]
+        # The query id takes up a parameter too.
+        chunk_size = MAX_PARAMETERS - 1
+        for i in range(0, len(ids), chunk_size):
+            (QueryMatch.delete()
+             .where((QueryMatch.query == self) &
+                    (QueryMatch.benchmark << ids[i:i + chunk_size]))
+             .execute())
+        insert_many(QueryMatch(query=self,
+                               benchmark=benchmark,
+                               num_matches=num_matches,
+                               version=benchmark.version,
+                               seconds=seconds.get(benchmark.id),
+                               locations=QueryMatch.pack_locations(
+                                   locations.get(benchmark.id)))
+                    for benchmark, num_matches in matches)
 
     def get_cached_matches(self):
-        return list(self.querymatch_set.order_by(
-            QueryMatch.num_matches.desc()))
+        # Leaving out the locations, which only the benchmark page needs.
+        fields = [field for field in QueryMatch._meta.get_fields()
+                  if field is not QueryMatch.locations]
+        return list(QueryMatch.select(*fields + [Benchmark])
+                    .join(Benchmark)
+                    .where((QueryMatch.query == self) &
+                           (QueryMatch.num_matches > 0))
+                    .order_by(QueryMatch.num_matches.desc()))
+
+    def nth_most_matches(self, n):
+        """Returns the number of matches of the benchmark with the nth most,
+        going by the up to date cached results, or 0 if fewer than n
+        benchmarks have any."""
+        match = (QueryMatch.select(QueryMatch.num_matches)
+                 .join(Benchmark)
+                 .where((QueryMatch.query == self) &
+                        (QueryMatch.version == Benchmark.version) &
+                        (QueryMatch.num_matches > 0))
+                 .order_by(QueryMatch.num_matches.desc())
+                 .limit(1)
+                 .offset(n - 1)
+                 .first())
+        return 0 if match is None else match.num_matches
+
+    def match_locations(self, benchmark):
+        """Returns the Matlab and XML lines of the matches in each file of
+        benchmark, as {path: {'m': lines, 'xml': lines}}, from when the
+        query was last evaluated against it; None if they weren't recorded
+        then, or the benchmark has changed since."""
+        match = (QueryMatch.select()
+                 .where((QueryMatch.query == self) &
+                        (QueryMatch.benchmark == benchmark) &
+                        (QueryMatch.version == benchmark.version))
+                 .first())
+        if match is None:
+            return None
+        if not match.num_matches:
+            return {}
+        return match.unpack_locations()
 
+    def slowest_matches(self, limit):
+        """Returns the cached results whose evaluation took longest."""
+        return list(self.querymatch_set
+                    .where(QueryMatch.seconds > 0)
+                    .order_by(QueryMatch.seconds.desc())
+                    .limit(limit))
 
+
+# Benchmarks a query was evaluated against get a QueryMatch even when they
+# have no matches, so that an interrupted evaluation can pick up where it left
+# off; see Query.pending_benchmarks.
 class QueryMatch(Model):
     benchmark = peewee.ForeignKeyField(Benchmark, on_delete='CASCADE')
     query = peewee.ForeignKeyField(Query, on_delete='CASCADE')
     num_matches = peewee.IntegerField()
+    # The Benchmark.version these results are for.
+    version = peewee.IntegerField(null=True, default=0)
+    # How long evaluating the query against the benchmark took, if it wasn't
+    # answered from the index.
+    seconds = peewee.FloatField(null=True)
+    # Where the matches are, if that was recorded; see
+    # Query.match_locations.
+    locations = peewee.BlobField(null=True)
+
+    # Roughly how many bytes a row takes up with its index entries, besides
+    # its locations.
+    ROW_BYTES = 50
+
+    @staticmethod
+    def size():
+        """The expression for how many bytes the rows selected take up, their
+        locations included."""
+        return (peewee.fn.COUNT(QueryMatch.id) * QueryMatch.ROW_BYTES +
+                peewee.fn.COALESCE(
+                    peewee.fn.SUM(peewee.fn.LENGTH(QueryMatch.locations)), 0))
+
+    class Meta:
+        indexes = (
+            # For get_cached_matches, which filters and sorts on both.
+            (('query', 'num_matches'), False),
+            # Covers pending_benchmarks.
+            (('query', 'benchmark', 'version'), False),
+        )
+
+    @staticmethod
+    def pack_locations(locations):
+        if locations is None:
+            return None
+        return zlib.compress(json.dumps(dict(
+            (path, [lines['m'], lines['xml']])
+            for path, lines in locations.iteritems())))
+
+    def unpack_locations(self):
+        if self.locations is None:
+            return None
+        return dict((path, {'m': m_lines, 'xml': xml_lines})
+                    for path, (m_lines, xml_lines)
+                    in json.loads(zlib.decompress(self.locations)).iteritems())
+
+    @staticmethod
+    def delete_orphans():
+        """Deletes the results cached for benchmarks that no longer exist."""
+        (QueryMatch.delete()
+         .where(~(QueryMatch.benchmark << Benchmark.select(Benchmark.id)))
+         .execute())
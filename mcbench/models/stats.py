@@ -0,0 +1,65 @@
+import datetime
+
+import peewee
+
+from . import Model, Query
+
+
+class QueryStats(Model):
+    """Where the time went when a query was evaluated.
+
+    The parse and evaluate times are summed over the worker processes, so
+    they can add up to more than the elapsed time.
+    """
+    query = peewee.ForeignKeyField(Query, on_delete='CASCADE')
+    created = peewee.DateTimeField(default=datetime.datetime.now)
+    # The benchmarks and files that had to be evaluated, i.e. those the
+    # index couldn't answer for.
+    benchmarks = peewee.IntegerField()
+    files = peewee.IntegerField()
+    elapsed = peewee.FloatField()
+    plan_time = peewee.FloatField()
+    parse_time = peewee.FloatField()
+    evaluate_time = peewee.FloatField()
+    write_time = peewee.FloatField()
+    extension_calls = peewee.IntegerField()
+    # Why the evaluation was cut short, if it was; see Query.incomplete.
+    incomplete = peewee.CharField(null=True)
+
+    @staticmethod
+    def record(query, stats, elapsed, incomplete=None):
+        """Records a collections.Counter of the costs of evaluating query."""
+        return QueryStats.create(query=query,
+                                 benchmarks=stats['benchmarks'],
+                                 files=stats['files'],
+                                 elapsed=elapsed,
+                                 plan_time=stats['plan'],
+                                 parse_time=stats['parse'],
+                                 evaluate_time=stats['evaluate'],
+                                 write_time=stats['write'],
+                                 extension_calls=stats['extension_calls'],
+                                 incomplete=incomplete)
+
+    @staticmethod
+    def latest(query):
+        return (QueryStats.select()
+                .where(QueryStats.query == query)
+                .order_by(QueryStats.id.desc())
+                .first())
+
+    @staticmethod
+    def slowest(limit):
+        """Returns the slowest evaluation of each of the limit queries whose
+        slowest evaluations took longest."""
+        slowest = []
+        seen = set()
+        query = (QueryStats.select(QueryStats, Query)
+                 .join(Query)
+                 .order_by(QueryStats.elapsed.desc()))
+        for stats in query:
+            if stats.query.id not in seen:
+                seen.add(stats.query.id)
+                slowest.append(stats)
+                if len(slowest) == limit:
+                    break
+        return slowest
@@ -0,0 +1,115 @@
+"""Puts XPath queries in a canonical form, so that queries that only differ
+in how they're written share their cached results; see Query.normalized.
+
+The normalized query has the same results as the original: whitespace
+between tokens is made uniform, string literals are quoted with single
+quotes where they can be, and the operands of 'and' and 'or', which are
+commutative in XPath, are sorted. Operands are only sorted if none of them
+calls an extension function, as those raise outside their context and an
+earlier operand may be what keeps them out of it.
+"""
+from mcbench.analysis import _closing, _is_literal, _is_name, _split
+import mcbench.analysis
+
+_OPERATOR_NAMES = ('and', 'or', 'div', 'mod')
+
+# The functions of XPath 1.0, and node tests that look like calls; any other
+# call is to an extension function.
+_XPATH_FUNCTIONS = frozenset([
+    'last', 'position', 'count', 'id', 'local-name', 'namespace-uri', 'name',
+    'string', 'concat', 'starts-with', 'contains', 'substring-before',
+    'substring-after', 'substring', 'string-length', 'normalize-space',
+    'translate', 'boolean', 'not', 'true', 'false', 'lang', 'number', 'sum',
+    'floor', 'ceiling', 'round', 'node', 'text', 'comment',
+    'processing-instruction',
+])
+
+
+def _literal(token):
+    value = token[1:-1]
+    if "'" in value:
+        return '"%s"' % value
+    return "'%s'" % value
+
+
+def _join(parts, separator):
+    return [token for part in parts for token in [separator] + part][1:]
+
+
+def _calls_extension(tokens):
+    return any(token not in _XPATH_FUNCTIONS and _is_name(token) and
+               tokens[i + 1] == '(' and
+               not mcbench.analysis._is_operator(tokens, i)
+               for i, token in enumerate(tokens[:-1]))
+
+
+def _expression(tokens):
+    for operator in ('or', 'and'):
+        parts = _split(tokens, operator)
+        if len(parts) > 1:
+            parts = [_expression(part) for part in parts]
+            if not any(_calls_extension(part) for part in parts):
+                parts.sort(key=lambda part: ' '.join(part))
+            return _join(parts, operator)
+    return _term(tokens)
+
+
+def _term(tokens):
+    normalized = []
+    i = 0
+    while i < len(tokens):
+        token = tokens[i]
+        if _is_literal(token):
+            normalized.append(_literal(token))
+        elif token in ('(', '['):
+            end = _closing(tokens, i)
+            inner = tokens[i + 1:end]
+            is_call = (token == '(' and i > 0 and _is_name(tokens[i - 1]) and
+                       not mcbench.analysis._is_operator(tokens, i - 1))
+            if is_call and inner:
+                # Function arguments keep their order.
+                inner = _join([_expression(arg) for arg in _split(inner, ',')],
+                              ',')
+            elif inner:
+                inner = _expression(inner)
+            normalized.extend([token] + inner + [tokens[end]])
+            i = end
+        else:
+            normalized.append(token)
+        i += 1
+    return normalized
+
+
+def _is_word(token):
+    return _is_name(token) or token[0].isdigit() or token[0] == '.'
+
+
+def _needs_space(tokens, i):
+    before, after = tokens[i - 1], tokens[i]
+    if '-' in (before, after):
+        # '-' can be part of a name, so keep the operator apart.
+        return True
+    if ((before in _OPERATOR_NAMES and
+         mcbench.analysis._is_operator(tokens, i - 1)) or
+            (after in _OPERATOR_NAMES and
+             mcbench.analysis._is_operator(tokens, i))):
+        return True
+    return _is_word(before) and _is_word(after)
+
+
+def _text(tokens):
+    text = []
+    for i, token in enumerate(tokens):
+        if i > 0 and _needs_space(tokens, i):
+            text.append(' ')
+        text.append(token)
+    return ''.join(text)
+
+
+def normalize(query):
+    """Returns the canonical form of query; queries it can't make sense of
+    are only stripped of surrounding whitespace."""
+    try:
+        return _text(_expression(mcbench.analysis.tokenize(query)))
+    except ValueError:
+        return query.strip()
@@ -1,54 +1,1024 @@
+import atexit
 import collections
 import itertools
+import logging
 import multiprocessing
+import os
+import threading
+import time
 
+import lxml.etree
+
+import mcbench.analysis
 import mcbench.xpath
-from mcbench.models import Benchmark, Query
+from mcbench.normalization import normalize
+from mcbench.cache import LRUCache
+from mcbench.remote import RemoteExecutor
+from mcbench.models import (
+    db, Benchmark, File, IndexTerm, Query, QueryStats)
+from mcbench.workers import Cancelled, JobAborted, WorkerPool
 from mcbench import settings
 
+log = logging.getLogger(__name__)
+
+# Parsed XML trees, keyed by path. Only worker processes keep one; see
+# _init_worker.
+_trees = None
+
+
+def _init_worker(cache_size):
+    global _trees
+    _trees = LRUCache(cache_size)
+
+
+def parse(file):
+    path = file.ast_path
+    if _trees is None:
+        return mcbench.xpath.parse_xml_filename(path)
+    mtime = os.path.getmtime(path)
+    cached = _trees.get(path)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+    xml = mcbench.xpath.parse_xml_filename(path)
+    _trees.put(path, (mtime, xml),
+               size=mcbench.xpath.xml_size(file.xml_path))
+    return xml
+
 
 def matches_in(xpath, file):
     xpath = mcbench.xpath.compile(xpath)
-    xml = mcbench.xpath.parse_xml_filename(file.xml_path)
-    return xpath.execute(xml)
+    return xpath.execute(parse(file))
+
+
+def count(result):
+    """Returns the number of matches an XPath result amounts to."""
+    if isinstance(result, list):
+        return len(result)
+    if isinstance(result, basestring):
+        return int(bool(result))
+    return int(result)
+
+
+def _lines(matches):
+    return {'m': [match.get('line', 1) for match in matches],
+            'xml': [match.sourceline for match in matches]}
+
+
+def _recorded_lines(benchmark, xpath):
+    """Returns where the matches of xpath in each file of benchmark are, if
+    that was recorded when it was last evaluated (see
+    Query.match_locations), or None."""
+    mcbench.xpath.compile(xpath)
+    query = Query.find_by_xpath(xpath)
+    if query is None:
+        return None
+    return query.match_locations(benchmark)
+
+
+def matching_lines_in(file, xpath, recorded=None):
+    lines = {'m': [], 'xml': []}
+    if xpath is None or file.parse_error is not None:
+        return lines
+    if recorded is None:
+        recorded = _recorded_lines(file.benchmark, xpath)
+    if recorded is not None:
+        return recorded.get(file.path, lines)
+    matches = matches_in(xpath, file)
+    if isinstance(matches, list):
+        lines = _lines(matches)
+    return lines
 
 
 def matching_lines(benchmark, xpath):
+    """Returns the Matlab and XML lines of the matches of xpath in each file
+    of benchmark, by file name. They're looked up rather than evaluated
+    again where the search recorded them."""
     lines = collections.defaultdict(lambda: {'m': [], 'xml': []})
     if xpath is None:
         return lines
+    recorded = _recorded_lines(benchmark, xpath)
     for file in benchmark.files:
-        matches = matches_in(xpath, file)
-        lines[file.name]['m'] = [match.get('line', 1) for match in matches]
-        lines[file.name]['xml'] = [match.sourceline for match in matches]
+        lines[file.name] = matching_lines_in(file, xpath, recorded)
     return lines
 
 
-def _num_matches_worker((name, xpath)):
-    benchmark = Benchmark(name=name)
-    return sum(len(matches_in(xpath, file)) for file in benchmark.files)
+def _evaluate(xpath, file, stats, xml=None, locations=None):
+    """Counts the matches of xpath in file, adding what it cost to stats.
+
+    Given a locations dict, it also adds the lines of the matches to it
+    under file.path; None if some of them aren't elements, and so have no
+    lines of their own.
+    """
+    if xml is None:
+        start = time.time()
+        xml = parse(file)
+        stats['parse'] += time.time() - start
+    calls = mcbench.xpath.extension_call_count()
+    start = time.time()
+    result = mcbench.xpath.compile(xpath).execute(xml)
+    num_matches = count(result)
+    stats['evaluate'] += time.time() - start
+    stats['extension_calls'] += mcbench.xpath.extension_call_count() - calls
+    stats['files'] += 1
+    if locations is not None and num_matches and isinstance(result, list):
+        if all(isinstance(match, lxml.etree._Element) for match in result):
+            locations[file.path] = _lines(result)
+        else:
+            locations[file.path] = None
+    return num_matches
+
+
+# Worker tasks are about a benchmark, given by name, and some of its files,
+# given by path; workers don't access the database. Tasks evaluating queries
+# return the number of matches along with a collections.Counter of what it
+# cost; see QueryStats.
+def _num_matches_worker((name, xpath, paths)):
+    """Also returns the lines of the matches in each file, unless there are
+    more than settings.MAX_RECORDED_MATCHES of them or they aren't all
+    elements, in which case it returns None for them.
+
+    Existence queries (see existence_xpath) stop at the first matching file.
+    """
+    stats = collections.Counter()
+    locations = {}
+    exists = _exists(xpath)
+    num_matches = 0
+    for path in paths:
+        num_matches += _evaluate(xpath, File.from_path(path), stats,
+                                 locations=locations)
+        if exists and num_matches:
+            break
+    if (num_matches > settings.MAX_RECORDED_MATCHES or
+            None in locations.values()):
+        locations = None
+    return num_matches, stats, locations
 
 
-def _map(benchmarks, query):
-    pool = multiprocessing.Pool(processes=32)
-    results = pool.map(_num_matches_worker,
-                       ((b.name, query) for b in benchmarks))
-    pool.close()
-    pool.join()
+def _num_matches_many_worker((name, queries)):
+    """Runs several queries, each given as (xpath, paths), parsing each file
+    once; the parse time is shared out among the queries that needed it.
+
+    Like _num_matches_worker, existence queries stop at the first matching
+    file.
+    """
+    results = [(0, collections.Counter()) for _ in queries]
+    paths = [set(paths) for _, paths in queries]
+    exists = [_exists(xpath) for xpath, _ in queries]
+    for path in sorted(set().union(*paths)):
+        needed = [i for i, query_paths in enumerate(paths)
+                  if path in query_paths and
+                  not (exists[i] and results[i][0])]
+        if not needed:
+            continue
+        file = File.from_path(path)
+        start = time.time()
+        xml = parse(file)
+        parse_time = time.time() - start
+        for i in needed:
+            num_matches, stats = results[i]
+            stats['parse'] += parse_time / len(needed)
+            results[i] = (num_matches +
+                          _evaluate(queries[i][0], file, stats, xml), stats)
     return results
 
 
-def compute_matches(xpath):
-    benchmarks = Benchmark.all()
-    results = _map(benchmarks, xpath)
-    for benchmark, num_matches in itertools.izip(benchmarks, results):
-        if num_matches:
-            yield benchmark, num_matches
+def _compact_worker((name, paths)):
+    """Writes the compact XML of each file, returning for each path the
+    number of elements in it and the error parsing it, one of them None."""
+    results = {}
+    for path in paths:
+        try:
+            results[path] = (File.from_path(path).write_compact_xml(), None)
+        except (EnvironmentError, lxml.etree.XMLSyntaxError) as e:
+            results[path] = (None, str(e))
+    return results
 
 
-def get_matches(xpath):
-    query = Query.find_by_xpath(xpath)
-    if query is None:
-        query = Query.create(xpath=xpath, name='')
-        query.cache_matches(compute_matches(xpath))
-    return list(query.get_cached_matches())
+def _encoding_worker((name, paths)):
+    """Returns the encoding of the Matlab source of each file, by path;
+    None for those it can't tell."""
+    results = {}
+    for path in paths:
+        try:
+            results[path] = File.from_path(path).detect_encoding()
+        except (EnvironmentError, UnicodeDecodeError):
+            results[path] = None
+    return results
+
+
+def _store_worker((name, paths, compressed)):
+    return sum(File.from_path(path).store_xml(compressed) for path in paths)
+
+
+def _index_worker((name, paths)):
+    return dict((path, mcbench.analysis.document_terms(
+                     parse(File.from_path(path))))
+                for path in paths)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+# How long starting the worker processes took.
+pool_startup_time = None
+
+
+def local_pool(processes=None):
+    """Starts worker processes on this host."""
+    return WorkerPool(processes or settings.WORKER_PROCESSES,
+                      initializer=_init_worker,
+                      initargs=(settings.WORKER_CACHE_SIZE,),
+                      memory_limit=settings.WORKER_MEMORY_LIMIT,
+                      shrink=_shrink_caches)
+
+
+def start_workers():
+    """Returns the executor worker tasks run on, starting it if need be:
+    a RemoteExecutor if settings.WORKER_HOSTS are set, or else a local
+    WorkerPool. Either way, it has the interface of WorkerPool."""
+    global _pool, pool_startup_time
+    with _pool_lock:
+        if _pool is None:
+            start = time.time()
+            if settings.WORKER_HOSTS:
+                _pool = RemoteExecutor(
+                    settings.WORKER_HOSTS, settings.WORKER_AUTHKEY,
+                    timeout=settings.WORKER_HOST_TIMEOUT,
+                    retries=settings.WORKER_HOST_RETRIES,
+                    health_interval=settings.WORKER_HEALTH_INTERVAL)
+            else:
+                _pool = local_pool()
+            atexit.register(_pool.close)
+            pool_startup_time = time.time() - start
+    return _pool
+
+
+def use_executor(executor):
+    """Makes worker tasks run on executor from now on, and returns the one
+    they ran on before (None if none was started)."""
+    global _pool
+    with _pool_lock:
+        previous, _pool = _pool, executor
+    return previous
+
+
+def _cache_stats(_=None):
+    caches = {'xpath': mcbench.xpath.compiled_queries, 'trees': _trees}
+    return dict((name, {'hits': cache.hits,
+                        'misses': cache.misses,
+                        'entries': len(cache)})
+                for name, cache in caches.iteritems() if cache is not None)
+
+
+def cache_stats():
+    """Returns the hit and miss counts of the caches in this process and
+    those of the workers' caches summed up, and how long starting the workers
+    took."""
+    workers = collections.defaultdict(collections.Counter)
+    for stats in start_workers().broadcast(_cache_stats):
+        for name, counts in stats.iteritems():
+            workers[name].update(counts)
+    return {'process': _cache_stats(), 'workers': workers,
+            'pool_startup_time': pool_startup_time}
+
+
+def _clear_caches(_=None):
+    mcbench.xpath.compiled_queries.clear()
+    if _trees is not None:
+        _trees.clear()
+
+
+def _shrink_caches():
+    # Called from a signal handler (see WorkerPool), which may have
+    # interrupted a get or put on one of the caches.
+    mcbench.xpath.compiled_queries.clear(blocking=False)
+    if _trees is not None:
+        _trees.clear(blocking=False)
+
+
+def clear_caches():
+    """Empties the caches of this process and of the workers."""
+    _clear_caches()
+    start_workers().broadcast(_clear_caches)
+
+
+def _files_of(benchmarks, unparsable=False):
+    paths = File.paths_by_benchmark(unparsable)
+    return [(b.name, paths[b.id]) for b in benchmarks]
+
+
+@db.commit_on_success
+def compact_benchmarks(benchmarks):
+    """Writes the compact XML of every file of benchmarks, checking that it
+    parses along the way; records the number of elements of the files that
+    do and the parse error of those that don't (see File.parse_error).
+
+    Returns the files that don't parse.
+    """
+    benchmarks = list(benchmarks)
+    results = start_workers().map(_compact_worker,
+                                  _files_of(benchmarks, unparsable=True),
+                                  key=lambda (name, _): name)
+    unparsable = []
+    for benchmark, files in itertools.izip(benchmarks, results):
+        for path, (node_count, parse_error) in files.iteritems():
+            (File.update(node_count=node_count, parse_error=parse_error)
+             .where((File.benchmark == benchmark) & (File.path == path))
+             .execute())
+            if parse_error is not None:
+                unparsable.append((path, parse_error))
+    return unparsable
+
+
+@db.commit_on_success
+def detect_encodings(benchmarks):
+    """Detects and records the encoding of the Matlab source of the files of
+    benchmarks that have none recorded yet (see File.encoding), and returns
+    how many it recorded."""
+    benchmarks = list(benchmarks)
+    known = set(path for path, in File.select(File.path)
+                .where(~(File.encoding >> None)).tuples())
+    tasks = [(name, [path for path in paths if path not in known])
+             for name, paths in _files_of(benchmarks, unparsable=True)]
+    results = start_workers().map(_encoding_worker, tasks,
+                                  key=lambda (name, _): name)
+    detected = 0
+    for benchmark, encodings in itertools.izip(benchmarks, results):
+        for path, encoding in encodings.iteritems():
+            if encoding is None:
+                continue
+            (File.update(encoding=encoding)
+             .where((File.benchmark == benchmark) & (File.path == path))
+             .execute())
+            detected += 1
+    return detected
+
+
+def store_xml(benchmarks, compressed):
+    """Stores the XML of every file of benchmarks gzipped, or uncompressed
+    (see File.store_xml), and returns how many files were converted."""
+    tasks = [(name, paths, compressed) for name, paths
+             in _files_of(benchmarks, unparsable=True)]
+    return sum(start_workers().map(_store_worker, tasks,
+                                   key=lambda (name, _, __): name))
+
+
+@db.commit_on_success
+def index_benchmarks(benchmarks):
+    benchmarks = list(benchmarks)
+    results = start_workers().map(_index_worker, _files_of(benchmarks),
+                                  key=lambda (name, _): name)
+    for benchmark, terms in itertools.izip(benchmarks, results):
+        IndexTerm.index(benchmark, terms)
+        for path, counts in terms.iteritems():
+            node_count = sum(count for term, count in counts.iteritems()
+                             if not term.startswith('@'))
+            (File.update(node_count=node_count)
+             .where((File.benchmark == benchmark) & (File.path == path))
+             .execute())
+
+
+def _tasks(benchmarks, xpath):
+    """Works out what needs evaluating to run xpath over benchmarks.
+
+    Returns a list of (benchmark name, xpath, paths) tasks for
+    _num_matches_worker, where paths are the only files of the benchmark
+    that can possibly match, a dict of the number of matches in benchmarks
+    that the index alone could answer for, and the size of the XML of each
+    file of the benchmarks with tasks, by benchmark name and path, for
+    _schedule.
+    """
+    analysis = mcbench.analysis.analyze(mcbench.xpath.compile(xpath))
+    indexed = IndexTerm.indexed_benchmarks()
+    candidates = {}
+    known = {}
+    if analysis.counted_tag is not None:
+        known = IndexTerm.counts(analysis.counted_tag)
+    elif analysis.required:
+        candidates = IndexTerm.candidates(analysis.required)
+    else:
+        indexed = set()
+    files = File.sizes_by_benchmark()
+    tasks = []
+    sizes = {}
+    for benchmark in benchmarks:
+        if benchmark.id not in indexed:
+            paths = [path for path, _ in files[benchmark.id]]
+        elif benchmark.id in candidates:
+            paths = candidates[benchmark.id]
+        else:
+            continue
+        tasks.append((benchmark.name, xpath, paths))
+        sizes[benchmark.name] = dict(files[benchmark.id])
+    return tasks, known, sizes
+
+
+def _schedule(tasks, sizes):
+    """Splits the tasks (see _tasks, which also gives the sizes of the
+    files) of benchmarks with more than settings.TASK_SPLIT_SIZE bytes of
+    XML into a task per file, and orders all of them largest first, so that
+    the workers aren't left waiting on one big benchmark at the end. The
+    results of a benchmark's tasks need adding up.
+
+    Whether a benchmark is split goes by all of its files, not just those
+    the index left to search, so that it's the same from one query to the
+    next; see _task_key. Worker hosts hold whole benchmarks, so with
+    settings.WORKER_HOSTS the tasks are only ordered.
+
+    Returns the tasks and the names of the benchmarks that were split.
+    """
+    split = set()
+    if settings.TASK_SPLIT_SIZE is None or not tasks:
+        return tasks, split
+    scheduled = []
+    for name, xpath, paths in tasks:
+        benchmark_sizes = sizes[name]
+        size = sum(benchmark_sizes.get(path, 0) for path in paths)
+        if (not settings.WORKER_HOSTS and
+                sum(benchmark_sizes.itervalues()) > settings.TASK_SPLIT_SIZE):
+            split.add(name)
+            scheduled.extend((benchmark_sizes.get(path, 0),
+                              (name, xpath, [path]))
+                             for path in paths)
+        else:
+            scheduled.append((size, (name, xpath, paths)))
+    scheduled.sort(key=lambda (size, _): size, reverse=True)
+    return [task for _, task in scheduled], split
+
+
+def _by_bound(tasks, benchmarks, xpath):
+    """Returns (bound, task) pairs for tasks, most first, where bound is the
+    most matches the task's benchmark can have according to the index (see
+    QueryAnalysis.result_tag), or infinity if it can't tell."""
+    result_tag = mcbench.analysis.analyze(
+        mcbench.xpath.compile(xpath)).result_tag
+    bounds = {}
+    if result_tag is not None:
+        indexed = IndexTerm.indexed_benchmarks()
+        counts = IndexTerm.counts(result_tag)
+        bounds = dict((b.name, counts.get(b.id, 0)) for b in benchmarks
+                      if b.id in indexed)
+    return sorted(((bounds.get(task[0], float('inf')), task)
+                   for task in tasks),
+                  key=lambda (bound, _): bound, reverse=True)
+
+
+def _task_key(split):
+    """Returns the key tasks are sharded by: the file of those of the
+    benchmarks in split, which are a task per file (see _schedule), and the
+    benchmark of the others. Either way, each file goes to the same worker
+    whatever the index rules out."""
+    def key((name, _, paths)):
+        return paths[0] if name in split else name
+    return key
+
+
+def _map(tasks, split):
+    return start_workers().map(_num_matches_worker, tasks,
+                               key=_task_key(split))
+
+
+def _exists(xpath):
+    """Whether xpath is an existence query (see existence_xpath), whose
+    count for a benchmark is whether any of its files matched."""
+    return mcbench.analysis.analyze(mcbench.xpath.compile(xpath)).exists
+
+
+def compute_matches(xpath, benchmarks=None):
+    """Yields (benchmark, number of matches) for every benchmark, including
+    those without any matches."""
+    if benchmarks is None:
+        benchmarks = Benchmark.all()
+    benchmarks = list(benchmarks)
+    tasks, known, sizes = _tasks(benchmarks, xpath)
+    tasks, split = _schedule(tasks, sizes)
+    computed = collections.Counter()
+    for (name, _, _), (num_matches, _, _) in itertools.izip(
+            tasks, _map(tasks, split)):
+        computed[name] += num_matches
+    if _exists(xpath):
+        for name in computed:
+            computed[name] = min(computed[name], 1)
+    for benchmark in benchmarks:
+        yield benchmark, computed.get(benchmark.name,
+                                      known.get(benchmark.id, 0))
+
+
+def _compute_many(pending):
+    """Evaluates each xpath in pending against the benchmarks it maps to,
+    in one pass over the files.
+
+    Returns a dict mapping each xpath to a list of (benchmark, number of
+    matches) pairs, a collections.Counter of what evaluating it cost (see
+    QueryStats) and a dict of the seconds spent on each benchmark id.
+    """
+    results = {}
+    queries = collections.defaultdict(list)
+    for xpath, benchmarks in pending.iteritems():
+        start = time.time()
+        tasks, known, _ = _tasks(benchmarks, xpath)
+        for name, _, paths in tasks:
+            queries[name].append((xpath, paths))
+        stats = collections.Counter(plan=time.time() - start,
+                                    benchmarks=len(tasks))
+        results[xpath] = ([(b, known.get(b.id, 0)) for b in benchmarks],
+                          stats, {})
+    tasks = queries.items()
+    counts = start_workers().map(_num_matches_many_worker, tasks,
+                                 key=lambda (name, _): name)
+    computed = {}
+    for (name, queries), query_counts in itertools.izip(tasks, counts):
+        for (xpath, _), (num_matches, stats) in zip(queries, query_counts):
+            computed[xpath, name] = num_matches, stats
+            results[xpath][1].update(stats)
+    for xpath, (matches, stats, seconds) in results.iteritems():
+        for i, (benchmark, num_matches) in enumerate(matches):
+            if (xpath, benchmark.name) in computed:
+                num_matches, benchmark_stats = computed[xpath, benchmark.name]
+                matches[i] = benchmark, num_matches
+                seconds[benchmark.id] = (benchmark_stats['parse'] +
+                                         benchmark_stats['evaluate'])
+    return results
+
+
+def compute_matches_many(xpaths, benchmarks=None):
+    """Like compute_matches for each of xpaths, but parsing each file only
+    once for all of them; see _compute_many."""
+    if benchmarks is None:
+        benchmarks = Benchmark.all()
+    benchmarks = list(benchmarks)
+    return _compute_many(dict((xpath, benchmarks) for xpath in xpaths))
+
+
+def update_matches_many(queries):
+    """Evaluates each of queries against the benchmarks it has no up to date
+    cached results for, in one pass over the files, and caches the results.
+
+    Returns a dict of the QueryStats recorded for each query.
+    """
+    start = time.time()
+    queries = list(queries)
+    results = _compute_many(dict((query.xpath, query.pending_benchmarks())
+                                 for query in queries))
+    recorded = {}
+    for query in queries:
+        matches, stats, seconds = results[query.xpath]
+        write_start = time.time()
+        query.cache_matches(matches, seconds)
+        stats['write'] += time.time() - write_start
+        recorded[query.xpath] = QueryStats.record(query, stats,
+                                                  time.time() - start)
+    return recorded
+
+
+class QueryJob(object):
+    """Evaluates a query against the benchmarks it has no cached results
+    for, caching results as workers finish them.
+
+    The benchmarks the index can answer for are cached right away; the rest
+    are only handed to the workers once the job is started, which
+    start_query holds off on while too many other jobs are running.
+
+    What the evaluation cost is recorded as a QueryStats once it's done. If
+    it's cancelled or goes over its budget, the results cached so far are
+    kept and the query and its QueryStats are marked incomplete.
+
+    With top set, the job only finds the top benchmarks with the most
+    matches: it evaluates them a round at a time, those that could have the
+    most first, and rules out the rest (counting them as skipped) once none
+    of them could place. The benchmarks it does evaluate get their full
+    counts cached, like any other job's.
+    """
+    def __init__(self, query, top=None):
+        self.query = query
+        self.top = top
+        self.error = None
+        self.incomplete = None
+        self.stats = collections.Counter()
+        start = time.time()
+        benchmarks = query.pending_benchmarks()
+        self.total = len(benchmarks)
+        tasks, known, self._sizes = _tasks(benchmarks, query.xpath)
+        if top is None:
+            self._waiting = [(None, task) for task in tasks]
+        else:
+            self._waiting = _by_bound(tasks, benchmarks, query.xpath)
+        self.stats['plan'] = time.time() - start
+        self.stats['benchmarks'] = len(tasks)
+        self._benchmarks = dict((b.name, b) for b in benchmarks)
+        self._tasks = []
+        self._split = set()
+        self._exists = _exists(query.xpath)
+        # How many of each benchmark's tasks are yet to finish, and what
+        # those that did added up to; see _merge.
+        self._parts = collections.Counter()
+        self._partial = {}
+        self._results = None
+        self._deadline = None
+        self._lock = threading.RLock()
+
+        evaluated = set(name for name, _, _ in tasks)
+        self._cache([(b, known.get(b.id, 0)) for b in benchmarks
+                     if b.name not in evaluated])
+        self.processed = self.total - len(tasks)
+        self.skipped = 0
+        self._next_round()
+        self._start = start
+        self._finish()
+
+    @property
+    def started(self):
+        return self._results is not None
+
+    @property
+    def done(self):
+        return (self.error is not None or self.incomplete is not None or
+                self.processed + self.skipped == self.total)
+
+    def _next_round(self):
+        """Takes the tasks to hand out next off those waiting: all of them,
+        or for a top-N job, the next settings.TOP_ROUND_SIZE benchmarks that
+        could still place, skipping the rest once none can."""
+        if self.top is None:
+            tasks = [task for _, task in self._waiting]
+            self._waiting = []
+        else:
+            threshold = self.query.nth_most_matches(self.top)
+            tasks = []
+            while self._waiting and len(tasks) < settings.TOP_ROUND_SIZE:
+                bound, task = self._waiting[0]
+                if bound <= threshold:
+                    # They're in order, so none of the others can either.
+                    self.skipped += len(self._waiting)
+                    self.stats['benchmarks'] -= len(self._waiting)
+                    self._waiting = []
+                    break
+                tasks.append(task)
+                del self._waiting[0]
+        self._tasks, self._split = _schedule(tasks, self._sizes)
+        self._parts = collections.Counter(name for name, _, _ in self._tasks)
+
+    def _submit(self):
+        self._results = start_workers().imap_unordered(
+            _num_matches_worker, self._tasks, key=_task_key(self._split),
+            deadline=self._deadline)
+
+    def start(self):
+        """Hands the benchmarks that need evaluating to the workers."""
+        # The time spent waiting to be started doesn't count.
+        self._start = time.time() - self.stats['plan']
+        if settings.QUERY_TIME_LIMIT is not None:
+            self._deadline = time.time() + settings.QUERY_TIME_LIMIT
+        self._submit()
+
+    def cancel(self):
+        """Stops the evaluation; see poll."""
+        with self._lock:
+            if self.started:
+                start_workers().cancel(self._results)
+            elif not self.done:
+                self._mark_incomplete(Cancelled('cancelled'))
+
+    def _mark_incomplete(self, e):
+        self.incomplete = str(e)
+        self.query.mark_incomplete(self.incomplete)
+        QueryStats.record(self.query, self.stats, time.time() - self._start,
+                          self.incomplete)
+
+    def _cache(self, results, seconds=None, locations=None):
+        start = time.time()
+        self.query.cache_matches(results, seconds, locations)
+        self.stats['write'] += time.time() - start
+
+    def _finish(self):
+        if self.total and self.processed + self.skipped == self.total:
+            QueryStats.record(self.query, self.stats,
+                              time.time() - self._start)
+
+    def _merge(self, name, num_matches, seconds, locations):
+        """Adds up the results of the tasks of the benchmark called name,
+        and returns them once they're all in (and None until then)."""
+        partial = self._partial.setdefault(name, [0, 0, {}])
+        partial[0] += num_matches
+        partial[1] += seconds
+        if locations is None or partial[2] is None:
+            partial[2] = None
+        else:
+            partial[2].update(locations)
+        self._parts[name] -= 1
+        if self._parts[name]:
+            return None
+        num_matches, seconds, locations = self._partial.pop(name)
+        if self._exists:
+            num_matches = min(num_matches, 1)
+        if num_matches > settings.MAX_RECORDED_MATCHES:
+            locations = None
+        return num_matches, seconds, locations
+
+    def _take(self, deadline):
+        """Waits until deadline for results, and returns those of the
+        benchmarks that are done, along with the seconds spent on each
+        benchmark id and the locations of the matches in each."""
+        results = []
+        seconds = {}
+        locations = {}
+        while True:
+            # Once some are in, only those already waiting are taken too.
+            if results:
+                timeout = 0
+            elif deadline is None:
+                timeout = None
+            else:
+                timeout = max(deadline - time.time(), 0)
+            try:
+                index, (num_matches, stats, benchmark_locations) = (
+                    self._results.next_indexed(timeout))
+            except (StopIteration, multiprocessing.TimeoutError):
+                return results, seconds, locations
+            except JobAborted:
+                # The next call raises it again; keep what came in first.
+                if results:
+                    return results, seconds, locations
+                raise
+            self.stats.update(stats)
+            name = self._tasks[index][0]
+            merged = self._merge(name, num_matches,
+                                 stats['parse'] + stats['evaluate'],
+                                 benchmark_locations)
+            if merged is None:
+                continue
+            benchmark = self._benchmarks[name]
+            results.append((benchmark, merged[0]))
+            seconds[benchmark.id] = merged[1]
+            locations[benchmark.id] = merged[2]
+
+    def poll(self, timeout=0):
+        """Caches the results that come in within timeout seconds (or until
+        the job is done, if timeout is None) and returns whether it's done.
+
+        Raises XPathError if the query failed to evaluate. A job that was
+        cancelled or went over its budget is done, with incomplete set to
+        the reason.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._lock:
+            while self.started and not self.done:
+                try:
+                    results, seconds, locations = self._take(deadline)
+                except mcbench.xpath.XPathError as e:
+                    self.error = e
+                    break
+                except JobAborted as e:
+                    self._mark_incomplete(e)
+                    break
+                if results:
+                    self._cache(results, seconds, locations)
+                    self.processed += len(results)
+                if (self._waiting and
+                        self._results.received == self._results.total):
+                    self._next_round()
+                    if self._tasks:
+                        self._submit()
+                elif not results:
+                    break
+                self._finish()
+            if self.error is not None:
+                raise self.error
+            return self.done
+
+    def poll_if_idle(self):
+        """Polls the job without waiting, unless someone else is already
+        polling it."""
+        if not self._lock.acquire(False):
+            return self.done
+        try:
+            return self.poll()
+        finally:
+            self._lock.release()
+
+    def wait(self):
+        self.poll(timeout=None)
+
+
+# What a search finds out about each benchmark; see get_matches.
+MODES = ('count', 'exists', 'top')
+
+# The jobs under way, by normalized xpath and top (see QueryJob), so that
+# everyone running the same query waits on the same job; the ones not started
+# yet wait in _queue, in order.
+_jobs = {}
+_queue = collections.deque()
+_jobs_lock = threading.Condition(threading.Lock())
+
+
+def _admit():
+    """Starts queued jobs while fewer than settings.MAX_RUNNING_QUERIES are
+    running. Must be called with _jobs_lock held."""
+    running = sum(1 for job in _jobs.itervalues()
+                  if job.started and not job.done)
+    while _queue and running < settings.MAX_RUNNING_QUERIES:
+        job = _queue.popleft()
+        if job.done:
+            continue
+        job.start()
+        running += 1
+    _jobs_lock.notify_all()
+
+
+def _forget(job):
+    key = job.query.normalized, job.top
+    with _jobs_lock:
+        if _jobs.get(key) is job:
+            del _jobs[key]
+        if job in _queue:
+            _queue.remove(job)
+        _admit()
+
+
+def evict_queries():
+    """Deletes the least recently used unsaved queries until their cached
+    results fit settings.QUERY_CACHE_MAX_BYTES (see Query.evict), sparing
+    those being evaluated. Returns how many were deleted."""
+    with _jobs_lock:
+        keep = set(job.query.id for job in _jobs.itervalues())
+    return Query.evict(settings.QUERY_CACHE_MAX_BYTES,
+                       settings.QUERY_CACHE_HIT_WEIGHT, keep)
+
+
+_evictor = None
+
+
+def _evict_every(interval):
+    while True:
+        time.sleep(interval)
+        try:
+            evict_queries()
+        except Exception:
+            log.exception('evicting queries failed')
+
+
+def start_evictor():
+    """Runs evict_queries in a background thread every
+    settings.QUERY_EVICTION_INTERVAL seconds, unless it already is."""
+    global _evictor
+    with _pool_lock:
+        if _evictor is None:
+            _evictor = threading.Thread(
+                target=_evict_every,
+                args=(settings.QUERY_EVICTION_INTERVAL,))
+            _evictor.daemon = True
+            _evictor.start()
+
+
+def queue_position(job):
+    """Returns how many jobs will be started before job (counting itself),
+    or 0 if it's started."""
+    with _jobs_lock:
+        if job.started or job not in _queue:
+            return 0
+        return list(_queue).index(job) + 1
+
+
+def existence_xpath(xpath):
+    """Returns the query asking only whether each benchmark matches xpath
+    at all, which counts one match for each one that does. Its results are
+    cached apart from those of xpath, and found faster, as each benchmark's
+    evaluation stops at its first matching file."""
+    if mcbench.analysis.analyze(mcbench.xpath.compile(xpath)).exists:
+        return xpath
+    return 'boolean(%s)' % xpath
+
+
+def start_query(xpath, resume=False, touch=True, top=None):
+    """Starts evaluating xpath against the benchmarks it has no cached
+    results for, unless that's already under way. The job is queued if too
+    many others are running; see queue_position. With top, it only looks
+    for the top benchmarks with the most matches; see QueryJob.
+
+    Returns the QueryJob doing it, or None if all the results are cached.
+    A query whose last evaluation was cut short (see Query.incomplete) is
+    only picked up again if resume is set. Unless touch is false, the query
+    is recorded as accessed; see Query.evict.
+    """
+    mcbench.xpath.compile(xpath)
+    key = normalize(xpath), top
+    with _jobs_lock:
+        job = _jobs.get(key)
+        if job is not None and not job.done:
+            if touch:
+                job.query.touch()
+            return job
+    query = Query.find_or_create(xpath)
+    if touch:
+        query.touch()
+    if query.incomplete is not None:
+        if not resume:
+            return None
+        query.mark_incomplete(None)
+    # Planning the job caches what the index answers, which can take a
+    # while, so the other searches aren't held up meanwhile.
+    job = QueryJob(query, top)
+    with _jobs_lock:
+        running = _jobs.get(key)
+        if running is not None and not running.done:
+            # Started by someone else in the meantime.
+            return running
+        if job.done:
+            _jobs.pop(key, None)
+            return None
+        _jobs[key] = job
+        _queue.append(job)
+        _admit()
+        return job
+
+
+def _wait_until_started(job, deadline):
+    """Waits for job to be started (or done) until deadline, and returns
+    whether it was.
+
+    Running jobs only notice they're done when they're polled, and whoever
+    started them may have stopped doing that, so the running jobs are
+    polled here as well.
+    """
+    while not (job.started or job.done):
+        with _jobs_lock:
+            running = [j for j in _jobs.itervalues()
+                       if j.started and not j.done]
+        for other in running:
+            try:
+                other.poll_if_idle()
+            except mcbench.xpath.XPathError:
+                pass
+            if other.done:
+                _forget(other)
+        with _jobs_lock:
+            _admit()
+            if job.started or job.done:
+                break
+            timeout = 0.5
+            if deadline is not None:
+                timeout = min(timeout, deadline - time.time())
+                if timeout <= 0:
+                    return False
+            _jobs_lock.wait(timeout)
+    return True
+
+
+def poll_query(job, timeout=0):
+    """Polls job (see QueryJob.poll), forgetting about it once it's done;
+    a job that hasn't started within timeout isn't done.
+
+    A query that fails to evaluate is forgotten too, unless it was saved.
+    """
+    deadline = None if timeout is None else time.time() + timeout
+    if not _wait_until_started(job, deadline):
+        return False
+    if deadline is not None:
+        timeout = max(deadline - time.time(), 0)
+    try:
+        done = job.poll(timeout)
+    except mcbench.xpath.XPathError:
+        if not job.query.is_saved:
+            job.query.delete_instance(recursive=True)
+        raise
+    finally:
+        if job.done:
+            _forget(job)
+    return done
+
+
+def cancel_query(xpath, top=None):
+    """Cancels the evaluation of xpath (for the top benchmarks, with top),
+    if it's under way, and returns whether it was."""
+    with _jobs_lock:
+        job = _jobs.get((normalize(xpath), top))
+    if job is None or job.done:
+        return False
+    job.cancel()
+    poll_query(job, timeout=None)
+    return True
+
+
+def mode_query(xpath, mode, top=None):
+    """Returns the xpath and top to start_query with to search for xpath in
+    mode, one of MODES: 'count' counts every match in every benchmark,
+    'exists' only finds out which benchmarks match (see existence_xpath),
+    and 'top' finds the top (by default, settings.TOP_MATCHES) benchmarks
+    with the most matches (see QueryJob)."""
+    if mode not in MODES:
+        raise ValueError('unknown query mode %r' % mode)
+    if mode == 'exists':
+        return existence_xpath(xpath), None
+    if mode == 'top':
+        return xpath, top or settings.TOP_MATCHES
+    return xpath, None
+
+
+def get_matches(xpath, mode='count', top=None):
+    """Evaluates xpath in mode (see mode_query) and returns the cached
+    results of the benchmarks that match, most matches first."""
+    xpath, top = mode_query(xpath, mode, top)
+    job = start_query(xpath, resume=True, top=top)
+    if job is not None:
+        poll_query(job, timeout=None)
+    matches = Query.find_by_xpath(xpath).get_cached_matches()
+    return matches[:top] if top else matches
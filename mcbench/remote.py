@@ -0,0 +1,316 @@
+"""Running worker tasks on other hosts.
+
+Each worker host runs serve, which evaluates tasks in a local WorkerPool
+against its own DATA_ROOT. A RemoteExecutor then stands in for the local
+WorkerPool: tasks are assigned to hosts by their shard key (the benchmark
+name) the same way WorkerPool assigns them to processes, so each host only
+needs the benchmarks that shard to it, and only the results of the tasks
+travel back.
+
+Hosts that fail are retried, and once they're given up on their tasks go to
+the next live host in the list, which should therefore hold a replica of
+their shard. Hosts are pinged periodically to notice when they come back.
+
+Tasks and results are pickled, so hosts must trust each other; connections
+are authenticated with a shared key.
+"""
+import _multiprocessing
+import logging
+import multiprocessing.connection
+import operator
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+import weakref
+import zlib
+
+from mcbench.workers import Cancelled, JobAborted, ResultIterator, _ordered
+
+log = logging.getLogger(__name__)
+
+# How long to wait for a host to answer a ping.
+PING_TIMEOUT = 5
+
+
+class WorkerHostError(Exception):
+    pass
+
+
+def _check_authkey(authkey):
+    if not authkey:
+        raise WorkerHostError('worker hosts need a shared key; set '
+                              'WORKER_AUTHKEY in local_settings.py')
+
+
+def _apply((func, arg, key)):
+    return func(arg)
+
+
+def _handle(conn, pool):
+    try:
+        request = conn.recv()
+        if request[0] == 'ping':
+            conn.send('pong')
+        elif request[0] == 'map':
+            _, func, items, time_limit = request
+            deadline = None if time_limit is None else time.time() + time_limit
+            results = pool.imap_unordered(
+                _apply, [(func, arg, key) for arg, key in items],
+                key=operator.itemgetter(2), deadline=deadline)
+            try:
+                while True:
+                    try:
+                        conn.send(results.next_result(timeout=0.5))
+                    except multiprocessing.TimeoutError:
+                        # The executor sends nothing more, so the connection
+                        # only becomes readable once it's closed, e.g.
+                        # because the job was cancelled.
+                        if conn.poll():
+                            raise EOFError
+            except StopIteration:
+                pass
+            except JobAborted as e:
+                conn.send((None, (False, e)))
+            except (EOFError, IOError):
+                pool.cancel(results)
+                raise
+        elif request[0] == 'broadcast':
+            _, func, arg = request
+            try:
+                conn.send((True, pool.broadcast(func, arg)))
+            except Exception as e:
+                conn.send((False, e))
+    except (EOFError, IOError):
+        log.warning('lost connection to executor', exc_info=True)
+    finally:
+        conn.close()
+
+
+def serve(address, authkey, pool):
+    """Runs the tasks that RemoteExecutors send to address in pool, until
+    terminated."""
+    try:
+        _check_authkey(authkey)
+    except WorkerHostError:
+        pool.close()
+        raise
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    listener = multiprocessing.connection.Listener(address, authkey=authkey)
+    try:
+        while True:
+            try:
+                conn = listener.accept()
+            except multiprocessing.AuthenticationError:
+                log.warning('rejected connection with the wrong key')
+                continue
+            thread = threading.Thread(target=_handle, args=(conn, pool))
+            thread.daemon = True
+            thread.start()
+    finally:
+        listener.close()
+        pool.close()
+
+
+def _connect(address, authkey, timeout):
+    # multiprocessing.connection.Client keeps retrying refused connections
+    # for 20 seconds, which is no good for noticing dead hosts.
+    sock = socket.create_connection(address, timeout)
+    sock.settimeout(None)
+    try:
+        conn = _multiprocessing.Connection(os.dup(sock.fileno()))
+    finally:
+        sock.close()
+    multiprocessing.connection.answer_challenge(conn, authkey)
+    multiprocessing.connection.deliver_challenge(conn, authkey)
+    return conn
+
+
+def _recv(conn, timeout):
+    if not conn.poll(timeout):
+        raise IOError('timed out waiting for worker host')
+    return conn.recv()
+
+
+class RemoteExecutor(object):
+    """Runs tasks on worker hosts running serve; see WorkerPool."""
+    def __init__(self, addresses, authkey, timeout=60, retries=2,
+                 health_interval=10):
+        _check_authkey(authkey)
+        self.addresses = [tuple(address) for address in addresses]
+        self.authkey = authkey
+        self.timeout = timeout
+        self.retries = retries
+        self.live = set()
+        # The connections used by each job, so they can be closed to cancel
+        # it; see _abort.
+        self._connections = weakref.WeakKeyDictionary()
+        self._lock = threading.RLock()
+        self._closed = threading.Event()
+        self.check_health()
+        self._health_checker = threading.Thread(
+            target=self._check_health_every, args=(health_interval,))
+        self._health_checker.daemon = True
+        self._health_checker.start()
+
+    def __len__(self):
+        return len(self.addresses)
+
+    def _connect(self, address):
+        return _connect(address, self.authkey, self.timeout)
+
+    def ping(self, address):
+        try:
+            conn = _connect(address, self.authkey, PING_TIMEOUT)
+            try:
+                conn.send(('ping',))
+                return _recv(conn, PING_TIMEOUT) == 'pong'
+            finally:
+                conn.close()
+        except (EOFError, IOError, multiprocessing.AuthenticationError):
+            return False
+
+    def check_health(self):
+        """Pings every host, and returns the ones that are up."""
+        live = set(address for address in self.addresses
+                   if self.ping(address))
+        with self._lock:
+            for address in set(self.addresses) - live:
+                if address in self.live:
+                    log.warning('worker host %s:%s is down', *address)
+            self.live = live
+        return live
+
+    def _check_health_every(self, interval):
+        while not self._closed.wait(interval):
+            self.check_health()
+
+    def _mark_down(self, address):
+        log.warning('giving up on worker host %s:%s', *address)
+        with self._lock:
+            self.live.discard(address)
+
+    def shard(self, key):
+        return (zlib.crc32(key) & 0xffffffff) % len(self.addresses)
+
+    def _host(self, key, exclude=()):
+        """Returns the live host that key shards to, or the first live one
+        after it, or None if there is none."""
+        start = self.shard(key)
+        with self._lock:
+            for i in range(len(self.addresses)):
+                address = self.addresses[(start + i) % len(self.addresses)]
+                if address in self.live and address not in exclude:
+                    return address
+        return None
+
+    def _dispatch(self, results, func, tasks, deadline, exclude=()):
+        """Sends tasks, (index, arg, key) triples, to the hosts they shard
+        to, in a thread per host."""
+        by_host = {}
+        for index, arg, key in tasks:
+            address = self._host(key, exclude)
+            if address is None:
+                results._put(index, (False, WorkerHostError(
+                    'no worker host left for %s' % key)))
+            else:
+                by_host.setdefault(address, []).append((index, arg, key))
+        for address, host_tasks in by_host.iteritems():
+            thread = threading.Thread(
+                target=self._run,
+                args=(results, func, address, host_tasks, deadline, exclude))
+            thread.daemon = True
+            thread.start()
+
+    def _run(self, results, func, address, tasks, deadline, exclude):
+        pending = dict((index, (arg, key)) for index, arg, key in tasks)
+        for attempt in range(self.retries + 1):
+            if attempt:
+                time.sleep(0.1 * 2 ** attempt)
+            if results.aborted is not None:
+                return
+            indices = sorted(pending)
+            time_limit = None if deadline is None else deadline - time.time()
+            try:
+                conn = self._connect(address)
+                with self._lock:
+                    if results.aborted is not None:
+                        conn.close()
+                        return
+                    self._connections[results].append(conn)
+                try:
+                    conn.send(('map', func, [pending[i] for i in indices],
+                               time_limit))
+                    while pending:
+                        i, result = _recv(conn, self.timeout)
+                        if i is None:
+                            self._abort(results, result[1])
+                            return
+                        del pending[indices[i]]
+                        results._put(indices[i], result)
+                finally:
+                    conn.close()
+                return
+            except (EOFError, IOError, multiprocessing.AuthenticationError):
+                if results.aborted is not None:
+                    return
+                log.warning('worker host %s:%s failed (attempt %d)',
+                            address[0], address[1], attempt + 1,
+                            exc_info=True)
+        self._mark_down(address)
+        self._dispatch(results, func,
+                       [(i, arg, key) for i, (arg, key) in pending.items()],
+                       deadline, exclude=tuple(exclude) + (address,))
+
+    def imap_unordered(self, func, iterable, key=None, deadline=None):
+        items = list(iterable)
+        results = ResultIterator(len(items))
+        with self._lock:
+            self._connections[results] = []
+        self._dispatch(results, func, [
+            (index, item, key(item) if key else str(index))
+            for index, item in enumerate(items)], deadline)
+        return results
+
+    def _abort(self, results, e):
+        with self._lock:
+            if results.aborted is not None:
+                return
+            results._abort(e)
+            connections = self._connections[results]
+        # The hosts cancel their part of the job when they lose the
+        # connection.
+        for conn in connections:
+            conn.close()
+
+    def cancel(self, results, e=None):
+        self._abort(results, e or Cancelled('cancelled'))
+
+    def map(self, func, iterable, key=None):
+        return _ordered(self.imap_unordered(func, iterable, key))
+
+    def broadcast(self, func, arg=None):
+        """Runs func(arg) once in every worker process of every live host
+        and returns the results."""
+        results = []
+        for address in sorted(self.live):
+            try:
+                conn = self._connect(address)
+                try:
+                    conn.send(('broadcast', func, arg))
+                    success, value = _recv(conn, self.timeout)
+                finally:
+                    conn.close()
+            except (EOFError, IOError, multiprocessing.AuthenticationError):
+                self._mark_down(address)
+                continue
+            if not success:
+                raise value
+            results.extend(value)
+        return results
+
+    def close(self):
+        self._closed.set()
+        self._health_checker.join()
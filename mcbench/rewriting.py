@@ -0,0 +1,153 @@
+"""Rewrites calls to the XPath extensions into plain XPath.
+
+Extensions are Python callbacks, so lxml has to call back into Python for
+every node a query tries them on. Where an extension is called in a
+predicate of a step whose tag it accepts, the call can instead be spelled
+out in XPath that libxml2 evaluates on its own. Calls that can't be rewritten
+this way, because of their arguments or context, are left alone.
+
+The rewritten query has the same results, except that an arg() index out of
+range selects nothing instead of failing the query.
+"""
+import re
+
+from mcbench.analysis import _closing, _is_literal, _is_name, _split
+import mcbench.analysis
+
+_INTEGER = re.compile(r'\d+$')
+
+_NON_ELEMENT_AXES = ('attribute', 'namespace')
+
+_FUNCTION = "*[1][self::NameExpr][@kind='FUN']"
+
+
+def _is_attribute_path(tokens):
+    """Returns whether tokens are a location path selecting attributes."""
+    steps = mcbench.analysis._steps(tokens)
+    return bool(steps) and steps[-1][0] == 'attribute'
+
+
+def _is_call(args, texts):
+    if not args:
+        return 'boolean(%s)' % _FUNCTION
+    if all(len(arg) == 1 and _is_literal(arg[0]) for arg in args):
+        names = ' or '.join('@nameId=%s' % arg[0] for arg in args)
+        return 'boolean(%s/*[1][%s])' % (_FUNCTION, names)
+    if len(args) == 1 and _is_attribute_path(args[0]):
+        return '(%s/*[1]/@nameId = (%s))' % (_FUNCTION, texts[0])
+    return None
+
+
+def _child(index):
+    def rewrite(args, texts):
+        if args:
+            return None
+        return '(*[%d])' % index
+    return rewrite
+
+
+def _arg(args, texts):
+    if len(args) != 1 or len(args[0]) != 1 or not _INTEGER.match(args[0][0]):
+        return None
+    return '(*[%d])' % (int(args[0][0]) + 1)
+
+
+def _tag_ends_with(suffix):
+    def rewrite(args, texts):
+        if args:
+            return None
+        return ("(substring(name(), string-length(name()) - %d) = '%s')" %
+                (len(suffix) - 1, suffix))
+    return rewrite
+
+
+# The extensions that can be rewritten, with the tags they accept (None for
+# any element) and a function from their arguments, as lists of tokens, to
+# the XPath replacing the call, or None if they can't be rewritten. The
+# functions also get the text of each argument.
+_REWRITES = {
+    'is_call': (('ParameterizedExpr',), _is_call),
+    'arg': (('ParameterizedExpr', 'CellIndexExpr'), _arg),
+    'lhs': (('AssignStmt',), _child(1)),
+    'rhs': (('AssignStmt',), _child(2)),
+    'target': (('CellIndexExpr', 'DotExpr', 'ParameterizedExpr'), _child(1)),
+    'is_stmt': (None, _tag_ends_with('Stmt')),
+    'is_expr': (None, _tag_ends_with('Expr')),
+}
+
+
+def _opening(tokens, i):
+    """Returns the index of the bracket closed by the one at i."""
+    depth = 0
+    for j in range(i, -1, -1):
+        if tokens[j] in (')', ']'):
+            depth += 1
+        elif tokens[j] in ('(', '['):
+            depth -= 1
+            if depth == 0:
+                return j
+    raise ValueError('unbalanced brackets in query')
+
+
+def _context_tag(tokens, i):
+    """Returns the node test of the step whose predicate the token at i is
+    in, '*' for any element, or None if that isn't an element step."""
+    depth = 0
+    for j in range(i - 1, -1, -1):
+        if tokens[j] in (')', ']'):
+            depth += 1
+        elif tokens[j] == '[' and depth == 0:
+            break
+        elif tokens[j] in ('(', '[') and depth > 0:
+            depth -= 1
+    else:
+        return None
+    # Skip back over any predicates before this one.
+    j -= 1
+    while j >= 0 and tokens[j] == ']':
+        j = _opening(tokens, j) - 1
+    if j < 0 or not (_is_name(tokens[j]) or tokens[j] == '*'):
+        return None
+    if ':' in tokens[j] or (j > 0 and tokens[j - 1] in ('@', '$')):
+        return None
+    if j > 1 and tokens[j - 1] == '::' and tokens[j - 2] in _NON_ELEMENT_AXES:
+        return None
+    return tokens[j]
+
+
+def rewrite(query):
+    """Returns query with the extension calls that can be rewritten into
+    plain XPath rewritten."""
+    try:
+        spans = mcbench.analysis.tokenize_spans(query)
+        tokens = [token for token, _, _ in spans]
+        replacements = []
+        i = 0
+        while i < len(tokens):
+            if (tokens[i] not in _REWRITES or i + 1 == len(tokens) or
+                    tokens[i + 1] != '(' or
+                    (i > 0 and tokens[i - 1] in ('/', '//', '::', '@'))):
+                i += 1
+                continue
+            end = _closing(tokens, i + 1)
+            tags, rewrite_call = _REWRITES[tokens[i]]
+            tag = _context_tag(tokens, i)
+            if tag is not None and (tags is None or tag in tags):
+                args = _split(tokens[i + 2:end], ',') if end > i + 2 else []
+                texts = []
+                start = i + 2
+                for arg in args:
+                    texts.append(query[spans[start][1]:
+                                       spans[start + len(arg) - 1][2]])
+                    start += len(arg) + 1
+                replacement = rewrite_call(args, texts)
+                if replacement is not None:
+                    replacements.append((spans[i][1], spans[end][2],
+                                         replacement))
+                    i = end
+            i += 1
+    except ValueError:
+        return query
+    for start, end, replacement in reversed(replacements):
+        query = query[:start] + replacement + query[end:]
+    return query
@@ -2,9 +2,80 @@ import os
 
 root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 DB_PATH = os.path.join(root, 'mcbench.sqlite')
+# Set on every database connection. In WAL mode, pages are read while
+# query results are being written instead of waiting for the write to
+# commit, and with it synchronous=NORMAL is still safe from corruption.
+SQLITE_PRAGMAS = (
+    ('journal_mode', 'WAL'),
+    ('synchronous', 'NORMAL'),
+    ('mmap_size', 256 * 1024 * 1024),
+    # In KiB when negative.
+    ('cache_size', -64 * 1024),
+)
 DATA_ROOT = os.path.expanduser('~/mcbench-benchmarks')
 SECRET_KEY = 'dummy'
 
+# Long-lived processes that evaluate queries over the corpus.
+WORKER_PROCESSES = 32
+# How much parsed XML each worker keeps around between queries, measured in
+# bytes of XML on disk (the parsed trees themselves take up a few times more).
+WORKER_CACHE_SIZE = 256 * 1024 * 1024
+# Workers using more memory than this (in bytes) have their caches emptied,
+# and if that's not enough, the query they're working on cut short; None for
+# no limit.
+WORKER_MEMORY_LIMIT = 2 * 1024 * 1024 * 1024
+# Other hosts to evaluate queries on instead, as (host, port) pairs of
+# 'manage.py serve_worker' instances; see mcbench.remote. They authenticate
+# with WORKER_AUTHKEY, hosts taking longer than WORKER_HOST_TIMEOUT seconds
+# to answer are retried WORKER_HOST_RETRIES times before their tasks go to
+# another host, and hosts are pinged every WORKER_HEALTH_INTERVAL seconds.
+# Hosts run whatever tasks they're sent, so WORKER_AUTHKEY has no default:
+# set it to a long random string in local_settings.py.
+WORKER_HOSTS = ()
+WORKER_AUTHKEY = None
+WORKER_HOST_TIMEOUT = 300
+WORKER_HOST_RETRIES = 2
+WORKER_HEALTH_INTERVAL = 10
+# How much highlighted source the web server keeps around, in bytes of HTML.
+HIGHLIGHT_CACHE_SIZE = 64 * 1024 * 1024
+
+# How many compiled XPath queries each process keeps around.
+XPATH_CACHE_SIZE = 1024
+
+# How long (in seconds) a search waits for its results before showing a
+# progress page instead, and how long each progress update waits for more.
+QUERY_WAIT_TIMEOUT = 5
+QUERY_POLL_TIMEOUT = 1
+# How long (in seconds) a search may take before it's cut short, leaving the
+# results found so far marked as incomplete; None for no limit.
+QUERY_TIME_LIMIT = 600
+# How many searches may run at once; the others wait their turn.
+MAX_RUNNING_QUERIES = 4
+# Benchmarks with more than this many bytes of XML are searched a file at a
+# time, so that their files are spread over the workers, and the largest
+# tasks are handed out first; None to search a benchmark at a time, in order.
+TASK_SPLIT_SIZE = 1024 * 1024
+# How many benchmarks with the most matches a top-N search finds by default,
+# and how many it evaluates at a time before checking whether the others
+# could still make it.
+TOP_MATCHES = 20
+TOP_ROUND_SIZE = 64
+
+# How many bytes the cached results of unsaved queries may take up: some 50
+# for each query and benchmark, plus the compressed locations of the matches
+# if they were recorded (see MAX_RECORDED_MATCHES). Past that, the unsaved
+# queries searched for least recently are deleted by a background thread of
+# the web server, which checks every QUERY_EVICTION_INTERVAL seconds, or by
+# 'manage.py evict_queries'. Each time a query was searched for counts as
+# QUERY_CACHE_HIT_WEIGHT seconds more recent.
+QUERY_CACHE_MAX_BYTES = 256 * 1024 * 1024
+QUERY_EVICTION_INTERVAL = 60
+QUERY_CACHE_HIT_WEIGHT = 3600
+# Searches record where the matches are in benchmarks with at most this many
+# of them, so that benchmark pages can highlight them without evaluating the
+# query again; 0 to record none.
+MAX_RECORDED_MATCHES = 10000
+
 try:
     from local_settings import *
 except ImportError:
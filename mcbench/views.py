@@ -2,8 +2,9 @@ import time
 
 import flask
 
+import mcbench.highlighters
 import mcbench.xpath
-from mcbench.models import Benchmark, Query
+from mcbench.models import Benchmark, Query, QueryStats
 from mcbench import querier
 from mcbench import app
 
@@ -12,6 +13,12 @@ def redirect(url_name, *args, **kwargs):
     return flask.redirect(flask.url_for(url_name, *args, **kwargs))
 
 
+@app.before_first_request
+def start_workers():
+    querier.start_workers()
+    querier.start_evictor()
+
+
 def get_valid_query_or_throw():
     xpath = flask.request.args.get('query') or None
     if xpath is None:
@@ -20,6 +27,22 @@ def get_valid_query_or_throw():
     return xpath
 
 
+def get_mode():
+    """Returns the search mode and, for top-N searches, the N asked for;
+    see querier.mode_query."""
+    mode = flask.request.values.get('mode') or 'count'
+    if mode not in querier.MODES:
+        flask.abort(400)
+    top = flask.request.values.get('top')
+    try:
+        top = int(top) if top else None
+    except ValueError:
+        flask.abort(400)
+    if top is not None and top < 1:
+        flask.abort(400)
+    return mode, top
+
+
 @app.route('/', methods=['GET'])
 def index():
     return flask.render_template('index.html', queries=Query.saved())
@@ -47,24 +70,81 @@ def benchmark_list():
         benchmarks = list(Benchmark.all())
         return flask.render_template('list.html', benchmarks=benchmarks)
 
+    mode, top = get_mode()
+    searched, top = querier.mode_query(xpath, mode, top)
     start = time.time()
     try:
-        matches = querier.get_matches(xpath)
+        job = querier.start_query(
+            searched, resume=bool(flask.request.args.get('resume')), top=top)
+        done = job is None or querier.poll_query(
+            job, app.config['QUERY_WAIT_TIMEOUT'])
     except mcbench.xpath.XPathError as e:
         flask.flash(str(e), 'error')
         return redirect('index', query=e.query)
+    query = Query.find_by_xpath(searched)
+    matches = query.get_cached_matches()[:top]
     elapsed_time = time.time() - start
 
     return flask.render_template(
         'search.html',
-        show_save_query_form=not Query.find_by_xpath(xpath).is_saved,
+        show_save_query_form=not query.is_saved,
+        job=None if done else job,
+        position=0 if done else querier.queue_position(job),
         matches=matches,
         query=xpath,
+        searched=searched,
+        mode=mode,
+        top=top,
+        incomplete=query.incomplete,
         elapsed_time=elapsed_time,
+        stats=QueryStats.latest(query),
+        slowest_matches=query.slowest_matches(3),
         total_matches=sum(m.num_matches for m in matches),
         total_benchmarks=Benchmark.count())
 
 
+@app.route('/list/status', methods=['GET'])
+def query_status():
+    xpath = flask.request.args['query']
+    mode, top = get_mode()
+    try:
+        searched, top = querier.mode_query(xpath, mode, top)
+        job = querier.start_query(searched, touch=False, top=top)
+        done = job is None or querier.poll_query(
+            job, app.config['QUERY_POLL_TIMEOUT'])
+    except mcbench.xpath.XPathError as e:
+        return flask.jsonify(done=True, error=str(e))
+    query = Query.find_by_xpath(searched)
+    matches = query.get_cached_matches()[:top]
+    return flask.jsonify(
+        done=done,
+        incomplete=query.incomplete,
+        position=querier.queue_position(job) if job else 0,
+        processed=job.processed if job else 0,
+        total=job.total if job else 0,
+        total_matches=sum(m.num_matches for m in matches),
+        matches=[{
+            'title': m.benchmark.title,
+            'url': flask.url_for('benchmark', name=m.benchmark.name,
+                                 query=xpath),
+            'num_matches': m.num_matches,
+        } for m in matches])
+
+
+@app.route('/list/cancel', methods=['POST'])
+def cancel_query():
+    xpath = flask.request.values['xpath']
+    mode, top = get_mode()
+    if querier.cancel_query(*querier.mode_query(xpath, mode, top)):
+        flask.flash('Search cancelled.', 'info')
+    return redirect('benchmark_list', query=xpath, mode=mode, top=top)
+
+
+@app.route('/stats', methods=['GET'])
+def stats():
+    return flask.jsonify(querier.cache_stats())
+
+
 @app.route('/benchmark/<name>', methods=['GET'])
 def benchmark(name):
     benchmark = Benchmark.find_by_name(name)
@@ -78,16 +158,44 @@ def benchmark(name):
         hl_lines = querier.matching_lines(benchmark, None)
 
     num_matches = sum(len(v['m']) for v in hl_lines.values())
+    files = list(benchmark.files)
+    # Only the source shown first is highlighted up front; the page fetches
+    # the others from benchmark_source when they're looked at.
+    shown_file = next((f for f in files if hl_lines[f.name]['m']),
+                      files[0] if files else None)
 
     return flask.render_template(
         'benchmark.html',
         benchmark=benchmark,
-        files=list(benchmark.files),
+        files=files,
+        shown_file=shown_file,
+        query=query,
         hl_lines=hl_lines,
         num_matches=num_matches,
     )
 
 
+@app.route('/benchmark/<name>/source', methods=['GET'])
+def benchmark_source(name):
+    benchmark = Benchmark.find_by_name(name)
+    if benchmark is None:
+        flask.abort(404)
+    path = flask.request.args.get('file')
+    file = next((f for f in benchmark.files if f.path == path), None)
+    highlight = {
+        'm': mcbench.highlighters.matlab_file,
+        'xml': mcbench.highlighters.xml_file,
+    }.get(flask.request.args.get('lang'))
+    if file is None or highlight is None:
+        flask.abort(404)
+
+    try:
+        lines = querier.matching_lines_in(file, get_valid_query_or_throw())
+    except mcbench.xpath.XPathError:
+        lines = querier.matching_lines_in(file, None)
+    return highlight(file, lines[flask.request.args['lang']])
+
+
 @app.route('/save_query', methods=['POST'])
 def save_query():
     xpath = flask.request.values['xpath']
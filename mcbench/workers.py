@@ -0,0 +1,378 @@
+"""A pool of long-lived worker processes.
+
+Unlike multiprocessing.Pool, each task is routed to a fixed worker chosen by
+a shard key (e.g. the benchmark name). A worker therefore keeps seeing the
+same benchmarks from one query to the next, and whatever it caches about them
+in its own memory stays useful.
+
+Each worker talks to the pool over its own pipe and is only handed its next
+task once it's done with the last one, so a job can be aborted (cancelled,
+or cut short for going over its time or memory budget) by dropping its
+queued tasks and killing just the workers busy with it. They are replaced by
+fresh ones, and the other jobs carry on.
+"""
+import collections
+import cPickle
+import ctypes
+import gc
+import multiprocessing
+import os
+import Queue
+import select
+import signal
+import threading
+import time
+import zlib
+
+# How long a worker asked to shrink (see WorkerPool) has to get back under
+# the memory limit.
+SHRINK_GRACE = 1
+
+try:
+    _malloc_trim = ctypes.CDLL('libc.so.6').malloc_trim
+except (OSError, AttributeError):
+    _malloc_trim = None
+
+
+class JobAborted(Exception):
+    """Raised by a ResultIterator when its job stopped before finishing."""
+
+
+class Cancelled(JobAborted):
+    pass
+
+
+class BudgetExceeded(JobAborted):
+    pass
+
+
+class WorkerDied(JobAborted):
+    pass
+
+
+def _shrink_handler(shrink):
+    def handle(signum, frame):
+        shrink()
+        gc.collect()
+        # Hand the freed memory back, or the worker's RSS wouldn't go down.
+        if _malloc_trim is not None:
+            _malloc_trim(0)
+    return handle
+
+
+def _work(conn, initializer, initargs, shrink):
+    if shrink is not None:
+        signal.signal(signal.SIGUSR1, _shrink_handler(shrink))
+        # Don't break off reading the next task.
+        signal.siginterrupt(signal.SIGUSR1, False)
+    if initializer is not None:
+        initializer(*initargs)
+    for job_id, index, func, args in iter(conn.recv, None):
+        try:
+            result = (True, func(args))
+        except Exception as e:
+            try:
+                cPickle.dumps(e, cPickle.HIGHEST_PROTOCOL)
+            except Exception:
+                e = Exception(repr(e))
+            result = (False, e)
+        conn.send((job_id, index, result))
+
+
+def _rss(pid):
+    """Returns the resident memory of a process in bytes, if it can tell."""
+    try:
+        with open('/proc/%d/statm' % pid) as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError):
+        return None
+
+
+class ResultIterator(object):
+    """Iterates over the results of a job as workers finish them.
+
+    Like the iterator returned by multiprocessing.Pool.imap_unordered, next
+    accepts a timeout and raises multiprocessing.TimeoutError when it expires.
+    Once the job is aborted, it raises the JobAborted it was aborted with.
+    """
+    def __init__(self, total, job_id=None):
+        self.total = total
+        self.received = 0
+        self.job_id = job_id
+        self.aborted = None
+        self._results = Queue.Queue()
+
+    def __iter__(self):
+        return self
+
+    def _put(self, index, result):
+        self._results.put((index, result))
+
+    def _abort(self, e):
+        self.aborted = e
+        self._results.put((None, (False, e)))
+
+    def next(self, timeout=None):
+        return self.next_indexed(timeout)[1]
+
+    def next_indexed(self, timeout=None):
+        index, (success, value) = self.next_result(timeout)
+        if not success:
+            raise value
+        return index, value
+
+    def next_result(self, timeout=None):
+        """Returns the next (index, (success, value)) pair as it came from
+        the worker, without raising the exception of failed tasks."""
+        if self.received == self.total:
+            raise StopIteration
+        try:
+            index, result = self._results.get(timeout=timeout)
+        except Queue.Empty:
+            raise multiprocessing.TimeoutError
+        if index is None:
+            self._results.put((index, result))
+            raise result[1]
+        self.received += 1
+        return index, result
+
+
+def _ordered(results):
+    ordered = [None] * results.total
+    while True:
+        try:
+            index, result = results.next_indexed()
+        except StopIteration:
+            return ordered
+        ordered[index] = result
+
+
+class _Worker(object):
+    def __init__(self, initializer, initargs, shrink):
+        self.conn, child = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(
+            target=_work, args=(child, initializer, initargs, shrink))
+        self.process.daemon = True
+        self.process.start()
+        child.close()
+        self.backlog = collections.deque()
+        # The (job id, index) of the task being worked on.
+        self.running = None
+        # When it was last asked to shrink, if it's been over the memory
+        # limit since.
+        self.shrunk = None
+
+    def kill(self):
+        self.process.terminate()
+        self.process.join()
+        self.conn.close()
+
+
+class _Job(object):
+    def __init__(self, results, remaining, deadline):
+        self.results = results
+        self.remaining = remaining
+        self.deadline = deadline
+
+
+class WorkerPool(object):
+    """Runs tasks in worker processes.
+
+    Workers using more than memory_limit bytes while working on a task have
+    the job it's part of aborted with BudgetExceeded. If shrink is given,
+    they first have it called (from a signal handler) to free what memory
+    they can spare, such as caches, and the job is only aborted if they're
+    still over the limit SHRINK_GRACE seconds later. As it interrupts the
+    task, shrink mustn't wait on locks the task may hold.
+    """
+    def __init__(self, processes, initializer=None, initargs=(),
+                 memory_limit=None, shrink=None):
+        self._initializer = initializer
+        self._initargs = initargs
+        self._shrink = shrink
+        self.memory_limit = memory_limit
+        self._workers = [_Worker(initializer, initargs, shrink)
+                         for _ in range(processes)]
+        self._jobs = {}
+        self._job_ids = iter(xrange(1, 2 ** 62))
+        self._lock = threading.RLock()
+        self._closed = False
+        # Written to when the workers change, so the collector notices.
+        self._wakeup_read, self._wakeup_write = os.pipe()
+        self._collector = threading.Thread(target=self._collect)
+        self._collector.daemon = True
+        self._collector.start()
+
+    def __len__(self):
+        return len(self._workers)
+
+    def _wake_collector(self):
+        os.write(self._wakeup_write, 'x')
+
+    def _collect(self):
+        while not self._closed:
+            with self._lock:
+                workers = dict((w.conn.fileno(), w) for w in self._workers)
+            try:
+                readable, _, _ = select.select(
+                    list(workers) + [self._wakeup_read], [], [], 0.5)
+            except select.error:
+                # A worker was replaced in the meantime.
+                continue
+            for fd in readable:
+                if fd == self._wakeup_read:
+                    os.read(fd, 4096)
+                    continue
+                worker = workers[fd]
+                try:
+                    job_id, index, result = worker.conn.recv()
+                except (EOFError, IOError):
+                    self._worker_died(worker)
+                else:
+                    self._finished(worker, job_id, index, result)
+            self._check_budgets()
+
+    def _send_next(self, worker):
+        """Hands worker its next task, if it's idle and has one."""
+        while worker.running is None and worker.backlog:
+            task = worker.backlog.popleft()
+            if task[0] not in self._jobs:
+                continue
+            try:
+                worker.conn.send(task)
+            except (IOError, OSError):
+                worker.backlog.appendleft(task)
+                return
+            worker.running = task[:2]
+
+    def _finished(self, worker, job_id, index, result):
+        with self._lock:
+            if worker not in self._workers:
+                return
+            worker.running = None
+            job = self._jobs.get(job_id)
+            if job is not None:
+                job.remaining -= 1
+                if job.remaining == 0:
+                    del self._jobs[job_id]
+            self._send_next(worker)
+        if job is not None:
+            job.results._put(index, result)
+
+    def _replace(self, worker):
+        """Kills worker and starts another to take over its backlog."""
+        i = self._workers.index(worker)
+        worker.kill()
+        replacement = _Worker(self._initializer, self._initargs,
+                              self._shrink)
+        replacement.backlog = worker.backlog
+        self._workers[i] = replacement
+        self._send_next(replacement)
+        self._wake_collector()
+
+    def _worker_died(self, worker):
+        with self._lock:
+            if self._closed or worker not in self._workers:
+                return
+            running = worker.running
+            self._replace(worker)
+            if running is not None:
+                self._abort(running[0], WorkerDied(
+                    'worker process %d died' % worker.process.pid))
+
+    def _abort(self, job_id, e):
+        with self._lock:
+            job = self._jobs.pop(job_id, None)
+            if job is None:
+                return
+            for worker in list(self._workers):
+                worker.backlog = collections.deque(
+                    task for task in worker.backlog if task[0] != job_id)
+                if worker.running is not None and worker.running[0] == job_id:
+                    self._replace(worker)
+        job.results._abort(e)
+
+    def _check_budgets(self):
+        now = time.time()
+        with self._lock:
+            overdue = [job_id for job_id, job in self._jobs.iteritems()
+                       if job.deadline is not None and now > job.deadline]
+            for job_id in overdue:
+                self._abort(job_id, BudgetExceeded('time limit exceeded'))
+            if self.memory_limit is None:
+                return
+            for worker in list(self._workers):
+                if worker.running is None:
+                    continue
+                rss = _rss(worker.process.pid)
+                if rss is None or rss <= self.memory_limit:
+                    worker.shrunk = None
+                elif self._shrink is not None and worker.shrunk is None:
+                    worker.shrunk = now
+                    os.kill(worker.process.pid, signal.SIGUSR1)
+                elif (self._shrink is None or
+                      now - worker.shrunk > SHRINK_GRACE):
+                    self._abort(worker.running[0],
+                                BudgetExceeded('memory limit exceeded'))
+
+    def shard(self, key):
+        return (zlib.crc32(key) & 0xffffffff) % len(self._workers)
+
+    def _submit(self, func, items, workers, deadline=None):
+        with self._lock:
+            job_id = next(self._job_ids)
+            results = ResultIterator(len(items), job_id)
+            if not items:
+                return results
+            self._jobs[job_id] = _Job(results, len(items), deadline)
+            for index, (item, worker) in enumerate(zip(items, workers)):
+                self._workers[worker].backlog.append(
+                    (job_id, index, func, item))
+            for worker in set(workers):
+                self._send_next(self._workers[worker])
+        return results
+
+    def imap_unordered(self, func, iterable, key=None, deadline=None):
+        """Runs func over iterable, yielding results as they come in.
+
+        key maps each item to the string its worker is chosen by; without
+        it, items are dealt out to the workers in turn. If the job isn't done
+        by deadline (a time.time()), it's aborted with BudgetExceeded.
+        """
+        items = list(iterable)
+        if key is None:
+            workers = [i % len(self._workers) for i in range(len(items))]
+        else:
+            workers = [self.shard(key(item)) for item in items]
+        return self._submit(func, items, workers, deadline)
+
+    def broadcast(self, func, arg=None):
+        """Runs func(arg) once in every worker and returns the results."""
+        return _ordered(self._submit(func, [arg] * len(self._workers),
+                                     range(len(self._workers))))
+
+    def map(self, func, iterable, key=None):
+        return _ordered(self.imap_unordered(func, iterable, key))
+
+    def cancel(self, results, e=None):
+        """Aborts the job whose results are results, with e (by default
+        Cancelled)."""
+        self._abort(results.job_id, e or Cancelled('cancelled'))
+
+    def close(self):
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            workers = list(self._workers)
+        for worker in workers:
+            try:
+                worker.conn.send(None)
+            except (IOError, OSError):
+                pass
+        for worker in workers:
+            worker.process.join()
+        self._wake_collector()
+        self._collector.join()
+        for fd in (self._wakeup_read, self._wakeup_write):
+            os.close(fd)
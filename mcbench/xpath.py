@@ -1,8 +1,18 @@
+import collections
 import functools
+import gzip
+import os
+import re
+import struct
 import sys
+from xml.sax.saxutils import quoteattr
 
 import lxml.etree
 
+from mcbench.cache import LRUCache
+import mcbench.rewriting
+from mcbench import settings
+
 
 class XPathError(Exception):
     def __init__(self, query, cause):
@@ -26,19 +36,160 @@ class XPathQuery(object):
             raise XPathError(self.query, e), None, sys.exc_info()[2]
 
 
+class _Parser(lxml.etree.XMLParser):
+    # The loop variables annotate_xml recorded in the document parsed with
+    # this parser, by source line; None if it wasn't annotated. A document
+    # keeps its parser, so extensions find them with getroottree().parser.
+    loopvars = None
+
+
+# McLab ASTs have no text content, so the whitespace between elements can be
+# dropped while parsing, which makes parsing about a third faster.
+def _parser():
+    return _Parser(remove_blank_text=True)
+
+
+def _take_annotations(root, parser):
+    """Moves the attributes annotate_xml added out of the tree into parser,
+    so that queries see the same document in annotated and plain XML."""
+    if root.get(ANNOTATED) is None:
+        return
+    del root.attrib[ANNOTATED]
+    parser.loopvars = dict(
+        (element.sourceline, element.attrib.pop(LOOPVARS).split())
+        for element in root.xpath('//*[@%s]' % LOOPVARS))
+
+
 def parse_xml(xml):
-    return lxml.etree.XML(xml)
+    parser = _parser()
+    root = lxml.etree.XML(xml, parser)
+    _take_annotations(root, parser)
+    return root
 
 
 def parse_xml_filename(filename):
-    return lxml.etree.parse(filename)
+    parser = _parser()
+    # libxml2 reads gzipped files by itself.
+    tree = lxml.etree.parse(filename, parser)
+    _take_annotations(tree.getroot(), parser)
+    return tree
+
+
+# XML can be stored gzipped (see File.store_xml), with this added to its
+# name.
+GZIP_SUFFIX = '.gz'
+
+
+def open_xml(filename, mode='rb', compressed=None):
+    """Opens stored XML, gzipped if compressed is true or, by default, if
+    filename ends with GZIP_SUFFIX."""
+    if compressed is None:
+        compressed = filename.endswith(GZIP_SUFFIX)
+    if compressed:
+        return gzip.open(filename, mode, 6)
+    return open(filename, mode)
+
 
+def xml_size(filename):
+    """Returns the size of the XML stored in filename, uncompressed."""
+    if not filename.endswith(GZIP_SUFFIX):
+        return os.path.getsize(filename)
+    # gzip ends with the size of the data, modulo 2 ** 32.
+    with open(filename, 'rb') as f:
+        f.seek(-4, os.SEEK_END)
+        return struct.unpack('<I', f.read(4))[0]
 
-def compile(query):
+
+_INDENTATION = re.compile(r'>\n[ \t]+<')
+
+
+def compact_xml(xml):
+    """Strips the indentation from serialized XML.
+
+    The result parses to the same tree with the same source lines, and for
+    McLab ASTs is about half the size.
+    """
+    return _INDENTATION.sub('>\n<', xml)
+
+
+# Attributes added to ASTs at ingest so that extensions don't have to walk
+# up the tree: the root gets ANNOTATED, and every element inside a loop gets
+# LOOPVARS, the loop variables of the enclosing loops, innermost first.
+# They're taken out again when the AST is parsed; see _take_annotations.
+ANNOTATED = '_annotated'
+LOOPVARS = '_loopvars'
+
+
+def _loop_annotations(xml):
+    """Sets LOOPVARS on the elements of xml inside loops, and yields them."""
+    for element in xml.iter():
+        if not isinstance(element.tag, basestring):
+            continue
+        parent = element.getparent()
+        loopvars = parent.get(LOOPVARS) if parent is not None else None
+        if element.tag == 'ForStmt':
+            loopvars = ' '.join(filter(None, [
+                element[0][0][0].get('nameId'), loopvars]))
+        if loopvars:
+            element.set(LOOPVARS, loopvars)
+            yield element, LOOPVARS, loopvars
+
+
+def annotate_xml(xml, tree=None):
+    """Adds the ANNOTATED and LOOPVARS attributes to serialized XML with at
+    most one tag per line, like compact_xml returns. tree is xml parsed, if
+    it already was; the attributes are added to it too.
+
+    The attributes are added to the start tags as they are, so the source
+    lines don't change. XML laid out any other way, or with loops that don't
+    look like McLab's, is returned unchanged.
+    """
+    if tree is None:
+        tree = parse_xml(xml)
+    lines = xml.split('\n')
+    annotations = [(tree, ANNOTATED, '1')]
     try:
-        return XPathQuery(query, lxml.etree.XPath(query))
-    except lxml.etree.XPathError as e:
-        raise XPathError(query, e), None, sys.exc_info()[2]
+        annotations.extend(_loop_annotations(tree))
+    except IndexError:
+        return xml
+    annotated_lines = set()
+    for element, name, value in annotations:
+        i = element.sourceline - 1
+        start = '<' + element.tag
+        if (i in annotated_lines or not lines[i].startswith(start) or
+                lines[i][len(start):len(start) + 1] not in (' ', '>', '/')):
+            return xml
+        lines[i] = '%s %s=%s%s' % (start, name, quoteattr(value),
+                                   lines[i][len(start):])
+        annotated_lines.add(i)
+    return '\n'.join(lines)
+
+
+# Compiled queries by query text. Malformed queries are cached too, as the
+# XPathError compiling them raised.
+compiled_queries = LRUCache(settings.XPATH_CACHE_SIZE)
+
+
+def compile(query, rewrite=True):
+    """Compiles query, with the extension calls that can be evaluated without
+    calling back into Python rewritten (see mcbench.rewriting), unless
+    rewrite is False. Only rewritten queries are cached."""
+    if not rewrite:
+        try:
+            return XPathQuery(query, lxml.etree.XPath(query))
+        except lxml.etree.XPathError as e:
+            raise XPathError(query, e)
+    compiled = compiled_queries.get(query)
+    if compiled is None:
+        try:
+            compiled = XPathQuery(
+                query, lxml.etree.XPath(mcbench.rewriting.rewrite(query)))
+        except lxml.etree.XPathError as e:
+            compiled = XPathError(query, e)
+        compiled_queries.put(query, compiled)
+    if isinstance(compiled, XPathError):
+        raise compiled
+    return compiled
 
 
 class UnexpectedContext(Exception):
@@ -54,6 +205,13 @@ class UnexpectedContext(Exception):
 
 ns = lxml.etree.FunctionNamespace(None)
 
+# How many times each extension was called in this process.
+extension_calls = collections.Counter()
+
+
+def extension_call_count():
+    return sum(extension_calls.itervalues())
+
 
 def extension(*nodes):
     """Decorator to register a function as an xpath extension.
@@ -66,6 +224,7 @@ def extension(*nodes):
         @functools.wraps(f)
         def wrapper(context, *args):
             node = context.context_node
+            extension_calls[f.__name__] += 1
             if nodes is not None and node.tag not in nodes:
                 raise UnexpectedContext(f.__name__, node.tag, nodes)
             return f(context, *args)
@@ -130,6 +289,9 @@ def target(context):
 @extension
 def loopvars(context):
     node = context.context_node
+    annotated = getattr(node.getroottree().parser, 'loopvars', None)
+    if annotated is not None:
+        return annotated.get(node.sourceline, [])
     loop_vars = []
     while node is not None:
         if node.tag == 'ForStmt':
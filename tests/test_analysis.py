@@ -0,0 +1,89 @@
+from nose.tools import eq_, ok_
+
+import mcbench.analysis
+import mcbench.xpath
+
+
+def analyze(query):
+    return mcbench.analysis.analyze(mcbench.xpath.compile(query))
+
+
+def required(query):
+    return sorted(sorted(terms) for terms in analyze(query).required)
+
+
+def test_tokenize():
+    eq_(['//', 'ForStmt', '[', 'is_call', '(', "'eval'", ')', ']'],
+        mcbench.analysis.tokenize("//ForStmt[is_call( 'eval' )]"))
+
+
+def test_steps_are_required():
+    eq_([['AssignStmt'], ['ForStmt']], required('//ForStmt//AssignStmt'))
+
+
+def test_is_call_requires_name():
+    eq_([['@nameId=eval'], ['ParameterizedExpr']],
+        required("//ParameterizedExpr[is_call('eval')]"))
+
+
+def test_is_call_with_several_names_requires_any():
+    eq_([['@nameId=eval', '@nameId=feval'], ['ParameterizedExpr']],
+        required("//ParameterizedExpr[is_call('eval', 'feval')]"))
+
+
+def test_conjuncts_are_required():
+    eq_([['@kind=FUN'], ['@nameId=eval'], ['Name'], ['NameExpr'],
+         ['ParameterizedExpr']],
+        required("//ParameterizedExpr[is_call('eval') and "
+                 "NameExpr[@kind='FUN']/Name]"))
+
+
+def test_disjunctions_require_nothing_extra():
+    eq_([['ParameterizedExpr']],
+        required("//ParameterizedExpr[is_call('eval') or is_call('feval')]"))
+
+
+def test_negations_require_nothing_extra():
+    eq_([['ForStmt']], required('//ForStmt[not(.//IfStmt)]'))
+
+
+def test_unions_require_nothing():
+    eq_([], required('//ForStmt | //WhileStmt'))
+
+
+def test_non_literal_is_call_requires_nothing_extra():
+    eq_([['ParameterizedExpr']],
+        required('//ParameterizedExpr[is_call(ancestor::Function/Name/@nameId)]'))
+
+
+def test_count_of_tag_is_counted_tag():
+    eq_('ForStmt', analyze('count(//ForStmt)').counted_tag)
+    eq_('ForStmt', analyze('//ForStmt').counted_tag)
+    eq_(None, analyze('//ForStmt[1]').counted_tag)
+    eq_(None, analyze('//ForStmt/AssignStmt').counted_tag)
+
+
+def test_last_step_is_result_tag():
+    eq_('AssignStmt', analyze('//ForStmt//AssignStmt[1]').result_tag)
+    eq_('ForStmt', analyze('count(//AssignStmt/parent::ForStmt)').result_tag)
+    eq_(None, analyze('//ForStmt/@nameId').result_tag)
+    eq_(None, analyze('//ForStmt | //WhileStmt').result_tag)
+
+
+def test_boolean_is_existence_query():
+    analysis = analyze('boolean(//ForStmt)')
+    ok_(analysis.exists)
+    eq_(None, analysis.counted_tag)
+    eq_([frozenset(['ForStmt'])], analysis.required)
+    ok_(not analyze('//ForStmt').exists)
+
+
+def test_document_terms():
+    xml = mcbench.xpath.parse_xml(
+        '<A><NameExpr kind="FUN"><Name nameId="eval"/></NameExpr>'
+        '<Name nameId="eval"/></A>')
+    terms = mcbench.analysis.document_terms(xml)
+    eq_(1, terms['NameExpr'])
+    eq_(2, terms['Name'])
+    eq_(2, terms['@nameId=eval'])
+    eq_(1, terms['@kind=FUN'])
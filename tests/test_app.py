@@ -1,8 +1,15 @@
+import json
+import os
+import shutil
+import tempfile
+import time
+
 from nose.tools import eq_, assert_in, assert_not_in
 
 import manage
-from mcbench import app
-from mcbench.models import db
+from mcbench.workers import WorkerPool
+from mcbench import app, querier, settings
+from mcbench.models import db, Benchmark
 
 
 class TestMcBenchApp(object):
@@ -50,6 +57,10 @@ class TestMcBenchApp(object):
         eq_(200, response.status_code)
         assert_in('Found 16 occurrences', response.data)
 
+    def test_query_stats_on_list_page(self):
+        response = self._search_for('//ForStmt[loopvars()]')
+        assert_in('16 extension calls', response.data)
+
     def test_saved_query_on_list_page(self):
         manage.load_initial_queries()
         response = self._search_for("//ParameterizedExpr[is_call('eval')]")
@@ -66,6 +77,58 @@ class TestMcBenchApp(object):
         eq_(200, response.status_code)
         assert_in('XPathEvalError', response.data)
 
+    def test_slow_query_shows_progress_until_done(self):
+        app.config['QUERY_WAIT_TIMEOUT'] = 0
+        try:
+            response = self._search_for('//ForStmt[is_stmt()]')
+        finally:
+            app.config['QUERY_WAIT_TIMEOUT'] = 5
+        eq_(200, response.status_code)
+        status = {'done': False}
+        while not status['done']:
+            status = json.loads(
+                self._get('/list/status', query='//ForStmt[is_stmt()]').data)
+        response = self._search_for('//ForStmt[is_stmt()]')
+        assert_in('Found 16 occurrences', response.data)
+
+    def test_cancelled_query_shows_incomplete_results(self):
+        pool = WorkerPool(1)
+        local = querier.use_executor(pool)
+        busy = pool.imap_unordered(time.sleep, [60])
+        app.config['QUERY_WAIT_TIMEOUT'] = 0
+        try:
+            self._search_for('//ForStmt[is_stmt()]')
+            response = self._post('/list/cancel', xpath='//ForStmt[is_stmt()]')
+        finally:
+            app.config['QUERY_WAIT_TIMEOUT'] = 5
+            pool.cancel(busy)
+            querier.use_executor(local)
+            pool.close()
+        assert_in('Search cancelled.', response.data)
+        assert_in('id="incomplete"', response.data)
+        response = self._get('/list', query='//ForStmt[is_stmt()]', resume=1)
+        assert_in('Found 16 occurrences', response.data)
+
+    def test_search_modes_on_list_page(self):
+        response = self._get('/list', query='//ForStmt', mode='exists')
+        assert_in('Found 2 matching benchmarks', response.data)
+        response = self._get('/list', query='//ForStmt', mode='top', top=1)
+        assert_in('Found the 1 benchmark with the most', response.data)
+        eq_(400, self._get('/list', query='//ForStmt',
+                           mode='bad').status_code)
+        for top in (0, -1):
+            eq_(400, self._get('/list', query='//ForStmt', mode='top',
+                               top=top).status_code)
+
+    def test_status_of_bad_query_has_error(self):
+        response = self._get('/list/status', query='//ForStmt[bad()]')
+        assert_in('XPathEvalError', json.loads(response.data)['error'])
+
+    def test_stats_count_compiled_query_cache_hits(self):
+        self._search_for('//ForStmt[is_stmt()]')
+        stats = json.loads(self._get('/stats').data)
+        assert stats['workers']['xpath']['hits'] > 0
+
     def test_benchmark_page_renders_without_errors(self):
         eq_(200, self.app.get('/benchmark/1888-repmf').status_code)
 
@@ -73,6 +136,39 @@ class TestMcBenchApp(object):
         response = self._search_benchmark_for('1888-repmf', '//IfStmt')
         assert_in('Found 2 occurrences', response.data)
 
+    def test_benchmark_page_loads_xml_lazily(self):
+        response = self._search_benchmark_for('1888-repmf', '//IfStmt')
+        assert_not_in('CompilationUnits', response.data)
+        response = self._get('/benchmark/1888-repmf/source',
+                             file='1888-repmf/repmf', lang='xml',
+                             query='//IfStmt')
+        eq_(200, response.status_code)
+        assert_in('CompilationUnits', response.data)
+        eq_(2, response.data.count('class="hll"'))
+
+    def test_source_of_file_named_like_another(self):
+        data_root = settings.DATA_ROOT
+        settings.DATA_ROOT = tempfile.mkdtemp()
+        try:
+            root = os.path.join(settings.DATA_ROOT, '1888-repmf')
+            shutil.copytree(os.path.join(data_root, '1888-repmf'), root)
+            os.mkdir(os.path.join(root, 'sub'))
+            with open(os.path.join(root, 'sub', 'repmf.m'), 'w') as f:
+                f.write('other = 1;')
+            Benchmark.find_by_name('1888-repmf').scan_files()
+            response = self._get('/benchmark/1888-repmf/source',
+                                 file='1888-repmf/sub/repmf', lang='m')
+        finally:
+            shutil.rmtree(settings.DATA_ROOT)
+            settings.DATA_ROOT = data_root
+        eq_(200, response.status_code)
+        assert_in('other', response.data)
+
+    def test_source_of_unknown_file_is_not_found(self):
+        response = self._get('/benchmark/1888-repmf/source',
+                             file='nope', lang='m')
+        eq_(404, response.status_code)
+
     def test_syntax_error_in_benchmark_query_flashes_error(self):
         response = self._search_benchmark_for('1888-repmf', r'\\ForStmt')
         assert_in('XPathSyntaxError', response.data)
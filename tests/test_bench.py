@@ -0,0 +1,52 @@
+import json
+import os
+import shutil
+import tempfile
+
+from nose.tools import eq_, ok_, assert_raises
+
+import mcbench.bench
+
+
+class TestCorpus(object):
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.directory)
+
+    def _make(self, name, seed):
+        destination = os.path.join(self.directory, name)
+        mcbench.bench.make_corpus('testdata', destination, 2, seed=seed)
+        return destination
+
+    def _read(self, corpus, path):
+        with open(os.path.join(corpus, path)) as f:
+            return f.read()
+
+    def test_corpus_has_copies_of_every_benchmark(self):
+        corpus = self._make('corpus', 0)
+        with open(os.path.join(corpus, 'manifest.json')) as f:
+            names = [p['name'] for p in json.load(f)['projects']]
+        eq_(6, len(names))
+        for name in names:
+            ok_(os.path.isdir(os.path.join(corpus, name)))
+
+    def test_corpus_is_reproducible(self):
+        path = '8636-emgm-1/EM_GM.xml'
+        eq_(self._read(self._make('a', 1), path),
+            self._read(self._make('b', 1), path))
+
+    def test_skewed_corpus_has_giant_benchmarks(self):
+        corpus = os.path.join(self.directory, 'skewed')
+        mcbench.bench.make_skewed_corpus('testdata', corpus, 1, 2, 3)
+        with open(os.path.join(corpus, 'manifest.json')) as f:
+            names = [p['name'] for p in json.load(f)['projects']]
+        eq_(5, len(names))
+        eq_(9, len([name for name in os.listdir(
+            os.path.join(corpus, 'giant-1')) if name.endswith('.m')]))
+
+
+def test_run_needs_a_warm_run():
+    with assert_raises(ValueError):
+        mcbench.bench.run([('example', '//ForStmt')], 0)
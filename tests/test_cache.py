@@ -0,0 +1,49 @@
+from nose.tools import eq_, ok_
+
+from mcbench.cache import LRUCache
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = LRUCache(2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    cache.get('a')
+    cache.put('c', 3)
+    eq_(1, cache.get('a'))
+    eq_(None, cache.get('b'))
+    eq_(3, cache.get('c'))
+
+
+def test_entries_are_evicted_by_size():
+    cache = LRUCache(10)
+    cache.put('a', 1, size=4)
+    cache.put('b', 2, size=4)
+    cache.put('c', 3, size=4)
+    ok_('a' not in cache)
+    eq_(8, cache.total_size)
+
+
+def test_entry_larger_than_cache_is_not_kept():
+    cache = LRUCache(10)
+    cache.put('a', 1, size=11)
+    eq_(0, len(cache))
+    eq_(0, cache.total_size)
+
+
+def test_hits_and_misses_are_counted():
+    cache = LRUCache(10)
+    cache.put('a', 1)
+    cache.get('a')
+    cache.get('b')
+    eq_(1, cache.hits)
+    eq_(1, cache.misses)
+
+
+def test_clear_without_blocking_waits_for_the_cache_to_be_free():
+    cache = LRUCache(10)
+    cache.put('a', 1)
+    with cache._lock:
+        cache.clear(blocking=False)
+        eq_(1, len(cache))
+    eq_(None, cache.get('a'))
+    eq_(0, cache.total_size)
@@ -0,0 +1,260 @@
+import json
+import os
+import shutil
+import tempfile
+
+import chardet
+
+from nose.tools import eq_, ok_, assert_raises
+
+import manage
+from mcbench.models import db, insert_many, Benchmark, File, Query
+from mcbench import querier, settings
+
+
+class TestMigrate(object):
+    def setup(self):
+        db.init(':memory:')
+
+    def teardown(self):
+        manage.drop_tables()
+
+    def test_migrate_adds_missing_tables_and_columns(self):
+        # The benchmark table as it was before files were recorded.
+        db.execute_sql(
+            'CREATE TABLE "benchmark" ("id" INTEGER NOT NULL PRIMARY KEY, '
+            '"author" VARCHAR(255) NOT NULL, '
+            '"author_url" VARCHAR(255) NOT NULL, '
+            '"date_submitted" DATE NOT NULL, "date_updated" DATE NOT NULL, '
+            '"name" VARCHAR(255) NOT NULL, "summary" TEXT NOT NULL, '
+            '"tags" VARCHAR(255) NOT NULL, "title" VARCHAR(255) NOT NULL, '
+            '"url" VARCHAR(255) NOT NULL)')
+        db.execute_sql(
+            'INSERT INTO "benchmark" VALUES '
+            '(1, "", "", "2002-06-25", "2002-06-26", "1888-repmf", "", "", '
+            '"", "")')
+        manage.migrate()
+        columns = set(row[1] for row in
+                      db.execute_sql('PRAGMA table_info("benchmark")'))
+        ok_('scanned' in columns)
+        ok_('file' in db.get_tables())
+        benchmark = Benchmark.get(Benchmark.id == 1)
+        # Its files were scanned.
+        eq_(1, benchmark.version)
+        eq_(['1888-repmf/repmf'], [f.path for f in benchmark.files])
+        ok_(benchmark.files[0].node_count)
+
+    def test_migrate_merges_duplicate_queries(self):
+        manage.create_tables()
+        for xpath, name in (('//ForStmt', ''), (' //ForStmt', 'Loops'),
+                            ('//WhileStmt', '')):
+            db.execute_sql('INSERT INTO "query" ("xpath", "name") '
+                           'VALUES (?, ?)', (xpath, name))
+        manage.migrate()
+        eq_([('//ForStmt', 'Loops', '//ForStmt'),
+             ('//WhileStmt', '', '//WhileStmt')],
+            [(q.xpath, q.name, q.normalized)
+             for q in Query.select().order_by(Query.id)])
+
+    def test_migrate_adds_missing_indexes(self):
+        manage.create_tables()
+        db.execute_sql('DROP INDEX "querymatch_query_id_num_matches"')
+        manage.migrate()
+        indexes = set(row[1] for row in
+                      db.execute_sql('PRAGMA index_list("querymatch")'))
+        ok_('querymatch_query_id_num_matches' in indexes)
+        ok_('querymatch_query_id_benchmark_id_version' in indexes)
+
+
+class TestDatabase(object):
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+        # Drop the connection to the last test's database, if any.
+        db.get_conn()
+        db.close()
+        db.init(os.path.join(self.directory, 'test.sqlite'))
+
+    def teardown(self):
+        db.close()
+        shutil.rmtree(self.directory)
+
+    def test_connections_use_write_ahead_logging(self):
+        eq_('wal', db.execute_sql('PRAGMA journal_mode').fetchone()[0])
+        eq_(1, db.execute_sql('PRAGMA synchronous').fetchone()[0])
+
+
+class TestRefreshFiles(object):
+    def setup(self):
+        self.data_root = settings.DATA_ROOT
+        settings.DATA_ROOT = tempfile.mkdtemp()
+        shutil.copytree(os.path.join(self.data_root, '1888-repmf'),
+                        os.path.join(settings.DATA_ROOT, '1888-repmf'))
+        db.init(':memory:')
+        manage.create_tables()
+        self.benchmark = Benchmark.create(
+            author='', author_url='', date_submitted='2002-06-25',
+            date_updated='2002-06-26', name='1888-repmf', summary='',
+            tags='', title='', url='')
+        self.benchmark.scan_files()
+        # Make sure the changes below don't happen within the same clock tick
+        # as the scan.
+        self.benchmark.scanned -= 10
+        self.benchmark.save()
+        # Workers started before DATA_ROOT changed wouldn't see it.
+        self.pool = querier.local_pool(1)
+        self.local = querier.use_executor(self.pool)
+
+    def teardown(self):
+        querier.use_executor(self.local)
+        self.pool.close()
+        manage.drop_tables()
+        shutil.rmtree(settings.DATA_ROOT)
+        settings.DATA_ROOT = self.data_root
+
+    def _write(self, path, contents=''):
+        path = os.path.join(settings.DATA_ROOT, '1888-repmf', path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write(contents)
+
+    def test_scan_records_files(self):
+        eq_(['1888-repmf/repmf'], [f.path for f in self.benchmark.files])
+
+    def test_refresh_with_no_changes(self):
+        ok_(not self.benchmark.refresh_files())
+
+    def test_refresh_finds_new_files(self):
+        self._write('new.m')
+        self._write('sub/other.m')
+        ok_(self.benchmark.refresh_files())
+        eq_(['1888-repmf/new', '1888-repmf/repmf', '1888-repmf/sub/other'],
+            [f.path for f in self.benchmark.files])
+
+    def test_refresh_of_nested_benchmark_keeps_known_files(self):
+        self._write('a/b/nested.m')
+        self.benchmark.scan_files()
+        self.benchmark.scanned -= 10
+        self.benchmark.save()
+        self._write('README')
+        self._write('a/new.m')
+        ok_(self.benchmark.refresh_files())
+        eq_(['1888-repmf/a/b/nested', '1888-repmf/a/new', '1888-repmf/repmf'],
+            [f.path for f in self.benchmark.files])
+
+    def test_refresh_finds_changed_files(self):
+        self._write('repmf.m', 'x = 1;')
+        ok_(self.benchmark.refresh_files())
+        eq_(6, self.benchmark.files[0].size)
+
+    def test_refresh_forgets_encoding_of_changed_files(self):
+        File.update(encoding='ascii').execute()
+        self._write('repmf.m', 'disp(\'\xe9t\xe9\');')
+        ok_(self.benchmark.refresh_files())
+        eq_(None, self.benchmark.files[0].encoding)
+        manage.validate_benchmarks([self.benchmark])
+        file = self.benchmark.files[0]
+        ok_(file.encoding not in (None, 'ascii'))
+        eq_(u"disp('\xe9t\xe9');", file.read_matlab())
+
+    def test_files_with_different_fields_set_are_inserted_together(self):
+        insert_many([File(benchmark=self.benchmark, path='a'),
+                     File(benchmark=self.benchmark, path='b', xml_size=1,
+                          parse_error='bad')])
+        files = dict((f.path, f) for f in self.benchmark.files)
+        eq_((None, None), (files['a'].xml_size, files['a'].parse_error))
+        eq_((1, 'bad'), (files['b'].xml_size, files['b'].parse_error))
+
+    def test_refresh_forgets_removed_files(self):
+        os.remove(os.path.join(settings.DATA_ROOT, '1888-repmf', 'repmf.m'))
+        ok_(self.benchmark.refresh_files())
+        eq_([], self.benchmark.files)
+
+
+class TestLoadManifest(object):
+    def setup(self):
+        self.data_root = settings.DATA_ROOT
+        settings.DATA_ROOT = tempfile.mkdtemp()
+        for name in ('1888-repmf', '8636-emgm'):
+            shutil.copytree(os.path.join(self.data_root, name),
+                            os.path.join(settings.DATA_ROOT, name))
+        # Cut the XML of one file short.
+        with open(os.path.join(settings.DATA_ROOT, '8636-emgm',
+                               'EM_GM.xml'), 'r+') as f:
+            f.truncate(1000)
+        with open(os.path.join(self.data_root, 'manifest.json')) as f:
+            self.projects = [p for p in json.load(f)['projects']
+                             if p['name'] in ('1888-repmf', '8636-emgm')]
+        self.manifest = self._write_manifest(self.projects)
+        db.init(':memory:')
+        manage.create_tables()
+        # Workers started before DATA_ROOT changed wouldn't see it.
+        self.pool = querier.local_pool(1)
+        self.local = querier.use_executor(self.pool)
+
+    def teardown(self):
+        querier.use_executor(self.local)
+        self.pool.close()
+        manage.drop_tables()
+        shutil.rmtree(settings.DATA_ROOT)
+        settings.DATA_ROOT = self.data_root
+
+    def _write_manifest(self, projects):
+        path = os.path.join(settings.DATA_ROOT, 'manifest.json')
+        with open(path, 'w') as f:
+            json.dump({'projects': projects}, f)
+        return path
+
+    def test_unparsable_files_are_marked_and_skipped(self):
+        manage.load_manifest(self.manifest)
+        files = dict((f.name, f) for f in File.select())
+        ok_(files['EM_GM'].parse_error)
+        eq_(None, files['EM_GM'].node_count)
+        eq_(None, files['repmf'].parse_error)
+        ok_(files['repmf'].node_count > 0)
+        eq_([], querier.get_matches('//ForStmt[loopvars()]'))
+        benchmark = Benchmark.find_by_name('8636-emgm')
+        eq_([], querier.matching_lines(benchmark, '//*')['EM_GM']['m'])
+
+    def test_encodings_are_detected_once(self):
+        manage.load_manifest(self.manifest)
+        eq_(['ascii', 'ascii'], [f.encoding for f in File.select()])
+        detect = chardet.detect
+        chardet.detect = None
+        try:
+            for file in File.select():
+                ok_(file.read_matlab())
+        finally:
+            chardet.detect = detect
+
+    def test_missing_encodings_are_backfilled(self):
+        manage.load_manifest(self.manifest)
+        File.update(encoding=None).execute()
+        eq_(2, querier.detect_encodings(Benchmark.all()))
+        eq_(['ascii', 'ascii'], [f.encoding for f in File.select()])
+        eq_(0, querier.detect_encodings(Benchmark.all()))
+
+    def test_benchmarks_are_committed_before_validation(self):
+        validate = manage.validate_benchmarks
+        autocommit = []
+        manage.validate_benchmarks = (
+            lambda benchmarks: autocommit.append(db.get_autocommit()))
+        try:
+            manage.load_manifest(self.manifest)
+        finally:
+            manage.validate_benchmarks = validate
+        eq_([True], autocommit)
+
+    def test_loading_again_adds_nothing(self):
+        manage.load_manifest(self.manifest)
+        manage.load_manifest(self.manifest)
+        eq_(2, Benchmark.count())
+        eq_(2, File.select().count())
+
+    def test_failed_load_adds_nothing(self):
+        manifest = self._write_manifest(
+            self.projects + [dict(self.projects[0], name='bad',
+                                  date_submitted='yesterday')])
+        with assert_raises(ValueError):
+            manage.load_manifest(manifest)
+        eq_(0, Benchmark.count())
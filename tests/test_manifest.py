@@ -0,0 +1,32 @@
+import json
+import StringIO
+
+from nose.tools import eq_, assert_raises
+
+from mcbench.manifest import iter_projects
+
+
+def _projects(manifest, chunk_size=7):
+    return list(iter_projects(StringIO.StringIO(manifest), chunk_size))
+
+
+def test_projects_match_loading_whole_manifest():
+    with open('testdata/manifest.json') as f:
+        manifest = f.read()
+    eq_(json.loads(manifest)['projects'], _projects(manifest))
+
+
+def test_other_members_are_skipped():
+    eq_([{'name': 'a'}, {'name': 'b'}],
+        _projects('{"version": 12345, "projects": [{"name": "a"}, '
+                  '{"name": "b"}], "other": {"projects": []}}'))
+
+
+def test_empty_manifests():
+    eq_([], _projects('{}'))
+    eq_([], _projects('{"projects": [ ]}'))
+
+
+def test_truncated_manifest_is_an_error():
+    with assert_raises(ValueError):
+        _projects('{"projects": [{"name": "a"}, {"name"')
@@ -0,0 +1,64 @@
+import glob
+
+from nose.tools import eq_, ok_
+
+import manage
+import mcbench.xpath
+from mcbench.normalization import normalize
+
+QUERIES = [xpath for _, xpath in manage.EXAMPLE_QUERIES] + [
+    '//ForStmt[count(.//AssignStmt) > 1 or loopvars() = "i"]',
+    '//ParameterizedExpr[num_args() - 1 > 0 and is_call("size")]',
+    '//BinaryExpr[count(*) mod 2 = 0]',
+    '//*[self::AssignStmt and name(lhs()) = "NameExpr"]',
+]
+
+
+def test_whitespace_is_made_uniform():
+    eq_('//ForStmt[count(AssignStmt)>1]',
+        normalize(' //ForStmt [ count( AssignStmt ) > 1 ] '))
+
+
+def test_literals_are_single_quoted():
+    eq_("//ParameterizedExpr[is_call('eval')]",
+        normalize('//ParameterizedExpr[is_call("eval")]'))
+    eq_('''//*[@nameId="it's"]''', normalize('''//*[@nameId="it's"]'''))
+
+
+def test_operands_of_and_and_or_are_sorted():
+    eq_(normalize("//A[@x='b' and c or d]"),
+        normalize("//A[d or c and @x='b']"))
+
+
+def test_operands_calling_extensions_keep_their_order():
+    query = "//*[self::AssignStmt and name(lhs())='NameExpr']"
+    eq_(query, normalize(query))
+    ok_(normalize("//*[b and is_call('f') or a]") !=
+        normalize("//*[a or is_call('f') and b]"))
+    eq_(normalize("//*[(c or b) and is_stmt()]"),
+        normalize("//*[(b or c) and is_stmt()]"))
+
+
+def test_function_arguments_keep_their_order():
+    ok_(normalize("//*[concat('a', 'b')]") !=
+        normalize("//*[concat('b', 'a')]"))
+
+
+def test_operators_stay_apart_from_names():
+    eq_('//*[a - b>1 and c mod 2=1]', normalize('//*[a - b>1 and c mod 2=1]'))
+    eq_('//and/or', normalize('//and/or'))
+
+
+def test_normalization_is_idempotent():
+    for query in QUERIES:
+        eq_(normalize(query), normalize(normalize(query)))
+
+
+def test_normalized_queries_have_the_same_results():
+    files = [path for path in glob.glob('testdata/*/*.xml')
+             if not path.endswith('.compact.xml')]
+    for path in files:
+        xml = mcbench.xpath.parse_xml_filename(path)
+        for query in QUERIES:
+            eq_(mcbench.xpath.compile(query).execute(xml),
+                mcbench.xpath.compile(normalize(query)).execute(xml))
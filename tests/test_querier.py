@@ -1,9 +1,16 @@
+import os
+import shutil
+import tempfile
+import time
+
 from nose.tools import eq_, ok_, assert_items_equal, assert_raises
 
 import manage
 import mcbench.xpath
-from mcbench.models import db, Query
-from mcbench import querier
+from mcbench.models import (
+    db, Benchmark, IndexTerm, Query, QueryMatch, QueryStats)
+from mcbench.workers import WorkerPool
+from mcbench import querier, settings
 
 
 class TestQueries(object):
@@ -37,3 +44,449 @@ class TestQueries(object):
         query.unsave()
         cached_matches = query.get_cached_matches()
         eq_(len(original_matches), len(cached_matches))
+
+    def test_caching_results_again_replaces_them(self):
+        query = Query.create(xpath='//ForStmt', name='')
+        benchmarks = list(Benchmark.all())
+        query.cache_matches((b, 1) for b in benchmarks)
+        query.cache_matches([(benchmarks[0], 5)])
+        eq_(len(benchmarks), query.querymatch_set.count())
+        eq_((benchmarks[0].name, 5),
+            (query.get_cached_matches()[0].benchmark.name,
+             query.get_cached_matches()[0].num_matches))
+
+    def test_search_records_match_locations(self):
+        querier.get_matches('//ForStmt//IfStmt')
+        benchmark = Benchmark.find_by_name('8636-emgm')
+        recorded = querier.matching_lines(benchmark, '//ForStmt//IfStmt')
+        QueryMatch.update(locations=None).execute()
+        evaluated = querier.matching_lines(benchmark, '//ForStmt//IfStmt')
+        ok_(recorded['EM_GM']['m'])
+        eq_(evaluated, recorded)
+
+    def test_recorded_match_locations_are_not_evaluated_again(self):
+        querier.get_matches('//ForStmt//IfStmt')
+        benchmark = Benchmark.find_by_name('8636-emgm')
+        matches_in = querier.matches_in
+        querier.matches_in = None
+        try:
+            lines = querier.matching_lines(benchmark, '//ForStmt//IfStmt')
+        finally:
+            querier.matches_in = matches_in
+        ok_(lines['EM_GM']['m'])
+
+    def test_attribute_matches_have_no_recorded_locations(self):
+        querier.get_matches('//ForStmt/@*')
+        query = Query.find_by_xpath('//ForStmt/@*')
+        benchmark = Benchmark.find_by_name('8636-emgm')
+        eq_(None, query.match_locations(benchmark))
+
+    def test_existence_mode_counts_each_matching_benchmark_once(self):
+        matches = querier.get_matches('//ForStmt', mode='exists')
+        eq_([1, 1], [m.num_matches for m in matches])
+        eq_('boolean(//ForStmt)', matches[0].query.xpath)
+        eq_(None, Query.find_by_xpath('//ForStmt'))
+
+    def test_top_mode_skips_benchmarks_that_cannot_place(self):
+        xpath = '//ForStmt[loopvars()]'
+        round_size = settings.TOP_ROUND_SIZE
+        settings.TOP_ROUND_SIZE = 1
+        try:
+            top = querier.get_matches(xpath, mode='top', top=1)
+        finally:
+            settings.TOP_ROUND_SIZE = round_size
+        eq_(['8636-emgm'], [m.benchmark.name for m in top])
+        query = Query.find_by_xpath(xpath)
+        eq_(['33851-wind-barb-plotter'],
+            [b.name for b in query.pending_benchmarks()])
+        eq_(None, querier.start_query(xpath, top=1))
+        everything = querier.get_matches(xpath)
+        eq_(top[0].num_matches, everything[0].num_matches)
+        eq_(2, len(everything))
+
+    def test_count_query(self):
+        matches = querier.get_matches('count(//ForStmt)')
+        eq_(16, sum(m.num_matches for m in matches))
+
+    def test_index_does_not_change_results(self):
+        xpaths = [xpath for _, xpath in manage.EXAMPLE_QUERIES]
+        xpaths.extend(['//ForStmt', '//ForStmt//IfStmt', '//NoSuchTag'])
+
+        def matches(xpath):
+            return dict((benchmark.name, num_matches) for benchmark, num_matches
+                        in querier.compute_matches(xpath))
+
+        indexed = [matches(xpath) for xpath in xpaths]
+        IndexTerm.delete().execute()
+        eq_(indexed, [matches(xpath) for xpath in xpaths])
+
+    def test_interrupted_query_resumes_where_it_left_off(self):
+        xpath = '//ForStmt[is_stmt()]'
+        original_matches = querier.get_matches(xpath)
+        query = Query.find_by_xpath(xpath)
+        benchmark = Benchmark.find_by_name('8636-emgm')
+        QueryMatch.delete().where((QueryMatch.query == query) &
+                                  (QueryMatch.benchmark == benchmark)).execute()
+
+        job = querier.start_query(xpath)
+        eq_(1, job.total)
+        job.wait()
+        eq_(sorted(m.num_matches for m in original_matches),
+            sorted(m.num_matches for m in query.get_cached_matches()))
+
+    def test_find_or_create_returns_existing_query(self):
+        query = Query.find_or_create('//ForStmt')
+        eq_('', query.name)
+        eq_(query.id, Query.find_or_create('//ForStmt').id)
+
+    def test_equivalent_queries_share_cached_results(self):
+        querier.get_matches("//ParameterizedExpr[is_call('eval')]")
+        eq_(None, querier.start_query(
+            '//ParameterizedExpr[ is_call("eval") ]'))
+        eq_(1, Query.select().count())
+
+    def test_searching_records_access(self):
+        querier.get_matches('//ForStmt')
+        querier.get_matches('//ForStmt')
+        query = Query.find_by_xpath('//ForStmt')
+        eq_(2, query.hits)
+        ok_(query.accessed is not None)
+
+    def test_eviction_deletes_least_recently_used_unsaved_queries(self):
+        xpaths = ['//ForStmt', '//WhileStmt', '//IfStmt', '//Function']
+        for i, xpath in enumerate(xpaths):
+            querier.get_matches(xpath)
+            query = Query.find_by_xpath(xpath)
+            query.accessed = 1000 + i
+            query.save()
+        saved = Query.find_by_xpath('//ForStmt')
+        saved.name = 'Loops'
+        saved.save()
+        # The oldest unsaved query was hit often enough to stay.
+        Query.update(hits=10).where(Query.xpath == '//WhileStmt').execute()
+        budget = 2 * Benchmark.count() * QueryMatch.ROW_BYTES
+        eq_(1, Query.evict(max_bytes=budget, hit_weight=1))
+        assert_items_equal(['//ForStmt', '//WhileStmt', '//Function'],
+                           [q.xpath for q in Query.all()])
+        eq_(3 * Benchmark.count(), QueryMatch.select().count())
+
+    def test_saved_queries_results_are_not_budgeted(self):
+        querier.get_matches('//ForStmt')
+        querier.get_matches('//WhileStmt')
+        Query.update(name='Loops').where(Query.xpath == '//ForStmt').execute()
+        eq_(0, Query.evict(
+            max_bytes=Benchmark.count() * QueryMatch.ROW_BYTES, hit_weight=1))
+        eq_(1, Query.evict(max_bytes=0, hit_weight=1))
+        eq_(['//ForStmt'], [q.xpath for q in Query.all()])
+
+    def test_recorded_locations_count_toward_the_budget(self):
+        querier.get_matches('//ForStmt//IfStmt')
+        budget = Benchmark.count() * QueryMatch.ROW_BYTES
+        eq_(1, Query.evict(max_bytes=budget, hit_weight=1))
+
+    def test_eviction_spares_kept_queries(self):
+        querier.get_matches('//ForStmt')
+        query = Query.find_by_xpath('//ForStmt')
+        eq_(0, Query.evict(max_bytes=0, hit_weight=1, keep=[query.id]))
+        eq_(1, Query.evict(max_bytes=0, hit_weight=1))
+        eq_(0, QueryMatch.select().count())
+
+    def test_fully_cached_query_starts_no_job(self):
+        querier.get_matches('//ForStmt')
+        eq_(None, querier.start_query('//ForStmt'))
+
+    def test_query_failing_to_evaluate_is_not_cached(self):
+        with assert_raises(mcbench.xpath.XPathError):
+            querier.get_matches('//ForStmt[badpredicate()]')
+        eq_(None, Query.find_by_xpath('//ForStmt[badpredicate()]'))
+
+    def test_stale_compact_xml_is_not_used(self):
+        file = Benchmark.find_by_name('1888-repmf').files[0]
+        eq_(file.compact_xml_path, file.ast_path)
+        os.utime(file.compact_xml_path, (0, 0))
+        eq_(file.xml_path, file.ast_path)
+        file.write_compact_xml()
+        eq_(file.compact_xml_path, file.ast_path)
+
+    def test_changed_benchmark_is_reevaluated(self):
+        xpath = '//ForStmt'
+        querier.get_matches(xpath)
+        query = Query.find_by_xpath(xpath)
+        benchmark = Benchmark.find_by_name('8636-emgm')
+        benchmark.version += 1
+        benchmark.save()
+        eq_(['8636-emgm'], [b.name for b in query.pending_benchmarks()])
+
+        manage.refresh_query_results()
+        eq_([], query.pending_benchmarks())
+        eq_(16, sum(m.num_matches for m in query.get_cached_matches()))
+
+    def test_refresh_forgets_results_for_removed_benchmarks(self):
+        querier.get_matches('//ForStmt')
+        benchmark = Benchmark.find_by_name('8636-emgm')
+        db.execute_sql('DELETE FROM benchmark WHERE id = ?', (benchmark.id,))
+        manage.refresh_query_results()
+        eq_(0, QueryMatch.select()
+            .where(QueryMatch.benchmark == benchmark.id).count())
+
+    def test_batch_matches_agree_with_single_queries(self):
+        xpaths = [xpath for _, xpath in manage.EXAMPLE_QUERIES]
+        xpaths.extend(['//ForStmt', 'count(//ForStmt)', '//NoSuchTag'])
+        results = querier.compute_matches_many(xpaths)
+        eq_(set(xpaths), set(results))
+        for xpath in xpaths:
+            matches, stats, _ = results[xpath]
+            ok_(stats['evaluate'] >= 0)
+            eq_(sorted((b.name, n) for b, n in querier.compute_matches(xpath)),
+                sorted((b.name, n) for b, n in matches))
+
+    def test_load_initial_queries_caches_all_results(self):
+        manage.load_initial_queries()
+        for query in Query.all():
+            eq_([], query.pending_benchmarks())
+
+    def test_evaluation_costs_are_recorded(self):
+        xpath = '//ForStmt[loopvars()]'
+        querier.get_matches(xpath)
+        query = Query.find_by_xpath(xpath)
+        stats = QueryStats.latest(query)
+        eq_(16, stats.extension_calls)
+        ok_(stats.files > 0)
+        ok_(stats.elapsed >= stats.plan_time + stats.write_time)
+        ok_(query.slowest_matches(3))
+        eq_([stats.id], [s.id for s in QueryStats.slowest(10)])
+
+
+class TestBusyWorkers(object):
+    def setup(self):
+        db.init(':memory:')
+        manage.create_tables()
+        manage.load_manifest('testdata/manifest.json')
+        # A single worker, kept busy so that queries wait for it.
+        self.pool = WorkerPool(1)
+        self.local = querier.use_executor(self.pool)
+        self.busy = self.pool.imap_unordered(time.sleep, [60])
+        self.max_running_queries = settings.MAX_RUNNING_QUERIES
+
+    def teardown(self):
+        for xpath, top in list(querier._jobs):
+            querier.cancel_query(xpath, top)
+        settings.MAX_RUNNING_QUERIES = self.max_running_queries
+        self.pool.cancel(self.busy)
+        querier.use_executor(self.local)
+        self.pool.close()
+        manage.drop_tables()
+
+    def test_cancelled_query_is_marked_incomplete(self):
+        job = querier.start_query('//ForStmt[loopvars()]')
+        ok_(querier.cancel_query('//ForStmt[loopvars()]'))
+        ok_(job.done)
+        query = Query.find_by_xpath('//ForStmt[loopvars()]')
+        eq_('cancelled', query.incomplete)
+        eq_(['cancelled'], [s.incomplete for s in QueryStats.slowest(10)])
+
+    def test_incomplete_query_is_only_resumed_on_request(self):
+        querier.start_query('//ForStmt[loopvars()]')
+        querier.cancel_query('//ForStmt[loopvars()]')
+        eq_(None, querier.start_query('//ForStmt[loopvars()]'))
+        self.pool.cancel(self.busy)
+        matches = querier.get_matches('//ForStmt[loopvars()]')
+        eq_(16, sum(m.num_matches for m in matches))
+        query = Query.find_by_xpath('//ForStmt[loopvars()]')
+        eq_(None, query.incomplete)
+        eq_(None, QueryStats.latest(query).incomplete)
+
+    def test_jobs_are_planned_without_holding_up_other_searches(self):
+        planned = []
+        query_job = querier.QueryJob
+
+        class Job(query_job):
+            def __init__(self, *args):
+                ok_(querier._jobs_lock.acquire(False))
+                querier._jobs_lock.release()
+                planned.append(self)
+                query_job.__init__(self, *args)
+
+        querier.QueryJob = Job
+        try:
+            job = querier.start_query('//ForStmt[loopvars()]')
+        finally:
+            querier.QueryJob = query_job
+        eq_([job], planned)
+
+    def test_cancelling_query_not_running(self):
+        ok_(not querier.cancel_query('//ForStmt[loopvars()]'))
+
+    def test_same_query_runs_once(self):
+        job = querier.start_query('//ForStmt[loopvars()]')
+        ok_(job is querier.start_query('//ForStmt[loopvars()]'))
+
+    def test_queries_wait_their_turn(self):
+        settings.MAX_RUNNING_QUERIES = 1
+        first = querier.start_query('//ForStmt[loopvars()]')
+        second = querier.start_query('//WhileStmt[loopvars()]')
+        eq_(0, querier.queue_position(first))
+        eq_(1, querier.queue_position(second))
+        ok_(not querier.poll_query(second, timeout=0.1))
+        querier.cancel_query('//ForStmt[loopvars()]')
+        eq_(0, querier.queue_position(second))
+        self.pool.cancel(self.busy)
+        ok_(querier.poll_query(second, timeout=None))
+        eq_(None, Query.find_by_xpath('//WhileStmt[loopvars()]').incomplete)
+
+    def test_cancelling_queued_query(self):
+        settings.MAX_RUNNING_QUERIES = 1
+        querier.start_query('//ForStmt[loopvars()]')
+        querier.start_query('//WhileStmt[loopvars()]')
+        ok_(querier.cancel_query('//WhileStmt[loopvars()]'))
+        eq_('cancelled',
+            Query.find_by_xpath('//WhileStmt[loopvars()]').incomplete)
+
+
+class TestSplitTasks(object):
+    def setup(self):
+        self.data_root = settings.DATA_ROOT
+        self.split_size = settings.TASK_SPLIT_SIZE
+        settings.DATA_ROOT = tempfile.mkdtemp()
+        # A benchmark with the files of two.
+        shutil.copytree(os.path.join(self.data_root, '8636-emgm'),
+                        os.path.join(settings.DATA_ROOT, '8636-emgm'))
+        for ext in ('.m', '.xml'):
+            shutil.copy(os.path.join(self.data_root, '33851-wind-barb-plotter',
+                                     'windbarbm' + ext),
+                        os.path.join(settings.DATA_ROOT, '8636-emgm'))
+        db.init(':memory:')
+        manage.create_tables()
+        Benchmark.create(
+            author='', author_url='', date_submitted='2005-10-04',
+            date_updated='2006-03-06', name='8636-emgm', summary='',
+            tags='', title='', url='').scan_files()
+        self.pool = querier.local_pool(2)
+        self.local = querier.use_executor(self.pool)
+
+    def teardown(self):
+        querier.use_executor(self.local)
+        self.pool.close()
+        manage.drop_tables()
+        shutil.rmtree(settings.DATA_ROOT)
+        settings.DATA_ROOT = self.data_root
+        settings.TASK_SPLIT_SIZE = self.split_size
+
+    def test_large_benchmarks_are_split_largest_file_first(self):
+        settings.TASK_SPLIT_SIZE = 0
+        tasks, _, sizes = querier._tasks(Benchmark.all(), '//ForStmt')
+        eq_(([('8636-emgm', '//ForStmt', ['8636-emgm/EM_GM']),
+              ('8636-emgm', '//ForStmt', ['8636-emgm/windbarbm'])],
+             set(['8636-emgm'])),
+            querier._schedule(tasks, sizes))
+
+    def test_files_keep_their_shard_key_whatever_the_index_rules_out(self):
+        _, _, sizes = querier._tasks(Benchmark.all(), '//ForStmt')
+        # The index left a single file to search.
+        task = ('8636-emgm', '//ForStmt', ['8636-emgm/EM_GM'])
+        settings.TASK_SPLIT_SIZE = None
+        tasks, split = querier._schedule([task], sizes)
+        eq_('8636-emgm', querier._task_key(split)(tasks[0]))
+        settings.TASK_SPLIT_SIZE = 0
+        tasks, split = querier._schedule([task], sizes)
+        eq_('8636-emgm/EM_GM', querier._task_key(split)(tasks[0]))
+
+    def test_existence_stops_at_first_matching_file(self):
+        settings.TASK_SPLIT_SIZE = None
+        querier.get_matches('//ForStmt', mode='exists')
+        query = Query.find_by_xpath('boolean(//ForStmt)')
+        eq_(1, QueryStats.latest(query).files)
+
+    def test_refreshed_existence_stops_at_first_matching_file(self):
+        settings.TASK_SPLIT_SIZE = None
+        querier.get_matches('//ForStmt', mode='exists')
+        query = Query.find_by_xpath('boolean(//ForStmt)')
+        Benchmark.update(version=Benchmark.version + 1).execute()
+        stats = querier.update_matches_many([query])['boolean(//ForStmt)']
+        eq_(1, stats.files)
+        eq_([1], [m.num_matches for m in query.get_cached_matches()])
+
+    def test_split_existence_is_not_added_up(self):
+        settings.TASK_SPLIT_SIZE = 0
+        eq_([1], [m.num_matches for m in
+                  querier.get_matches('//ForStmt', mode='exists')])
+        eq_([1], [num_matches for _, num_matches in
+                  querier.compute_matches('boolean(//ForStmt)')])
+
+    def test_split_results_are_added_up(self):
+        settings.TASK_SPLIT_SIZE = None
+        whole = querier.get_matches('//ForStmt//IfStmt')
+        whole_lines = querier.matching_lines(whole[0].benchmark,
+                                             '//ForStmt//IfStmt')
+        Query.find_by_xpath('//ForStmt//IfStmt').delete_instance(
+            recursive=True)
+        settings.TASK_SPLIT_SIZE = 0
+        split = querier.get_matches('//ForStmt//IfStmt')
+        eq_([m.num_matches for m in whole], [m.num_matches for m in split])
+        eq_(whole_lines, querier.matching_lines(split[0].benchmark,
+                                                '//ForStmt//IfStmt'))
+        ok_(split[0].query.match_locations(split[0].benchmark))
+
+
+class TestCompressedStorage(object):
+    def setup(self):
+        self.data_root = settings.DATA_ROOT
+        settings.DATA_ROOT = tempfile.mkdtemp()
+        shutil.copytree(os.path.join(self.data_root, '8636-emgm'),
+                        os.path.join(settings.DATA_ROOT, '8636-emgm'))
+        db.init(':memory:')
+        manage.create_tables()
+        self.pool = querier.local_pool(1)
+        self.local = querier.use_executor(self.pool)
+        self.benchmark = Benchmark.create(
+            author='', author_url='', date_submitted='2005-10-04',
+            date_updated='2006-03-06', name='8636-emgm', summary='',
+            tags='', title='', url='')
+        self.benchmark.scan_files()
+        manage.validate_benchmarks([self.benchmark])
+        self.benchmark.scanned -= 10
+        self.benchmark.save()
+
+    def teardown(self):
+        querier.use_executor(self.local)
+        self.pool.close()
+        manage.drop_tables()
+        shutil.rmtree(settings.DATA_ROOT)
+        settings.DATA_ROOT = self.data_root
+
+    def _search(self, xpath):
+        querier.clear_caches()
+        matches = [m.num_matches for m in querier.get_matches(xpath)]
+        Query.find_by_xpath(xpath).delete_instance(recursive=True)
+        return matches
+
+    def test_compressed_xml_is_read_transparently(self):
+        file = self.benchmark.files[0]
+        xml, xml_size = file.read_xml(), file.xml_size
+        raw = self._search('//ForStmt//IfStmt')
+        eq_(1, querier.store_xml([self.benchmark], True))
+        eq_(['EM_GM.compact.xml.gz', 'EM_GM.m', 'EM_GM.xml.gz'],
+            sorted(os.listdir(file.root)))
+        eq_(file.compact_xml_path, file.ast_path)
+        eq_(xml, file.read_xml())
+        eq_(raw, self._search('//ForStmt//IfStmt'))
+        ok_(not self.benchmark.refresh_files())
+        eq_(xml_size, self.benchmark.files[0].xml_size)
+
+    def test_compact_xml_is_written_like_the_xml(self):
+        querier.store_xml([self.benchmark], True)
+        os.remove(self.benchmark.files[0].compact_xml_path)
+        eq_([], querier.compact_benchmarks([self.benchmark]))
+        ok_(os.path.exists(self.benchmark.files[0].compact_xml_path))
+        ok_(self.benchmark.files[0].compact_xml_path.endswith('.gz'))
+
+    def test_decompressing_restores_the_xml(self):
+        file = self.benchmark.files[0]
+        xml = file.read_xml()
+        querier.store_xml([self.benchmark], True)
+        eq_(1, querier.store_xml([self.benchmark], False))
+        eq_(0, querier.store_xml([self.benchmark], False))
+        eq_(['EM_GM.compact.xml', 'EM_GM.m', 'EM_GM.xml'],
+            sorted(os.listdir(file.root)))
+        with open(file.xml_path) as f:
+            eq_(xml, f.read())
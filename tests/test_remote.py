@@ -0,0 +1,103 @@
+import multiprocessing
+import socket
+import time
+
+from nose.tools import eq_, ok_, assert_raises
+
+import manage
+import mcbench.remote
+from mcbench.models import db
+from mcbench.workers import BudgetExceeded, Cancelled
+from mcbench import querier
+
+AUTHKEY = 'test'
+
+QUERIES = [xpath for _, xpath in manage.EXAMPLE_QUERIES] + ['//ForStmt', '//*']
+
+
+def _free_port():
+    sock = socket.socket()
+    sock.bind(('localhost', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def _serve(address):
+    mcbench.remote.serve(address, AUTHKEY, querier.local_pool(2))
+
+
+def _matches(xpath):
+    return sorted((benchmark.name, num_matches) for benchmark, num_matches
+                  in querier.compute_matches(xpath))
+
+
+class TestRemoteExecutor(object):
+    def setup(self):
+        db.init(':memory:')
+        manage.create_tables()
+        manage.load_manifest('testdata/manifest.json')
+        self.expected = dict((xpath, _matches(xpath)) for xpath in QUERIES)
+
+        self.addresses = [('localhost', _free_port()) for _ in range(3)]
+        self.hosts = []
+        for address in self.addresses:
+            host = multiprocessing.Process(target=_serve, args=(address,))
+            host.start()
+            self.hosts.append(host)
+        self.executor = mcbench.remote.RemoteExecutor(
+            self.addresses, AUTHKEY, timeout=5, retries=1)
+        deadline = time.time() + 10
+        while (len(self.executor.check_health()) < len(self.addresses) and
+               time.time() < deadline):
+            time.sleep(0.1)
+        self.local = querier.use_executor(self.executor)
+
+    def teardown(self):
+        querier.use_executor(self.local)
+        self.executor.close()
+        for host in self.hosts:
+            host.terminate()
+            host.join()
+        manage.drop_tables()
+
+    def test_hosts_need_a_key(self):
+        assert_raises(mcbench.remote.WorkerHostError,
+                      mcbench.remote.RemoteExecutor, self.addresses, None)
+
+    def test_all_hosts_are_live(self):
+        eq_(set(self.addresses), self.executor.live)
+
+    def test_remote_results_match_local(self):
+        for xpath in QUERIES:
+            eq_(self.expected[xpath], _matches(xpath))
+
+    def test_broadcast_reaches_every_worker(self):
+        eq_(6, len(self.executor.broadcast(querier._cache_stats)))
+
+    def test_tasks_of_dead_host_go_to_another(self):
+        dead = self.executor.shard('8636-emgm')
+        self.hosts[dead].terminate()
+        self.hosts[dead].join()
+        for xpath in QUERIES:
+            eq_(self.expected[xpath], _matches(xpath))
+        ok_(self.addresses[dead] not in self.executor.live)
+
+    def test_health_check_notices_dead_host(self):
+        self.hosts[1].terminate()
+        self.hosts[1].join()
+        eq_(set(self.addresses) - set([self.addresses[1]]),
+            self.executor.check_health())
+
+    def test_cancelled_job_stops(self):
+        results = self.executor.imap_unordered(time.sleep, [60] * 6)
+        self.executor.cancel(results)
+        with assert_raises(Cancelled):
+            results.next()
+        eq_(self.expected['//*'], _matches('//*'))
+
+    def test_host_aborts_job_past_its_deadline(self):
+        results = self.executor.imap_unordered(
+            time.sleep, [60] * 6, deadline=time.time() + 0.5)
+        with assert_raises(BudgetExceeded):
+            results.next(timeout=10)
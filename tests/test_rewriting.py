@@ -0,0 +1,50 @@
+import glob
+
+from nose.tools import eq_
+
+import manage
+import mcbench.xpath
+from mcbench.rewriting import rewrite
+
+QUERIES = [xpath for _, xpath in manage.EXAMPLE_QUERIES] + [
+    '//ParameterizedExpr[is_call()]',
+    "//ParameterizedExpr[is_call('length', 'isempty')]",
+    '//*[is_stmt()]',
+    '//*[is_expr() and not(is_stmt())]',
+    '//ParameterizedExpr[num_args() > 1][arg(2)]',
+    '//ParameterizedExpr[name(target())="NameExpr"]',
+    '//ForStmt//AssignStmt[loopvars() = lhs()/Name/@nameId]',
+]
+
+
+def test_is_call_with_literal_is_rewritten():
+    eq_("//ParameterizedExpr[boolean(*[1][self::NameExpr][@kind='FUN']"
+        "/*[1][@nameId='eval'])]",
+        rewrite("//ParameterizedExpr[is_call('eval')]"))
+
+
+def test_tag_tests_are_rewritten():
+    eq_("//*[(substring(name(), string-length(name()) - 3) = 'Stmt')]",
+        rewrite('//*[is_stmt()]'))
+
+
+def test_calls_in_unknown_context_are_not_rewritten():
+    for query in ["//*[is_call('eval')]", '//ForStmt[lhs()]',
+                  '//ParameterizedExpr/@kind[is_stmt()]', 'is_stmt()']:
+        eq_(query, rewrite(query))
+
+
+def test_calls_with_other_arguments_are_not_rewritten():
+    for query in ['//ParameterizedExpr[is_call(NameExpr)]',
+                  '//ParameterizedExpr[arg(position())]']:
+        eq_(query, rewrite(query))
+
+
+def test_rewritten_queries_have_the_same_results():
+    files = [path for path in glob.glob('testdata/*/*.xml')
+             if not path.endswith('.compact.xml')]
+    for path in files:
+        xml = mcbench.xpath.parse_xml_filename(path)
+        for query in QUERIES:
+            eq_(mcbench.xpath.compile(query, rewrite=False).execute(xml),
+                mcbench.xpath.compile(query).execute(xml))
@@ -0,0 +1,121 @@
+import os
+import time
+
+from nose.tools import eq_, assert_raises
+
+from mcbench.workers import (
+    BudgetExceeded, Cancelled, WorkerDied, WorkerPool)
+
+
+def square(x):
+    return x * x
+
+
+def pid(_):
+    return os.getpid()
+
+
+def fail(x):
+    raise ValueError(x)
+
+
+def sleep(seconds):
+    time.sleep(seconds)
+
+
+def die(_):
+    os._exit(1)
+
+
+_cache = []
+
+
+def fill_cache(size):
+    _cache.append(' ' * size)
+
+
+def empty_cache():
+    del _cache[:]
+
+
+def pause(seconds):
+    # Signals cut time.sleep short.
+    end = time.time() + seconds
+    while time.time() < end:
+        time.sleep(0.1)
+
+
+def hog(size):
+    data = ' ' * size
+    pause(2)
+    return len(data)
+
+
+class TestWorkerPool(object):
+    def setup(self):
+        self.pool = WorkerPool(4)
+
+    def teardown(self):
+        self.pool.close()
+
+    def test_map_returns_results_in_order(self):
+        eq_([x * x for x in range(20)], self.pool.map(square, range(20)))
+
+    def test_imap_unordered_returns_all_results(self):
+        results = self.pool.imap_unordered(square, range(20))
+        eq_(sorted(x * x for x in range(20)), sorted(results))
+
+    def test_items_with_same_key_go_to_same_worker(self):
+        pids = self.pool.map(pid, ['a', 'b'] * 10, key=lambda item: item)
+        eq_(1, len(set(pids[::2])))
+        eq_(1, len(set(pids[1::2])))
+
+    def test_exception_in_worker_is_reraised(self):
+        with assert_raises(ValueError):
+            self.pool.map(fail, [1])
+
+    def test_map_with_no_items(self):
+        eq_([], self.pool.map(square, []))
+
+    def test_closing_twice(self):
+        self.pool.close()
+        self.pool.close()
+
+    def test_cancelled_job_stops_and_others_carry_on(self):
+        slow = self.pool.imap_unordered(sleep, [60] * 4)
+        self.pool.cancel(slow)
+        with assert_raises(Cancelled):
+            slow.next()
+        eq_([x * x for x in range(20)], self.pool.map(square, range(20)))
+
+    def test_job_past_its_deadline_is_aborted(self):
+        start = time.time()
+        results = self.pool.imap_unordered(sleep, [60],
+                                           deadline=time.time() + 0.5)
+        with assert_raises(BudgetExceeded):
+            results.next()
+        eq_(4, len(set(self.pool.map(pid, range(20)))))
+        assert time.time() - start < 10
+
+    def test_worker_dying_aborts_its_job(self):
+        with assert_raises(WorkerDied):
+            self.pool.map(die, [1])
+        eq_([4], self.pool.map(square, [2]))
+
+
+class TestWorkerPoolMemoryLimit(object):
+    def setup(self):
+        self.pool = WorkerPool(1, memory_limit=256 * 1024 * 1024,
+                               shrink=empty_cache)
+
+    def teardown(self):
+        self.pool.close()
+
+    def test_job_using_too_much_memory_is_aborted(self):
+        with assert_raises(BudgetExceeded):
+            self.pool.map(hog, [512 * 1024 * 1024])
+        eq_([1024], self.pool.map(hog, [1024]))
+
+    def test_worker_over_the_limit_with_its_cache_empties_it(self):
+        self.pool.map(fill_cache, [384 * 1024 * 1024])
+        eq_([None], self.pool.map(pause, [3]))
@@ -1,6 +1,6 @@
 import mcbench.xpath
 
-from nose.tools import eq_, assert_raises
+from nose.tools import eq_, ok_, assert_raises
 
 
 def test_compiling_malformed_query_raises_error():
@@ -40,3 +40,83 @@ def test_unexpected_context_for_extension_function_raises_error():
     xml = mcbench.xpath.parse_xml('<ForStmt></ForStmt>')
     with assert_raises(mcbench.xpath.XPathError):
         query.execute(xml)
+
+
+def test_compact_xml_parses_to_same_tree_with_same_lines():
+    with open('testdata/8636-emgm/EM_GM.xml') as f:
+        xml = f.read()
+    compact = mcbench.xpath.compact_xml(xml)
+    assert len(compact) < len(xml)
+    original = list(mcbench.xpath.parse_xml(xml).iter())
+    compacted = list(mcbench.xpath.parse_xml(compact).iter())
+    eq_(len(original), len(compacted))
+    for a, b in zip(original, compacted):
+        eq_((a.tag, dict(a.attrib), a.sourceline),
+            (b.tag, dict(b.attrib), b.sourceline))
+
+
+def test_annotated_xml_keeps_lines_and_query_results():
+    with open('testdata/8636-emgm/EM_GM.xml') as f:
+        compact = mcbench.xpath.compact_xml(f.read())
+    plain = mcbench.xpath.parse_xml(compact)
+    annotated = mcbench.xpath.parse_xml(mcbench.xpath.annotate_xml(compact))
+    ok_(annotated.getroottree().parser.loopvars)
+    eq_([e.sourceline for e in plain.iter()],
+        [e.sourceline for e in annotated.iter()])
+    for query in ['//*[loopvars()]', '//*[count(loopvars()) > 1]',
+                  '//ForStmt//Name[@nameId = loopvars()]']:
+        query = mcbench.xpath.compile(query)
+        eq_([e.sourceline for e in query.execute(plain)],
+            [e.sourceline for e in query.execute(annotated)])
+
+
+def test_loopvars_are_annotated_innermost_first():
+    xml = mcbench.xpath.annotate_xml(
+        '<CompilationUnits>\n'
+        '<ForStmt>\n<AssignStmt>\n<NameExpr>\n<Name nameId="i"/>\n'
+        '</NameExpr>\n</AssignStmt>\n'
+        '<ForStmt>\n<AssignStmt>\n<NameExpr>\n<Name nameId="j"/>\n'
+        '</NameExpr>\n</AssignStmt>\n'
+        '<ExprStmt/>\n'
+        '</ForStmt>\n</ForStmt>\n</CompilationUnits>')
+    eq_(['<ExprStmt _loopvars="j i"/>'],
+        [line for line in xml.split('\n') if line.startswith('<ExprStmt')])
+    tree = mcbench.xpath.parse_xml(xml)
+    statement = tree.find('.//ExprStmt')
+    eq_(['j', 'i'],
+        tree.getroottree().parser.loopvars[statement.sourceline])
+
+
+def test_queries_do_not_see_annotations():
+    with open('testdata/8636-emgm/EM_GM.xml') as f:
+        xml = f.read()
+    plain = mcbench.xpath.parse_xml(xml)
+    annotated = mcbench.xpath.parse_xml(
+        mcbench.xpath.annotate_xml(mcbench.xpath.compact_xml(xml)))
+    for query in ['count(//@*)', 'count(//*[@*[starts-with(name(), "_")]])',
+                  'count(//*[@*])']:
+        query = mcbench.xpath.compile(query)
+        eq_(query.execute(plain), query.execute(annotated))
+
+
+def test_xml_with_several_tags_on_a_line_is_not_annotated():
+    xml = ('<CompilationUnits><ForStmt><AssignStmt><NameExpr>'
+           '<Name nameId="i"/></NameExpr></AssignStmt></ForStmt>'
+           '</CompilationUnits>')
+    eq_(xml, mcbench.xpath.annotate_xml(xml))
+
+
+def test_compiled_queries_are_cached():
+    hits = mcbench.xpath.compiled_queries.hits
+    query = mcbench.xpath.compile('//IfStmt[is_stmt()]')
+    assert mcbench.xpath.compile('//IfStmt[is_stmt()]') is query
+    eq_(hits + 1, mcbench.xpath.compiled_queries.hits)
+
+
+def test_malformed_queries_are_cached():
+    with assert_raises(mcbench.xpath.XPathError):
+        mcbench.xpath.compile(r'\\IfStmt')
+    hits = mcbench.xpath.compiled_queries.hits
+    with assert_raises(mcbench.xpath.XPathError):
+        mcbench.xpath.compile(r'\\IfStmt')
+    eq_(hits + 1, mcbench.xpath.compiled_queries.hits)